@@ -0,0 +1,50 @@
+"""
+Hourly energy differences of the results of the InfluxDB queries.
+Kept apart from main.py (FastAPI, Prophet and InfluxDB client) so that it can be tested without them.
+"""
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def hourly_energy_deltas(points) -> pd.DataFrame:
+    """ The query must have GROUP BY time('time(1h)'). Normally h but can be changed to other time intervals.
+    points come in UTC timezone. The points can be the cumulative counter (the differences are calculated here)
+    or the differences calculated by InfluxDB in a column named delta_energy.
+    Return a DataFrame indexed by time with the column delta_energy (NaN in the hours with a counter reset).
+    """
+    df = pd.DataFrame(points)
+
+    if 'time' not in df.columns:
+        logger.error("No 'time' column in the data")
+        raise ValueError("Column 'time' not found in the input data")
+
+    df['time'] = pd.to_datetime(df['time']).dt.tz_localize(None) # Eliminate the timezone for Prophet
+
+    # Convert time to the index of the DataFrame
+    df.set_index('time', inplace=True)
+
+    if df.empty:
+        raise ValueError("DataFrame is empty after setting 'time' as index")
+
+    if 'delta_energy' in df.columns:
+        # The query already returns the hourly differences (SELECT non_negative_difference(last("value")) AS "delta_energy").
+        # InfluxDB omits the first hour and the hours with a counter reset, Prophet treats them as missing values
+        df = df[['delta_energy']]
+        df = df.drop(df.index[-1]) # Remove the last row of the DataFrame (there isn´t enough data yet in the last hour)
+        return df
+
+    # Create a new column that calculates the hourly energy difference
+    df['delta_energy'] = df.iloc[:,0].diff() # Calculate the difference between consecutive values
+    df = df.drop(df.index[0]) # Remove the first row of the DataFrame (the hourly difference of the first record does not make sense)
+    df = df.drop(df.index[-1]) # Remove the last row of the DataFrame (there isn´t enough data yet in the last hour)
+
+    # If there has been any counter reset, the difference will be negative
+    mask = df['delta_energy'] < 0
+    # The next line is replaced because Prophet can manage perfectly the NaN values
+    # df.loc[mask, 'delta_energy'] = 0 # In those cases, set the difference to 0
+    df.loc[mask, 'delta_energy'] = np.nan # In those cases, set the difference to NaN
+
+    return df
@@ -1,12 +1,23 @@
+import asyncio
+import hashlib
 import logging
 import json
+import multiprocessing
 import os
-from fastapi import FastAPI, HTTPException
+import re
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from fastapi import BackgroundTasks, FastAPI, HTTPException
 from pydantic import BaseModel
 from prophet import Prophet
-import numpy as np
+from prophet.serialize import model_from_json, model_to_json
 import pandas as pd
 from influxdb import InfluxDBClient
+from energy_data import hourly_energy_deltas
 
 # Set logger
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -23,6 +34,23 @@ INFLUXDB_USER = options.get("INFLUXDB_USER", "user")
 INFLUXDB_PASSWORD = options.get("INFLUXDB_PASSWORD", "password")
 INFLUXDB_DBNAME = options.get("INFLUXDB_DBNAME", "database")
 
+# Maximum number of fitted models kept in memory (one for each pair of queries)
+MODEL_CACHE_SIZE = 8
+# Folder of the fitted models saved to survive the restarts of the add-on (/data is persistent)
+MODELS_DIR = '/data/prophet_models'
+# Processes that fit the Prophet models, one for each core of the host
+FIT_WORKERS = os.cpu_count() or 1
+# Maximum number of different fits running or waiting for a free process
+MAX_QUEUED_FITS = 4 * FIT_WORKERS
+# Seconds that the result of a finished job is kept to be read by the client
+JOB_RESULT_TTL = 3600
+# Maximum seconds that a poll of a job waits for its result (long-poll)
+MAX_JOB_WAIT = 30
+# Maximum number of InfluxDB clients kept open (one for each InfluxDB server and credentials)
+INFLUX_CLIENTS_SIZE = 4
+# Columns of the Prophet forecast returned with intervals=True: forecast and limits of the uncertainty interval
+FORECAST_BANDS = ['yhat', 'yhat_lower', 'yhat_upper']
+
 app = FastAPI()
 
 class ForecastRequest(BaseModel):
@@ -50,6 +78,8 @@ class EnergyQueryRequest(BaseModel):
     influx_dbname: str = INFLUXDB_DBNAME # os.getenv("INFLUXDB_DBNAME", "homeassistant")
     futurePeriods: int = 30
     futureFreq: str = "h"
+    hourlyDays: int = 0 # The history older than hourlyDays is aggregated to daily means (0: all the history is hourly)
+    intervals: bool = False # Return also the uncertainty interval: {"yhat": {...}, "yhat_lower": {...}, "yhat_upper": {...}}
 
 @app.post("/forecast")
 async def forecast(request: ForecastRequest):
@@ -76,19 +106,9 @@ async def forecast(request: ForecastRequest):
     # Delocalize the dates
     df['ds'] = pd.to_datetime(df['ds']).dt.tz_localize(None)
 
-    # Configure and train the Prophet model
-    model = Prophet()
-    model.fit(df)
-    future = model.make_future_dataframe(periods=futurePeriods, freq=futureFreq)
-    forecast = model.predict(future)
-    forecast = forecast[['ds', 'yhat']].tail(futurePeriods)
-    
-    # Convert dates to ISO format without timezone and create the output dictionary    
-    forecast['ds'] = forecast['ds'].dt.strftime('%Y-%m-%dT%H:%M:%S')
-    forecast = forecast.set_index('ds')
-    response = forecast.to_dict()['yhat']
- 
-    return response
+    # Configure and train the Prophet model in the process pool
+    fit_key = ('forecast', training_fingerprint(df), futurePeriods, futureFreq)
+    return await run_fit(fit_key, forecast_data_job, df, futurePeriods, futureFreq)
 
 @app.post("/query")
 async def query(request: QueryRequest):
@@ -104,11 +124,11 @@ async def query(request: QueryRequest):
     try:
         # Connect to InfluxDB
         logger.debug(f"Executing query: {str_query}")
-        client = InfluxDBClient(host=host, port=port, username=user, password=password, database=dbname)
+        client = get_influx_client(host, port, user, password, dbname)
         logger.debug("Connected to InfluxDB")
 
-        # Execute the query
-        result = client.query(str_query)
+        # Execute the query (in a thread, the event loop keeps serving other requests)
+        result = await asyncio.to_thread(client.query, str_query)
         logger.debug("Query executed successfully")
 
         # Convert the result to a DataFrame
@@ -131,18 +151,11 @@ async def query(request: QueryRequest):
         # Delocalize the dates
         df['ds'] = pd.to_datetime(df['ds']).dt.tz_localize(None)
 
-        # Configure and train the Prophet model
-        model = Prophet()
-        model.fit(df)
-        future = model.make_future_dataframe(periods=futurePeriods, freq=futureFreq)
-        forecast = model.predict(future)
-        forecast=forecast.tail(futurePeriods)
+        # Configure and train the Prophet model in the process pool
+        fit_key = ('query', training_fingerprint(df), futurePeriods, futureFreq)
+        _, response = await run_fit(fit_key, fit_forecast_job, df, futurePeriods, futureFreq)
 
-        forecast['ds'] = pd.to_datetime(forecast['ds']).dt.tz_localize('UTC')
-        forecast = forecast.set_index('ds')
-        response = forecast.to_dict()['yhat']        
-
-        return response
+        return response['yhat']
     
     except ConnectionError:
         logger.error("Failed to connect to InfluxDB")
@@ -152,53 +165,328 @@ async def query(request: QueryRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-async def delta_energy_dataframe(points) -> pd.DataFrame:
-    """ The query must have GROUP BY time('time(1h)'). Normally h but can be changed to other time intervals.
-    points come in UTC timezone.
+# InfluxDB clients by connection parameters (least recently used first). Each client keeps its HTTP session open
+_influx_clients = OrderedDict()
+
+
+def get_influx_client(host, port, user, password, dbname) -> InfluxDBClient:
     """
+    Return the InfluxDB client for the connection parameters, creating it the first time.
+    Only the INFLUX_CLIENTS_SIZE most recently used clients are kept, the session of the others is closed.
+    """
+    key = (host, port, user, password, dbname)
+    client = _influx_clients.get(key)
+    if client is None:
+        client = InfluxDBClient(host=host, port=port, username=user, password=password, database=dbname)
+        _influx_clients[key] = client
+        logger.debug(f"New InfluxDB client for {host}:{port}/{dbname}")
+        while len(_influx_clients) > INFLUX_CLIENTS_SIZE:
+            _, evicted = _influx_clients.popitem(last=False)
+            close_influx_client(evicted)
+    _influx_clients.move_to_end(key)
+    return client
+
+
+def close_influx_client(client: InfluxDBClient):
+    """Close the HTTP session of an InfluxDB client."""
     try:
-        df = pd.DataFrame(points)
-        
-        if 'time' not in df.columns:
-            logger.error("No 'time' column in the data")
-            raise ValueError("Column 'time' not found in the input data")
-        
-        df['time'] = pd.to_datetime(df['time']).dt.tz_localize(None) # Eliminate the timezone for Prophet
-        
-        # Convert time to the index of the DataFrame
-        df.set_index('time', inplace=True)
-        
-        if df.empty:
-            raise ValueError("DataFrame is empty after setting 'time' as index")
-        
-        # Create a new column that calculates the hourly energy difference
-        df['delta_energy'] = df.iloc[:,0].diff() # Calculate the difference between consecutive values
-        df = df.drop(df.index[0]) # Remove the first row of the DataFrame (the hourly difference of the first record does not make sense)
-        df = df.drop(df.index[-1]) # Remove the last row of the DataFrame (there isn´t enough data yet in the last hour)
-                
-        # If there has been any counter reset, the difference will be negative
-        mask = df['delta_energy'] < 0
-        # The next line is replaced because Prophet can manage perfectly the NaN values
-        # df.loc[mask, 'delta_energy'] = 0 # In those cases, set the difference to 0
-        df.loc[mask, 'delta_energy'] = np.nan # In those cases, set the difference to NaN
-        
+        client.close()
+    except Exception as e:
+        logger.warning(f"Error closing the InfluxDB client: {e}")
+
+
+# Time conditions of the queries, e.g. (time <= '2024-10-01T00:00:00Z')
+TIME_CONDITION = r"(?:\(\s*)?time\s*[<>]=?\s*'[^']*'(?:\s*\))?"
+
+
+def strip_time_bounds(str_query: str | None) -> str | None:
+    """Return the query without the time conditions, so that the same query of each hour has the same key."""
+    if str_query is None:
+        return None
+    str_query = re.sub(TIME_CONDITION + r"\s+AND\s+", "", str_query, flags=re.IGNORECASE)
+    str_query = re.sub(r"\s+AND\s+" + TIME_CONDITION, "", str_query, flags=re.IGNORECASE)
+    str_query = re.sub(r"WHERE\s+" + TIME_CONDITION + r"\s*", "", str_query, flags=re.IGNORECASE)
+    return " ".join(str_query.split())
+
+
+def query_end_hour(str_query: str | None) -> str:
+    """
+    Return the hour of the upper time bound of the query, e.g. '2024-10-01T00'.
+    If the query has no upper bound, the current UTC hour is returned.
+    """
+    match = re.search(r"time\s*<=?\s*'([^']*)'", str_query or "", flags=re.IGNORECASE)
+    if match is None:
+        return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H')
+    return match.group(1)[:13]
+
+
+@dataclass
+class CachedModel:
+    """Fitted Prophet model of a pair of queries and its last forecast."""
+    model: Prophet
+    model_json: str  # The model serialized with model_to_json, to send it to the process pool and save it
+    last_ds: pd.Timestamp  # Last hour used to fit the model
+    end_hour: str  # Upper bound of the queries of the last request
+    futurePeriods: int
+    futureFreq: str
+    response: dict
+    fingerprint: str  # Hash of the training window
+    restored: bool = False  # Loaded from MODELS_DIR and not refitted since the restart
+
+
+# Fitted models by the pair of queries without their time bounds (least recently used first)
+_model_cache: OrderedDict = OrderedDict()
+# Keys of the restored models that are being refitted in the background
+_refitting = set()
+
+
+def stan_init(model: Prophet) -> dict:
+    """Return the parameters of a fitted model to initialize the fit of a new model (warm start)."""
+    res = {}
+    for pname in ['k', 'm', 'sigma_obs']:
+        res[pname] = model.params[pname][0][0]
+    for pname in ['delta', 'beta']:
+        res[pname] = model.params[pname][0]
+    return res
+
+
+def new_prophet(df: pd.DataFrame) -> Prophet:
+    """
+    Create the Prophet model for the training data.
+    If the data has daily means (column hourly False, see downsample_history) the daily seasonality
+    is only applied to the hourly rows: the mean of a day does not depend on the hour.
+    """
+    if 'hourly' not in df.columns:
+        return Prophet()
+    model = Prophet(daily_seasonality=False)
+    model.add_seasonality(name='daily', period=1, fourier_order=4, condition_name='hourly')
+    return model
+
+
+def fit_prophet(df: pd.DataFrame, init: dict | None = None) -> Prophet:
+    """
+    Fit a Prophet model starting from the parameters of the previous model (stan_init) if they are available.
+    The optimizer converges in a few iterations since only the last hours are new.
+    """
+    if init is not None:
+        try:
+            model = new_prophet(df)
+            model.fit(df, init=init)
+            return model
+        except Exception as e:
+            # The number of parameters changes if a new seasonality is enabled (e.g. yearly with 2 years of data)
+            logger.warning(f"Warm start failed, fitting the model from scratch: {e}")
+    model = new_prophet(df)
+    model.fit(df)
+    return model
+
+
+def downsample_history(df: pd.DataFrame, hourly_days: int) -> pd.DataFrame:
+    """
+    Aggregate the rows older than hourly_days before the last one to a daily mean (at 12:00 of each day).
+    The number of rows, and so the fit time, grows by one row per day instead of 24 for the old history.
+    The column hourly tells Prophet which rows have daily seasonality.
+    """
+    if hourly_days <= 0:
         return df
-    
+    cutoff = (df['ds'].max() - pd.Timedelta(days=hourly_days)).normalize()
+    old = df[df['ds'] < cutoff]
+    if old.empty:
+        return df
+    daily = old.set_index('ds')['y'].resample('D').mean().dropna().reset_index()
+    daily['ds'] = daily['ds'] + pd.Timedelta(hours=12)
+    daily['hourly'] = False
+    recent = df[df['ds'] >= cutoff].assign(hourly=True)
+    return pd.concat([daily, recent], ignore_index=True)
+
+
+def prophet_forecast(model: Prophet, futurePeriods: int, futureFreq: str, last_ds: pd.Timestamp | None = None) -> dict:
+    """
+    Return the forecast of the next futurePeriods as a dictionary {band: {UTC date: value}} of the
+    FORECAST_BANDS, the forecast yhat and the limits of its uncertainty interval.
+    The forecast starts after the history of the model, or after last_ds if it is given.
+    """
+    if last_ds is None:
+        future = model.make_future_dataframe(periods=futurePeriods, freq=futureFreq, include_history=False)
+    else:
+        future = pd.DataFrame({'ds': pd.date_range(start=last_ds, periods=futurePeriods + 1, freq=futureFreq)[1:]})
+    # The forecast is hourly, the conditional seasonalities (daily) are applied
+    for seasonality in model.seasonalities.values():
+        if seasonality['condition_name'] is not None:
+            future[seasonality['condition_name']] = True
+    forecast = model.predict(future)
+    forecast=forecast.tail(futurePeriods)
+
+    # Convert dates to ISO format with timezone and create the output dictionary
+    forecast['ds'] = pd.to_datetime(forecast['ds']).dt.tz_localize('UTC')
+    forecast = forecast.set_index('ds')
+    return forecast[FORECAST_BANDS].to_dict()
+
+
+def forecast_response(bands: dict, intervals: bool) -> dict:
+    """Return the forecast as it is sent to the client: {date: yhat}, or all the bands if intervals is True."""
+    if not intervals:
+        return bands['yhat']
+    # The models saved by older versions only have yhat
+    return {band: bands.get(band, bands['yhat']) for band in FORECAST_BANDS}
+
+
+# The *_job functions run in the processes of the pool, their arguments and results are pickled
+
+def fit_forecast_job(df: pd.DataFrame, futurePeriods: int, futureFreq: str, init: dict | None = None,
+                     with_model: bool = False) -> tuple[str | None, dict]:
+    """Fit a model and return its forecast, and the serialized model if with_model is True."""
+    model = fit_prophet(df, init)
+    response = prophet_forecast(model, futurePeriods, futureFreq)
+    return (model_to_json(model) if with_model else None), response
+
+
+def forecast_job(model_json: str, futurePeriods: int, futureFreq: str, last_ds: pd.Timestamp | None = None) -> dict:
+    """Return the forecast of a serialized model that is already fitted."""
+    return prophet_forecast(model_from_json(model_json), futurePeriods, futureFreq, last_ds=last_ds)
+
+
+def forecast_data_job(df: pd.DataFrame, futurePeriods: int, futureFreq: str) -> dict:
+    """Fit a model and return its forecast with the dates in ISO format without timezone (endpoint /forecast)."""
+    model = fit_prophet(df)
+    future = model.make_future_dataframe(periods=futurePeriods, freq=futureFreq)
+    forecast = model.predict(future)
+    forecast = forecast[['ds', 'yhat']].tail(futurePeriods)
+
+    # Convert dates to ISO format without timezone and create the output dictionary
+    forecast['ds'] = forecast['ds'].dt.strftime('%Y-%m-%dT%H:%M:%S')
+    forecast = forecast.set_index('ds')
+    return forecast.to_dict()['yhat']
+
+
+# The processes are spawned, forking the server with its threads running could leave locks held in the children
+_fit_executor = ProcessPoolExecutor(max_workers=FIT_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+# Fits running or queued by their key. Identical concurrent requests wait for the same fit
+_fit_jobs = {}
+
+
+async def run_fit(key: tuple, job, *args):
+    """
+    Run the job in the process pool and return its result.
+    If a job with the same key is already in progress, its result is shared instead of fitting again.
+    """
+    future = _fit_jobs.get(key)
+    if future is None:
+        if len(_fit_jobs) >= MAX_QUEUED_FITS:
+            logger.error("Too many fits in progress")
+            raise HTTPException(status_code=503, detail="Too many forecasts in progress, try again later")
+        future = asyncio.get_running_loop().run_in_executor(_fit_executor, job, *args)
+        _fit_jobs[key] = future
+        future.add_done_callback(lambda _: _fit_jobs.pop(key, None))
+    else:
+        logger.debug(f"Waiting for the fit already in progress {key[0]}")
+    # A client that disconnects does not cancel the fit shared with other requests
+    return await asyncio.shield(future)
+
+
+def training_fingerprint(df: pd.DataFrame) -> str:
+    """Return a hash of the training window, it changes if any hour is added or modified."""
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest()
+
+
+def model_path(cache_key: tuple) -> str:
+    """Return the file of MODELS_DIR where the model of the cache key is saved."""
+    name = hashlib.sha1(json.dumps(list(cache_key)).encode()).hexdigest()
+    return os.path.join(MODELS_DIR, f"{name}.json")
+
+
+def save_cached_model(cache_key: tuple, cached: CachedModel):
+    """Save the fitted model and its last forecast so that they can be reloaded after a restart."""
+    data = {
+        'key': list(cache_key),
+        'fingerprint': cached.fingerprint,
+        'last_ds': cached.last_ds.isoformat(),
+        'end_hour': cached.end_hour,
+        'futurePeriods': cached.futurePeriods,
+        'futureFreq': cached.futureFreq,
+        'response': {band: {pd.Timestamp(ds).isoformat(): float(value) for ds, value in values.items()}
+                     for band, values in cached.response.items()},
+        'model': cached.model_json,
+    }
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    path = model_path(cache_key)
+    # Write a temporary file and replace the old one, a restart while writing does not corrupt it
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(data, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def delete_cached_model(cache_key: tuple):
+    """Remove the saved model of a cache key evicted from the cache."""
+    try:
+        os.remove(model_path(cache_key))
+    except FileNotFoundError:
+        pass
+
+
+def load_cached_models():
+    """Load the models saved in MODELS_DIR into the cache, the most recently saved are kept."""
+    if not os.path.isdir(MODELS_DIR):
+        return
+    paths = [os.path.join(MODELS_DIR, name) for name in os.listdir(MODELS_DIR) if name.endswith('.json')]
+    paths.sort(key=os.path.getmtime)
+    for path in paths[-MODEL_CACHE_SIZE:]:
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            cached = CachedModel(
+                model=model_from_json(data['model']),
+                model_json=data['model'],
+                last_ds=pd.Timestamp(data['last_ds']),
+                end_hour=data['end_hour'],
+                futurePeriods=data['futurePeriods'],
+                futureFreq=data['futureFreq'],
+                # The files saved by older versions only have the yhat band
+                response=data['response'] if 'yhat' in data['response'] else {'yhat': data['response']},
+                fingerprint=data['fingerprint'],
+                restored=True,
+            )
+            _model_cache[tuple(data['key'])] = cached
+            logger.info(f"Restored the Prophet model fitted until {cached.last_ds} from {path}")
+        except Exception as e:
+            logger.warning(f"Could not restore the model {path}: {e}")
+
+
+@app.on_event("startup")
+async def restore_models():
+    load_cached_models()
+
+
+@app.on_event("shutdown")
+async def stop_fit_workers():
+    _fit_executor.shutdown(wait=False, cancel_futures=True)
+    while _influx_clients:
+        _, client = _influx_clients.popitem()
+        close_influx_client(client)
+
+
+async def delta_energy_dataframe(points) -> pd.DataFrame:
+    """ Hourly energy differences of the points of a query (see energy_data.hourly_energy_deltas). """
+    try:
+        return hourly_energy_deltas(points)
     except Exception as e:
         logger.error(f"Error processing delta_energy_dataframe: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/energy_queries")
-async def query(request: EnergyQueryRequest):
+async def energy_queries(request: EnergyQueryRequest, background_tasks: BackgroundTasks):
     """ Post a query to the InfluxDB database for cumulatively accounted energy 
     and return the forecast results using Prophet."""
+    return forecast_response(await energy_forecast(request, background_tasks), request.intervals)
+
+
+async def energy_forecast(request: EnergyQueryRequest, background_tasks: BackgroundTasks) -> dict:
+    """Return all the bands of the forecast of /energy_queries (see prophet_forecast)."""
     str_query1 = request.str_query1
     str_query2 = request.str_query2
     host = request.influx_host
     port = request.influx_port
-    user = request.influx_user
-    password = request.influx_password
     dbname = request.influx_dbname
     futurePeriods = request.futurePeriods
     futureFreq = request.futureFreq
@@ -210,9 +498,64 @@ async def query(request: EnergyQueryRequest):
     if str_query2 is not None and 'GROUP BY TIME(' not in str_query2.upper():
         logger.error("The query must have GROUP BY time('time(1h)')")
         raise HTTPException(status_code=400, detail="The query must have GROUP BY time('time(1h)')")
+
+    # The model of the same queries is reused, the time bounds change in each request
+    cache_key = (strip_time_bounds(str_query1), strip_time_bounds(str_query2), host, port, dbname)
+    end_hour = query_end_hour(str_query1)
+    cached = _model_cache.get(cache_key)
+    if cached is not None:
+        _model_cache.move_to_end(cache_key)
+        if cached.end_hour == end_hour and cached.futurePeriods == futurePeriods and cached.futureFreq == futureFreq:
+            # No new complete hour since the last request
+            logger.debug(f"Returning the cached forecast for the hour {end_hour}")
+            return cached.response
+        if cached.restored:
+            # Model saved before the restart: forecast with it now and refit it with the new hours in the background
+            if cache_key not in _refitting:
+                _refitting.add(cache_key)
+                background_tasks.add_task(refit_energy_model, request, cache_key, end_hour)
+            # The data of the request goes as many hours beyond the saved model as the query bound has moved
+            last_ds = cached.last_ds + (pd.Timestamp(f"{end_hour}:00") - pd.Timestamp(f"{cached.end_hour}:00"))
+            logger.debug(f"Returning the forecast of the restored model after {last_ds}")
+            try:
+                fit_key = ('restored', cache_key, last_ds, futurePeriods, futureFreq)
+                return await run_fit(fit_key, forecast_job, cached.model_json, futurePeriods, futureFreq, last_ds)
+            except HTTPException:
+                raise
+            except Exception as e:
+                logger.error(f"Error processing Prophet model: {e}")
+                raise HTTPException(status_code=500, detail=str(e))
+
+    return await update_energy_model(request, cache_key, end_hour)
+
+
+async def refit_energy_model(request: EnergyQueryRequest, cache_key: tuple, end_hour: str):
+    """Refit a restored model in the background. If it fails, the next request tries again."""
     try:
-        # Connect to InfluxDB
-        client = InfluxDBClient(host=host, port=port, username=user, password=password, database=dbname)
+        await update_energy_model(request, cache_key, end_hour)
+        logger.info(f"Restored model refitted with the data until the hour {end_hour}")
+    except HTTPException as e:
+        logger.error(f"Background refit of the restored model failed: {e.detail}")
+    finally:
+        _refitting.discard(cache_key)
+
+
+async def update_energy_model(request: EnergyQueryRequest, cache_key: tuple, end_hour: str) -> dict:
+    """Query InfluxDB, fit the model of the cache key with the new hours and return its forecast."""
+    str_query1 = request.str_query1
+    str_query2 = request.str_query2
+    host = request.influx_host
+    port = request.influx_port
+    user = request.influx_user
+    password = request.influx_password
+    dbname = request.influx_dbname
+    futurePeriods = request.futurePeriods
+    futureFreq = request.futureFreq
+    cached = _model_cache.get(cache_key)
+
+    try:
+        # Connect to InfluxDB (the client of the same connection parameters is reused)
+        client = get_influx_client(host, port, user, password, dbname)
         logger.debug("Connected to InfluxDB step 1")
 
     except Exception as e:
@@ -220,11 +563,17 @@ async def query(request: EnergyQueryRequest):
         raise HTTPException(status_code=400, detail=f"Error connecting to InfluxDB step 1: {str(e)}")
     
     try:
-        # Execute the query
-        result = client.query(str_query1)
-        logger.debug("Query_1 executed successfully")
+        # Execute the queries. InfluxQL accepts several statements separated by ';',
+        # so both queries are sent to InfluxDB in a single request
+        # The request runs in a thread, the event loop keeps serving other requests
+        if str_query2 is not None:
+            result1, result2 = await asyncio.to_thread(client.query, f"{str_query1};{str_query2}")
+            logger.debug("Query_1 and Query_2 executed successfully")
+        else:
+            result1 = await asyncio.to_thread(client.query, str_query1)
+            logger.debug("Query_1 executed successfully")
         # Convert the result to a DataFrame
-        points = list(result.get_points()) # Get dates in UTC
+        points = list(result1.get_points()) # Get dates in UTC
     except Exception as e:
         logger.error("Failed to connect to InfluxDB")
         raise HTTPException(status_code=400, detail=f"Error executing query1: {str(e)}")
@@ -241,11 +590,8 @@ async def query(request: EnergyQueryRequest):
         raise HTTPException(status_code=400, detail="Error processing query1")    
     # Optional second query
     if str_query2 is not None:
-        result = client.query(str_query2)
-        logger.debug("Query_2 executed successfully")
-
         # Convert the result to a DataFrame
-        points = list(result.get_points())
+        points = list(result2.get_points())
         if not points:
             # raise HTTPException(status_code=400, detail="No data returned from query2")
             logger.warning("Query_2 has not points")
@@ -288,23 +634,141 @@ async def query(request: EnergyQueryRequest):
         # Delocalize the dates
         # df['ds'] = pd.to_datetime(df['ds']).dt.tz_localize(None) # Se ha hecho en delta_energy_dataframe
 
-        # Configure and train the Prophet model
-        model = Prophet()
-        model.fit(df)
-        future = model.make_future_dataframe(periods=futurePeriods, freq=futureFreq)
-        forecast = model.predict(future)
-        forecast=forecast.tail(futurePeriods)
-
-        # Convert dates to ISO format with timezone and create the output dictionary
-        forecast['ds'] = pd.to_datetime(forecast['ds']).dt.tz_localize('UTC')
-        forecast = forecast.set_index('ds')
-        response = forecast.to_dict()['yhat'] 
-
-        return response
+        # The old history is aggregated by days, the fit time is bounded for installations with years of data
+        df = downsample_history(df, request.hourlyDays)
+
+        last_ds = df['ds'].max()
+        fingerprint = training_fingerprint(df)
+        if cached is not None and cached.fingerprint == fingerprint:
+            # The training window has not changed, the fitted model is still valid
+            model, model_json = cached.model, cached.model_json
+            if cached.futurePeriods == futurePeriods and cached.futureFreq == futureFreq:
+                logger.debug(f"No new data since {last_ds}, returning the cached forecast")
+                response = cached.response
+            else:
+                fit_key = ('predict', fingerprint, futurePeriods, futureFreq)
+                response = await run_fit(fit_key, forecast_job, model_json, futurePeriods, futureFreq)
+        else:
+            # Configure and train the Prophet model in the process pool (warm start from the cached model)
+            init = stan_init(cached.model) if cached is not None else None
+            fit_key = ('energy', fingerprint, futurePeriods, futureFreq)
+            model_json, response = await run_fit(fit_key, fit_forecast_job, df, futurePeriods, futureFreq, init, True)
+            # Deserializing the model takes some time, the event loop keeps answering the polls of the jobs
+            model = await asyncio.to_thread(model_from_json, model_json)
+
+        cached = CachedModel(model, model_json, last_ds, end_hour, futurePeriods, futureFreq, response, fingerprint)
+        _model_cache[cache_key] = cached
+        _model_cache.move_to_end(cache_key)
+        while len(_model_cache) > MODEL_CACHE_SIZE:
+            evicted_key, _ = _model_cache.popitem(last=False)
+            delete_cached_model(evicted_key)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing Prophet model: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+    try:
+        await asyncio.to_thread(save_cached_model, cache_key, cached)
+    except Exception as e:
+        # The forecast is still valid, the model is only fitted from scratch after the next restart
+        logger.warning(f"Could not save the model to {MODELS_DIR}: {e}")
+
+    return response
+
+
+@dataclass
+class EnergyJob:
+    """Forecast of /energy_queries computed in the background for the job interface."""
+    job_id: str
+    key: tuple  # Parameters of the request, the same request pending is not submitted twice
+    done: asyncio.Event
+    status: str = "pending"  # pending, done or error
+    result: dict | None = None
+    detail: str | None = None
+    finished: float | None = None  # time.monotonic() when the job finished
+    task: asyncio.Task | None = None
+
+
+# Jobs by id (oldest first)
+_energy_jobs: OrderedDict = OrderedDict()
+
+
+def prune_energy_jobs():
+    """Remove the finished jobs older than JOB_RESULT_TTL."""
+    now = time.monotonic()
+    for job_id in [job_id for job_id, job in _energy_jobs.items()
+                   if job.finished is not None and now - job.finished > JOB_RESULT_TTL]:
+        del _energy_jobs[job_id]
+
+
+async def run_energy_job(job: EnergyJob, request: EnergyQueryRequest):
+    """Compute the forecast of the job as the /energy_queries endpoint does."""
+    background_tasks = BackgroundTasks()
+    try:
+        job.result = await energy_queries(request, background_tasks)
+        job.status = "done"
+    except HTTPException as e:
+        job.status, job.detail = "error", str(e.detail)
+    except Exception as e:
+        logger.error(f"Error in the energy job {job.job_id}: {e}")
+        job.status, job.detail = "error", str(e)
+    finally:
+        job.finished = time.monotonic()
+        job.done.set()
+    # Refit of a restored model, after the result is available
+    await background_tasks()
+
+
+def energy_job_state(job: EnergyJob) -> dict:
+    """Return the state of the job as it is sent to the client."""
+    state = {"job_id": job.job_id, "status": job.status}
+    if job.status == "done":
+        state["result"] = job.result
+    elif job.status == "error":
+        state["detail"] = job.detail
+    return state
+
+
+@app.post("/energy_queries/jobs")
+async def submit_energy_job(request: EnergyQueryRequest):
+    """
+    Submit the same request as /energy_queries and return a job id at once.
+    The forecast is read later with GET /energy_queries/jobs/{job_id}, so the client does not keep
+    a request open during the fit.
+    """
+    prune_energy_jobs()
+    key = (request.str_query1, request.str_query2, request.influx_host, request.influx_port,
+           request.influx_user, request.influx_dbname, request.futurePeriods, request.futureFreq, request.hourlyDays,
+           request.intervals)
+    for job in _energy_jobs.values():
+        if job.key == key and job.status == "pending":
+            logger.debug(f"The same request is already pending in the job {job.job_id}")
+            return energy_job_state(job)
+
+    job = EnergyJob(job_id=uuid.uuid4().hex, key=key, done=asyncio.Event())
+    _energy_jobs[job.job_id] = job
+    job.task = asyncio.create_task(run_energy_job(job, request))
+    logger.debug(f"Energy job {job.job_id} submitted")
+    return energy_job_state(job)
+
+
+@app.get("/energy_queries/jobs/{job_id}")
+async def get_energy_job(job_id: str, wait: float = 0):
+    """
+    Return the state of a job, and its forecast when it is done.
+    If wait > 0 and the job is pending, the answer waits up to wait seconds (at most MAX_JOB_WAIT) for the result.
+    """
+    job = _energy_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    if job.status == "pending" and wait > 0:
+        try:
+            await asyncio.wait_for(job.done.wait(), timeout=min(wait, MAX_JOB_WAIT))
+        except asyncio.TimeoutError:
+            pass
+    return energy_job_state(job)
+
 
 if __name__ == '__main__':
     import uvicorn
@@ -1,12 +1,26 @@
 import logging
+import hashlib
 import pytz
 import asyncio
 from datetime import datetime, timedelta
 import aiohttp
+import numpy as np
 import pandas as pd
 import pulp
+from .history_cache import InfluxHistoryCache
+from .hourly_series import HourlySeries, epoch_hour
+from .demand_forecast import FourierRidgeForecaster
+from .optimizer import SocScheduleModel, battery_energy_price, final_soc_weight, solve_soc_schedule_dp, make_soc_model, \
+    hourly_to_periods, ScheduleSolution, SOC_MODELS_MAX, FORECAST_ERROR_CORRELATION, STOCHASTIC_SCENARIOS, SOLAR_FORECAST_INTERVAL, DEMAND_FORECAST_INTERVAL, \
+    ScenarioScheduleModel, forecast_scenarios
+from .utils import hourly_factors_array, apply_hourly_factors
+from .influx_stream import InfluxChunkParser, INFLUX_CHUNK_SIZE
 from .const import INFLUX_UPDATE_INTERVAL, SOC_PERCENT_DEVIATION_FORCE_RECALC, \
-    TARGET_SOC_UPDATE_INTERVAL, HISTORY_SOLAR_MAX_DAYS
+    TARGET_SOC_UPDATE_INTERVAL, HISTORY_SOLAR_MAX_DAYS, PROPHET_JOB_POLL_WAIT, PROPHET_DELTA_QUERIES, \
+    DEMAND_FORECAST_PERIODS, MPC_HORIZON_HOURS, OPTIMIZER_CACHE_SIZE, OPTIMIZER_CACHE_ENERGY_QUANTUM_WH, \
+    OPTIMIZER_CACHE_PRICE_QUANTUM, OPTIMIZER_ENGINE_PULP, OPTIMIZER_ENGINE_DP, OPTIMIZER_ENGINE_VALIDATE, \
+    OPTIMIZER_ENGINE_STOCHASTIC, BATTERY_EOL_CYCLES_IF_MIN_SOC_20, BATTERY_EOL_CYCLES_IF_MIN_SOC_50, DEMAND_ENGINE_PROPHET, \
+    DEMAND_ENGINE_RIDGE
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -28,9 +42,18 @@ class PVContollerAPI:
                  charge_efficiency: float | None = None,
                  discharge_efficiency: float | None = None,
                  battery_purchase_price: float | None = 0,
+                 battery_eol_cycles_if_min_soc_20: float | None = BATTERY_EOL_CYCLES_IF_MIN_SOC_20,
+                 battery_eol_cycles_if_min_soc_50: float | None = BATTERY_EOL_CYCLES_IF_MIN_SOC_50,
+                 final_soc_weight_factor: float | None = 1.0,
                  str_local_timezone: str | None = None,
                  enable_fore_to_real_correction: bool | None = False,
-                 sell_allowed: bool | None = False
+                 sell_allowed: bool | None = False,
+                 history_store = None,
+                 optimizer_engine: str | None = OPTIMIZER_ENGINE_PULP,
+                 demand_history_days: int | None = 0,
+                 demand_hourly_days: int | None = 0,
+                 demand_engine: str | None = DEMAND_ENGINE_PROPHET,
+                 period_minutes: int | None = 60
                 ) -> None:
         
         """Initialize the API."""
@@ -64,6 +87,8 @@ class PVContollerAPI:
         self._hystory_forecast_solar_sensor = hystory_forecast_solar_sensor
         self._inverter_to_acout_sensor = inverter_to_acout_sensor
 
+        # Hourly history already read from InfluxDB. Only the new hours are requested in each update
+        self.history_cache = InfluxHistoryCache(history_store)
         
         # Photovoltaic installation values
         self._battery_capacity_Wh = battery_capacity_Wh
@@ -73,20 +98,25 @@ class PVContollerAPI:
         self._charge_efficiency = charge_efficiency
         self._discharge_efficiency = discharge_efficiency
         self.battery_purchase_price = battery_purchase_price
+        # Battery lifetime used to price the energy of the battery
+        self.battery_eol_cycles_if_min_soc_20 = battery_eol_cycles_if_min_soc_20 or BATTERY_EOL_CYCLES_IF_MIN_SOC_20
+        self.battery_eol_cycles_if_min_soc_50 = battery_eol_cycles_if_min_soc_50 or BATTERY_EOL_CYCLES_IF_MIN_SOC_50
+        # Factor applied to the weight w of the final SoC in the objective function
+        self.final_soc_weight_factor = 1.0 if final_soc_weight_factor is None else final_soc_weight_factor
 
         # Define internal class values that are calculated        
         self._data_source = "TFG EMG"
 
         # Electricity prices
-        self._dict_pvpc_buy_prices = None
-        self._dict_pvpc_sell_prices = None
+        self._pvpc_buy_prices = None
+        self._pvpc_sell_prices = None
         self.sell_allowed = sell_allowed
 
         # Solar production forecasts
-        self._dict_forecast_solar = None
-        self._dict_forecast_solar_last_update = None
-        self.dict_effective_forecast_solar = None
-        self._dict_effective_forecast_solar_last_update = None
+        self._forecast_solar = None
+        self._forecast_solar_last_update = None
+        self.effective_forecast_solar = None
+        self._effective_forecast_solar_last_update = None
 
         # Historical data of total consumption and solar production obtained from InfluxDB
         self.influx_last_update = None
@@ -103,10 +133,24 @@ class PVContollerAPI:
         self.last_history_solar_production_update = None  
 
         # Consumption and solar production forecasts from Prophet
+        # Training window: days of history (0 = all) and recent days kept hourly (older ones are aggregated by days)
+        self.demand_history_days = demand_history_days or 0
+        self.demand_hourly_days = demand_hourly_days or 0
+        # Engine of the demand forecast (prophet: Prophet InfluxDB Addon, ridge: built-in NumPy forecaster)
+        self.demand_engine = demand_engine or DEMAND_ENGINE_PROPHET
         self._prophet_last_update = None
-        self.dict_demand_prophet_predictions = None
+        self.demand_prophet_predictions = None
+        # Limits of the uncertainty interval of the predictions (None if the engine does not provide them)
+        self.demand_prophet_lower = None
+        self.demand_prophet_upper = None
         self.demand_prophet_current_hour_prediction = None
         self.demand_prophet_next_hour_prediction = None
+        # Id of the forecast job pending in the Addon (None if there is no job in progress)
+        self._prophet_job_id = None
+        # False if the Addon does not have the job interface (older versions), /energy_queries is used instead
+        self._prophet_jobs_supported = True
+        # True once the Addon has accepted a job: the versions with the job interface accept delta queries
+        self._prophet_delta_supported = False
 
         # SoC data
         self._current_initial_soc_Wh = None
@@ -116,16 +160,29 @@ class PVContollerAPI:
         # Optimization results        
         self._target_socs_last_update = None
         self._last_calc_initial_soc_Wh = None
-        self.dict_target_socs = None
+        self.target_socs = None
         self.target_soc_current_hour = None
         self.pulp_json_results = None # for sensor.ess_controller_pulp_results
+        self.pulp_results_datetime = None # time of the calculation of pulp_json_results (start of its first period)
         self.pulp_parameters = None # for sensor.ess_controller_pulp_parameters
+        # Engine used to calculate the SoC schedule (pulp, dp or validate)
+        self.optimizer_engine = optimizer_engine or OPTIMIZER_ENGINE_PULP
+        # LP models of the SoC schedule by structure (number of hours and installation parameters)
+        self._soc_models = {}
+        # Length of the periods of the calculation (minutes). With periods shorter than one hour the
+        # calculation is a rolling horizon (MPC): it is repeated in every update from the measured SoC
+        self.period_minutes = int(period_minutes or 60)
+        self.periods_per_hour = 60 // self.period_minutes
+        # Results of the last calculations by the hash of their inputs (least recently used first)
+        self._optimizer_cache = {}
 
         # Lists for the SoC calculation algorithm
         self._list_buy_prices = None
         self._list_sell_prices = None
         self._list_solar_production = None
         self._list_demand = None
+        self._list_demand_lower = None
+        self._list_demand_upper = None
 
 
     async def async_close(self):
@@ -138,22 +195,22 @@ class PVContollerAPI:
             str_timezone = "Europe/Madrid"
         self.class_local_timezone = await asyncio.to_thread(pytz.timezone, str_timezone)        
     
-    # Create set methods to update dict_pvpc_buy_prices, dict_pvpc_sell_prices, and dict_forecast_solar
-    async def set_dict_pvpc_buy_prices(self, dict_pvpc_buy_prices: dict[str, float]) -> None:
-        """Set dict_pvpc_buy_prices."""
-        if dict_pvpc_buy_prices != self._dict_pvpc_buy_prices:
-            self._dict_pvpc_buy_prices = dict_pvpc_buy_prices
-
-    async def set_dict_pvpc_sell_prices(self, dict_pvpc_sell_prices: dict[str, float]) -> None:
-        """Set dict_pvpc_sell_prices."""
-        if dict_pvpc_sell_prices != self._dict_pvpc_sell_prices:
-            self._dict_pvpc_sell_prices = dict_pvpc_sell_prices
-
-    async def set_dict_forecast_solar(self, dict_forecast_solar: dict[str, float]) -> None:
-        """Set dict_forecast_solar."""
-        if dict_forecast_solar != self._dict_forecast_solar:
-            self._dict_forecast_solar = dict_forecast_solar
-            self._dict_forecast_solar_last_update = datetime.now()
+    # Create set methods to update pvpc_buy_prices, pvpc_sell_prices, and forecast_solar
+    async def set_pvpc_buy_prices(self, pvpc_buy_prices: HourlySeries) -> None:
+        """Set pvpc_buy_prices."""
+        if pvpc_buy_prices != self._pvpc_buy_prices:
+            self._pvpc_buy_prices = pvpc_buy_prices
+
+    async def set_pvpc_sell_prices(self, pvpc_sell_prices: HourlySeries) -> None:
+        """Set pvpc_sell_prices."""
+        if pvpc_sell_prices != self._pvpc_sell_prices:
+            self._pvpc_sell_prices = pvpc_sell_prices
+
+    async def set_forecast_solar(self, forecast_solar: HourlySeries) -> None:
+        """Set forecast_solar."""
+        if forecast_solar != self._forecast_solar:
+            self._forecast_solar = forecast_solar
+            self._forecast_solar_last_update = datetime.now()
 
     # Create set method for self._current_initial_soc_Wh
     async def set_current_initial_soc(self, soc_percent: float) -> None:
@@ -181,79 +238,165 @@ class PVContollerAPI:
             if self.class_local_timezone is None:
                 date_tz = 'Europe/Madrid'        
                 # date = date.tz_localize(date_tz)
-                date = await asyncio.to_thread(date.tz_localize, date_tz)
+                date = await asyncio.to_thread(date.tz_localize, date_tz, ambiguous=True, nonexistent='shift_forward')
             else:
                 # date = date.tz_localize(self.class_local_timezone)
-                date = await asyncio.to_thread(date.tz_localize, self.class_local_timezone)
+                # The hour skipped when the clocks go forward does not exist and the repeated one is ambiguous
+                date = await asyncio.to_thread(date.tz_localize, self.class_local_timezone, ambiguous=True, nonexistent='shift_forward')
         # Localize the date and time to the UTC timezone
         date = await asyncio.to_thread(date.tz_convert, 'UTC')
         # Format the date in ISO 8601 format
         date = date.strftime('%Y-%m-%dT%H:%M:%SZ')
         return date
 
-    async def energy_query_string(self, entity_id, start: str | None = None, end: str | None = None) -> str:
-        """Create the SQL query string for energy data."""
+    async def energy_query_string(self, entity_id, start: str | None = None, end: str | None = None, delta: bool = False) -> str:
+        """
+        Create the SQL query string for energy data.
+        By default the query returns the cumulative counter of each hour (column energy_kWh).
+        With delta=True InfluxDB returns the hourly differences of the counter (column delta_energy):
+        NON_NEGATIVE_DIFFERENCE omits the hours with a counter reset and the first hour of the query.
+        """
         if start is not None:
             start = await self.format_date_for_influxdb(start)
         if end is not None:
             end = await self.format_date_for_influxdb(end)
+        if delta:
+            select = 'SELECT non_negative_difference(last("value")) AS "delta_energy" FROM "kWh"'
+        else:
+            select = 'SELECT last("value") AS "energy_kWh" FROM "kWh"'
         # If start and end are not specified, return all data
         if start is None and end is None:
-            query = """SELECT last("value") AS "energy_kWh" FROM "kWh" WHERE "entity_id"='{}' GROUP BY time(1h) fill(previous)""".format(entity_id)
+            query = """{} WHERE "entity_id"='{}' GROUP BY time(1h) fill(previous)""".format(select, entity_id)
         elif start is None:
-            query = """SELECT last("value") AS "energy_kWh" FROM "kWh" WHERE (time <= '{}') AND "entity_id"='{}' GROUP BY time(1h) fill(previous)""".format(end, entity_id) 
+            query = """{} WHERE (time <= '{}') AND "entity_id"='{}' GROUP BY time(1h) fill(previous)""".format(select, end, entity_id) 
         elif end is None:
-            query = """SELECT last("value") AS "energy_kWh" FROM "kWh" WHERE (time >= '{}') AND "entity_id"='{}' GROUP BY time(1h) fill(previous)""".format(start, entity_id)   
+            query = """{} WHERE (time >= '{}') AND "entity_id"='{}' GROUP BY time(1h) fill(previous)""".format(select, start, entity_id)   
         else:
-            query = """SELECT last("value") AS "energy_kWh" FROM "kWh" WHERE (time >= '{}') AND (time <= '{}') AND "entity_id"='{}' GROUP BY time(1h) fill(previous)""".format(start, end, entity_id)
+            query = """{} WHERE (time >= '{}') AND (time <= '{}') AND "entity_id"='{}' GROUP BY time(1h) fill(previous)""".format(select, start, end, entity_id)
         return query                         
 
     async def df_from_influxdb(self, query: str) -> pd.DataFrame:
         """
         Function to read data from InfluxDB using the InfluxDB API with aiohttp.
         """
+        df = (await self.dfs_from_influxdb([query]))[0]
+        #_LOGGER.debug(f"Conversion to DataFrame completed, query: {query}")
+        return df
+
+    async def dfs_from_influxdb(self, queries: list[str], utc: bool = False) -> list[pd.DataFrame]:
+        """
+        Read the results of several queries from InfluxDB in a single HTTP request.
+        InfluxQL accepts several statements separated by ';', results[i] is the result of the statement i.
+        Return a DataFrame for each query (empty if the query failed or returned no data).
+        The index is the naive local time, or the naive UTC time with utc=True.
+        """
         try:
-            #_LOGGER.debug("Starting df_from_influxdb")
+            #_LOGGER.debug("Starting dfs_from_influxdb")
+            # Ask for chunked responses with epoch times to parse the values incrementally
             params = {
                 'db': self._influx_db_database,
-                'q': query
+                'q': ';'.join(queries),
+                'epoch': 's',
+                'chunked': 'true',
+                'chunk_size': INFLUX_CHUNK_SIZE
             }
             auth = (self._influx_db_user, self._influx_db_pass)
+            parser = InfluxChunkParser()
             async with self._session.get(self._influx_db_url, params=params, auth=aiohttp.BasicAuth(auth[0], auth[1])) as response:
                 if response.status != 200:
                     response.raise_for_status()
-                data = await response.json()
-            if 'results' not in data or not data['results'] or 'series' not in data['results'][0] or not data['results'][0]['series']:
-                raise ValueError("No data returned from InfluxDB")                    
-            
+                # Decode the response while it is being received, one chunk at a time
+                async for data in response.content.iter_chunked(65536):
+                    parser.feed(data)
+            results = parser.close()
+        except Exception as e:
+            _LOGGER.debug(f"Error fetching data from InfluxDB: {e}. Query={';'.join(queries)}")
+            return [pd.DataFrame() for _ in queries] # return empty DataFrames
+
+        dfs = []
+        for statement_id, query in enumerate(queries):
+            if statement_id in parser.errors:
+                _LOGGER.debug(f"Error fetching data from InfluxDB: {parser.errors[statement_id]}. Query={query}")
+                dfs.append(pd.DataFrame())
+                continue
+            if statement_id not in results or len(results[statement_id][1]) == 0:
+                _LOGGER.debug(f"No data returned from InfluxDB. Query={query}")
+                dfs.append(pd.DataFrame())
+                continue
+
             #_LOGGER.debug("Data available. Starting conversion to DataFrame")
-            data = data['results'][0]['series'][0]
-            columns = data['columns']
-            values = data['values']
+            columns, times, values = results[statement_id]
             
-            df = pd.DataFrame(values, columns=columns)
-            # Convert the time column to the DataFrame index
-            df['time'] = pd.to_datetime(df['time'])
-            df.set_index('time', inplace=True)
+            df = pd.DataFrame(values, columns=columns[1:])
+            # Convert the epoch times to the DataFrame index
+            df.index = pd.to_datetime(times, unit='s', utc=True)
+            df.index.name = 'time'
+            if utc:
+                df.index = df.index.tz_localize(None)
+                dfs.append(df)
+                continue
             # InfluxDB returns dates in UTC, convert them to the local timezone and delocalize them
             # Perform the timezone conversion in a separate thread
             df.index = await asyncio.to_thread(df.index.tz_convert, self.class_local_timezone)
             # Delocalize the dates in a separate thread
             df.index = await asyncio.to_thread(df.index.tz_localize, None)
-                     
-            #_LOGGER.debug(f"Conversion to DataFrame completed, query: {query}")
-            return df
-        except Exception as e:
-            _LOGGER.debug(f"Error fetching data from InfluxDB: {e}. Query={query}")
-            return pd.DataFrame() # return an empty DataFrame
+            dfs.append(df)
+        return dfs
+
+    async def refresh_history_cache(self, entity_starts: dict) -> None:
+        """
+        Bring the history cache of several entities up to date with a single InfluxDB request.
+        entity_starts is a dictionary entity_id -> first datetime needed (None for all the history).
+        Only the complete hours after the last cached hour of each entity are requested.
+        """
+        async with self.history_cache.lock:
+            await self.history_cache.async_load()
+            # The cache is indexed by UTC hours, the local hours are not continuous at the DST changes
+            current_hour = datetime.now(pytz.utc).replace(minute=0, second=0, microsecond=0, tzinfo=None)
+
+            full_queries = {}  # entity_id -> (start, query)
+            incremental_queries = {}  # entity_id -> query
+            for entity_id, start in entity_starts.items():
+                if not self.history_cache.is_covered(entity_id, start):
+                    # Cold start: the history from start is not cached, make a full query (paid only once)
+                    _LOGGER.debug(f"History cache of {entity_id} is empty or incomplete, querying from {start}")
+                    full_queries[entity_id] = (start, await self.energy_query_string(entity_id, start=start))
+                else:
+                    last_cached = self.history_cache.last_timestamp(entity_id)
+                    if last_cached is None:
+                        incremental_queries[entity_id] = await self.energy_query_string(entity_id, start=start)
+                    elif last_cached + timedelta(hours=1) < current_hour:
+                        # Ask InfluxDB only for the hours after the last cached one (time > last_cached)
+                        query_start = pytz.utc.localize(last_cached + timedelta(hours=1))
+                        incremental_queries[entity_id] = await self.energy_query_string(entity_id, start=query_start)
+
+            entity_ids = list(full_queries.keys()) + list(incremental_queries.keys())
+            if not entity_ids:
+                return
+            queries = [full_queries[e][1] for e in full_queries] + [incremental_queries[e] for e in incremental_queries]
+            dfs = await self.dfs_from_influxdb(queries, utc=True)
+
+            for entity_id, df in zip(entity_ids, dfs):
+                if entity_id in full_queries:
+                    if df is None or df.empty:
+                        continue
+                    await self.history_cache.async_replace(entity_id, df, start=full_queries[entity_id][0], current_hour=current_hour)
+                else:
+                    new_rows = await self.history_cache.async_append(entity_id, df, current_hour=current_hour)
+                    _LOGGER.debug(f"History cache of {entity_id} updated with {new_rows} new hours")
+
+    async def cached_energy_dataframe(self, entity_id, start=None, end=None) -> pd.DataFrame:
+        """
+        Return the hourly energy data of an entity between start and end using the history cache.
+        Only the complete hours after the last cached hour are requested to InfluxDB.
+        """
+        await self.refresh_history_cache({entity_id: start})
+        return self.history_cache.get(entity_id, start, end, self.class_local_timezone or 'Europe/Madrid')
 
     async def hourly_delta_energy_dataframe(self, entity_id, start=None, end=None) -> pd.DataFrame:
         """Create a DataFrame with hourly energy deltas."""
-        # Create the SQL query to get the energy data. NaN values are filled with the last known value
-        query = await self.energy_query_string(entity_id, start, end)
-
-        # Create a DataFrame with the energy data obtained from InfluxDB
-        df = await self.df_from_influxdb(query)
+        # Get the hourly energy data from the history cache. NaN values are filled with the last known value
+        df = await self.cached_energy_dataframe(entity_id, start, end)
 
         # If no data was obtained, return an empty DataFrame
         # Even if the connection is successful and the query is correct, if there is no data in the specified range
@@ -289,11 +432,8 @@ class PVContollerAPI:
 
     async def hourly_energy_dataframe(self, entity_id, start=None, end=None) -> pd.DataFrame:
         """Create a DataFrame with hourly energy data."""
-        # Create the SQL query to get the energy data. NaN values are filled with the last known value
-        query = await self.energy_query_string(entity_id, start, end)
-
-        # Create a DataFrame with the energy data obtained from InfluxDB
-        df = await self.df_from_influxdb(query)
+        # Get the hourly energy data from the history cache. NaN values are filled with the last known value
+        df = await self.cached_energy_dataframe(entity_id, start, end)
 
         # If no data was obtained, return an empty DataFrame
         if df is None or df.empty:
@@ -384,6 +524,12 @@ class PVContollerAPI:
             or (current_datetime.date() - self.last_history_solar_production_update.date() > timedelta(days=1)): 
             previous_day = current_datetime - timedelta(days=1)
             solar_start = previous_day - timedelta(days=HISTORY_SOLAR_MAX_DAYS)
+
+            # Refresh the history of both sensors in a single request to InfluxDB
+            await self.refresh_history_cache({
+                self._solar_production_sensor.split('.')[1]: solar_start,
+                self._hystory_forecast_solar_sensor.split('.')[1]: solar_start
+            })
             
             # Update historical solar production data
             self.df_history_solar_production = await self.get_history_solar_production_df(start=solar_start, end=previous_day)
@@ -469,16 +615,82 @@ class PVContollerAPI:
         async with self._session as session:
             async with session.post(f"{base_url}/energy_queries", json=energy_query_data) as response:
                 return await response.json()
-        
+
+    async def submit_energy_job(self, base_url, energy_query_data) -> str | None:
+        """
+        Submit the energy queries as a job of the Addon and return the job id.
+        Return None if the Addon does not have the job interface.
+        """
+        async with self._session.post(f"{base_url}/energy_queries/jobs", json=energy_query_data) as response:
+            if response.status in (404, 405):
+                return None
+            response.raise_for_status()
+            job = await response.json()
+        return job["job_id"]
+
+    async def poll_energy_job(self, base_url, job_id, wait=PROPHET_JOB_POLL_WAIT) -> dict | None:
+        """
+        Return the state of a job of the Addon: {"status": "pending" | "done" | "error", "result": ..., "detail": ...}.
+        The Addon waits up to wait seconds for the result before answering. Return None if the job does not exist
+        (e.g. the Addon has been restarted).
+        """
+        async with self._session.get(f"{base_url}/energy_queries/jobs/{job_id}", params={"wait": wait}) as response:
+            if response.status == 404:
+                return None
+            response.raise_for_status()
+            return await response.json()
+
+    async def fetch_energy_forecast(self, base_url, energy_query_data) -> dict | None:
+        """
+        Get the forecast of the energy queries without holding a request open during the fit.
+        The query is submitted as a job of the Addon and polled; if the forecast is not ready after
+        PROPHET_JOB_POLL_WAIT seconds None is returned and the same job is polled in the next update.
+        """
+        if not self._prophet_jobs_supported:
+            return await self.post_energy_query(base_url, energy_query_data)
+        try:
+            if self._prophet_job_id is None:
+                self._prophet_job_id = await self.submit_energy_job(base_url, energy_query_data)
+                if self._prophet_job_id is None:
+                    _LOGGER.warning("The Addon has no job interface, using the /energy_queries endpoint")
+                    self._prophet_jobs_supported = False
+                    return await self.post_energy_query(base_url, energy_query_data)
+                _LOGGER.debug(f"Prophet job {self._prophet_job_id} submitted")
+                self._prophet_delta_supported = True
+
+            job = await self.poll_energy_job(base_url, self._prophet_job_id)
+            if job is None:
+                _LOGGER.warning(f"Prophet job {self._prophet_job_id} not found in the Addon, it will be submitted again")
+                self._prophet_job_id = None
+                return None
+            if job["status"] == "pending":
+                _LOGGER.debug(f"Prophet job {self._prophet_job_id} still in progress")
+                return None
+            self._prophet_job_id = None
+            if job["status"] == "error":
+                _LOGGER.error(f"Prophet job failed in the Addon: {job.get('detail')}")
+                return None
+            return job["result"] or None
+
+        except Exception as e:
+            _LOGGER.error(f"Error in the Prophet job of the energy queries: {e}")
+            self._prophet_job_id = None
+            return None
+
     async def make_predictions(self, current_datetime: datetime, force_update: bool = False) -> bool:
         """Make energy consumption predictions using Prophet."""
         # If the InfluxDB update date is more recent than the Prophet update date, recalculate predictions
-        if self._prophet_last_update is not None \
+        # (a job already submitted to the Addon is polled until it finishes)
+        if self._prophet_job_id is None \
+            and self._prophet_last_update is not None \
             and self.influx_last_update is not None \
             and self._prophet_last_update > self.influx_last_update \
             and not force_update:
             _LOGGER.debug("Prophet data is still valid") 
             return True
+
+        if self.demand_engine == DEMAND_ENGINE_RIDGE:
+            return await self.make_predictions_ridge(current_datetime)
         
 
         _LOGGER.debug("Prophet data needs to be updated")
@@ -491,47 +703,57 @@ class PVContollerAPI:
             current_date = current_datetime.replace(minute=0, second=0, microsecond=0)
 
             # Get the name for the query from self._acin_to_acout_sensor
+            # Rolling training window, the fit time does not grow with the age of the installation
+            start = current_date - timedelta(days=self.demand_history_days) if self.demand_history_days > 0 else None
+
+            # The Addon downloads the whole window, InfluxDB computes the hourly differences to transfer less data.
+            # Older Addon versions difference the results again, the deltas are only sent once a job was accepted
+            delta = PROPHET_DELTA_QUERIES and self._prophet_delta_supported
             entity_id = self._acin_to_acout_sensor.split('.')[1]
-            str_query1 = await self.energy_query_string(entity_id, start=None, end=current_date)
+            str_query1 = await self.energy_query_string(entity_id, start=start, end=current_date, delta=delta)
             
             # Get the name for the query from self._inverter_to_acout_sensor
             entity_id = self._inverter_to_acout_sensor.split('.')[1]
-            str_query2 = await self.energy_query_string(entity_id, start=None, end=current_date) 
+            str_query2 = await self.energy_query_string(entity_id, start=start, end=current_date, delta=delta) 
 
             energy_query_data = {
                 "str_query1": str_query1,
                 "str_query2": str_query2,
-                "futurePeriods": 30,
-                "futureFreq": "h"
+                "futurePeriods": DEMAND_FORECAST_PERIODS,
+                "futureFreq": "h",
+                # The Addon aggregates by days the history older than hourlyDays (ignored by older Addon versions)
+                "hourlyDays": self.demand_hourly_days,
+                # The Addon returns also the uncertainty interval of the forecast (ignored by older Addon versions)
+                "intervals": True
             }
             # base_url = "http://192.168.0.100:5000" # Raspeberry Pi (HA OS) runs the container with the API
             # base_url = "http://localhost:5000" # Raspeberry Pi (HA OS) runs the container with the API
             base_url = self._prophet_influxdb_addon_url
             _LOGGER.info(f"base url for addon: {base_url}")            
 
-            response = await self.post_energy_query(base_url, energy_query_data)
+            response = await self.fetch_energy_forecast(base_url, energy_query_data)
             if response is None:
+                if self._prophet_job_id is not None:
+                    # The fit is still running in the Addon, the previous predictions are kept meanwhile
+                    return False
                 raise ValueError("No data returned from Addon API") 
                 
             _LOGGER.debug("Energy Queries response:", response)
-            cc_response = {str(k): v for k, v in response.items()}
-            # Convert the dates to the local timezone
-            # Convert predictions to integers and Wh
-            cc_response = {pd.to_datetime(k).tz_convert(self.class_local_timezone)\
-                            .strftime('%Y-%m-%dT%H:%M:%S'): int(v * 1000) \
-                            for k, v in cc_response.items()}
-            _LOGGER.debug(f"\nEnergy Queries response local timezone: {cc_response}")
-
-            # Store values locally
-            self.dict_demand_prophet_predictions = cc_response        
-
-            # Store the prediction for this hour and the next hour
-            # Note: the current hour is index 0. The next hour is index 1
-            self.demand_prophet_current_hour_prediction = cc_response[list(cc_response.keys())[0]]
-            self.demand_prophet_next_hour_prediction = cc_response[list(cc_response.keys())[1]]          
-
-            # Update the last Prophet update date
-            self._prophet_last_update = datetime.now()
+            # {date: yhat} or, with the uncertainty interval, {"yhat": {date: yhat}, "yhat_lower": ..., "yhat_upper": ...}
+            bands = response if "yhat" in response else {"yhat": response}
+            series = {}
+            for band, values in bands.items():
+                # Convert the dates to the local timezone (all the dates are parsed at once)
+                index = pd.to_datetime([str(k) for k in values.keys()], utc=True) \
+                            .tz_convert(self.class_local_timezone).tz_localize(None)
+                # Convert predictions to integers and Wh
+                values = np.trunc(np.fromiter(values.values(), dtype=np.float64, count=len(values)) * 1000)
+                # The local hour skipped when the clocks go forward is interpolated
+                series[band] = HourlySeries.from_index(index, values).fill_gaps()
+            predictions = series["yhat"]
+            _LOGGER.debug(f"\nEnergy Queries response local timezone: {predictions}")
+
+            self.store_demand_predictions(predictions, series.get("yhat_lower"), series.get("yhat_upper"))
 
             # Show the end time of the prediction process
             _LOGGER.debug(f"Prophet demand predictions finished at {datetime.now()}")
@@ -541,9 +763,78 @@ class PVContollerAPI:
             _LOGGER.error(f"Error making demand predictions with Prophet: {e}")
             return False
 
+    def store_demand_predictions(self, predictions: HourlySeries, lower: HourlySeries | None = None,
+                                 upper: HourlySeries | None = None) -> None:
+        """Store the demand predictions (Wh) and their uncertainty interval, the first value is the current hour."""
+        # Store values locally
+        self.demand_prophet_predictions = predictions        
+        self.demand_prophet_lower = lower
+        self.demand_prophet_upper = upper
+
+        # Store the prediction for this hour and the next hour
+        # Note: the current hour is index 0. The next hour is index 1
+        self.demand_prophet_current_hour_prediction = int(predictions.values[0])
+        self.demand_prophet_next_hour_prediction = int(predictions.values[1])          
+
+        # Update the last Prophet update date
+        self._prophet_last_update = datetime.now()
+
+    async def demand_history_series(self, start=None) -> HourlySeries | None:
+        """
+        Return the hourly demand (kWh) from the history cache: energy from the grid plus energy
+        from the inverter to the consumers. Hours missing in any of the sensors are NaN.
+        """
+        entity_ids = [self._acin_to_acout_sensor.split('.')[1], self._inverter_to_acout_sensor.split('.')[1]]
+        # Refresh the history of both sensors in a single request to InfluxDB
+        await self.refresh_history_cache({entity_id: start for entity_id in entity_ids})
+        series = []
+        for entity_id in entity_ids:
+            df = await self.hourly_delta_energy_dataframe(entity_id, start=start)
+            if df is None or df.empty:
+                _LOGGER.debug(f"No demand history of {entity_id}")
+                return None
+            series.append(HourlySeries.from_index(df.index, df['delta_energy'].to_numpy()))
+        # Add the hours present in both series
+        first_hour = max(s.start_hour for s in series)
+        end_hour = min(s.start_hour + len(s) for s in series)
+        if end_hour <= first_hour:
+            return None
+        values = sum(s.values[first_hour - s.start_hour:end_hour - s.start_hour] for s in series)
+        return HourlySeries(first_hour, values)
+
+    async def make_predictions_ridge(self, current_datetime: datetime) -> bool:
+        """Make energy consumption predictions with the built-in NumPy forecaster (the Addon is not needed)."""
+        try:
+            current_date = current_datetime.replace(minute=0, second=0, microsecond=0)
+            start = current_date - timedelta(days=self.demand_history_days) if self.demand_history_days > 0 else None
+            history = await self.demand_history_series(start)
+            if history is None:
+                raise ValueError("No demand history available")
+
+            forecaster = FourierRidgeForecaster().fit(history)
+            predictions = forecaster.predict(epoch_hour(current_date), DEMAND_FORECAST_PERIODS)
+            lower, upper = forecaster.predict_interval(epoch_hour(current_date), DEMAND_FORECAST_PERIODS)
+            # Convert predictions to integers and Wh
+            predictions, lower, upper = (series.with_values(np.trunc(series.values * 1000)) for series in (predictions, lower, upper))
+            _LOGGER.debug(f"Ridge demand predictions: {predictions}")
+
+            self.store_demand_predictions(predictions, lower, upper)
+            return True
+        except Exception as e:
+            _LOGGER.error(f"Error making demand predictions with the ridge forecaster: {e}")
+            return False
+
 
     def need_new_target_socs(self):
         """Check if new target SoCs need to be calculated."""
+        # The dynamic programming engine is fast enough to recalculate in every update
+        if self.optimizer_engine == OPTIMIZER_ENGINE_DP:
+            return True
+
+        # Rolling horizon with sub-hourly periods: recalculate in every update from the measured SoC
+        if self.period_minutes < 60:
+            return True
+
         # Check if there is a significant deviation in the target SoCs values
         if self._last_calc_initial_soc_Wh is not None and self._current_initial_soc_Wh is not None:
             soc_deviation = 100 * abs(self._last_calc_initial_soc_Wh - self._current_initial_soc_Wh) / self._battery_capacity_Wh
@@ -566,17 +857,17 @@ class PVContollerAPI:
     def check_data_ready(self):
         """Check if all necessary data is available."""
         # Check if electricity price data is available
-        if self._dict_pvpc_buy_prices is None or self._dict_pvpc_sell_prices is None:
+        if self._pvpc_buy_prices is None or self._pvpc_sell_prices is None:
             _LOGGER.debug("No electricity price data available")
             return False
 
         # Check if solar forecast data is available
-        if self._dict_forecast_solar is None:
+        if self._forecast_solar is None:
             _LOGGER.debug("No solar forecast data available")
             return False
         
         # Check if corrected solar forecast data is available
-        if self.dict_effective_forecast_solar is None:
+        if self.effective_forecast_solar is None:
             _LOGGER.debug("No effective solar forecast data available")
             return False       
         
@@ -601,35 +892,33 @@ class PVContollerAPI:
         # current_datetime = datetime.now()
 
         # Create lists of electricity prices and solar forecast
-        if self._dict_pvpc_buy_prices is not None:
-            buy_prices = await self.pvpc_dict_to_list(self._dict_pvpc_buy_prices, current_datetime)
+        if self._pvpc_buy_prices is not None:
+            buy_prices = self._pvpc_buy_prices.slice_from(current_datetime).to_list()
         else:
             _LOGGER.debug("No electricity buy price data available")
             return False
         
-        if self._dict_pvpc_sell_prices is not None:
-            sell_prices = await self.pvpc_dict_to_list(self._dict_pvpc_sell_prices, current_datetime)
+        if self._pvpc_sell_prices is not None:
+            sell_prices = self._pvpc_sell_prices.slice_from(current_datetime).to_list()
             if self.sell_allowed is False:
                 sell_prices = [0.0] * len(sell_prices)
         else:
             _LOGGER.debug("No electricity sell price data available")
             return False
         
-        if self.dict_effective_forecast_solar is not None:
-            forecast_solar = await self.forecast_solar_dict_to_list(self.dict_effective_forecast_solar, current_datetime)
+        if self.effective_forecast_solar is not None:
+            forecast_solar = self.effective_forecast_solar.slice_from(current_datetime).to_list()
         else:
             _LOGGER.debug("No solar forecast data available")
             return False               
         
-        if self.dict_demand_prophet_predictions is None:
+        if self.demand_prophet_predictions is None:
             _LOGGER.debug("No electricity consumption data available")
             return False
 
         # Create the list with Prophet consumption forecasts
         current_date = current_datetime.replace(hour=0, minute=0, second=0, microsecond=0)
-        demand_dict = self.dict_demand_prophet_predictions
-        demand_dict = {k: v for k, v in demand_dict.items() if datetime.fromisoformat(k) >= current_date}
-        demand = list(demand_dict.values())
+        demand = self.demand_prophet_predictions.slice_from(current_date).to_list()
 
         max_i_buy = len(buy_prices)
         max_i_sell = len(sell_prices)
@@ -652,69 +941,107 @@ class PVContollerAPI:
             _LOGGER.debug("Not enough data for SoC calculation")
             return False
 
+        # The solvers fail with NaN values: the hours without data in the lists are interpolated
+        lists = [buy_prices, sell_prices, forecast_solar, demand]
+        for i, values in enumerate(lists):
+            array = np.asarray(values[0:max_index], dtype=np.float64)
+            if not np.isfinite(array).all():
+                _LOGGER.warning(f"Filling {np.count_nonzero(~np.isfinite(array))} hours without data in the lists for SoC calculation")
+                array = HourlySeries(0, array).fill_gaps().values
+                if not np.isfinite(array).all():
+                    _LOGGER.debug("No valid data for SoC calculation")
+                    return False
+                lists[i] = array.tolist()
+        buy_prices, sell_prices, forecast_solar, demand = lists
+
         _LOGGER.info(f"Optimization will be performed for {max_index} periods")   
 
         self._list_buy_prices = buy_prices[0:max_index]
         self._list_sell_prices = sell_prices[0:max_index]
         self._list_solar_production = forecast_solar[0:max_index]
         self._list_demand = demand[0:max_index]
+        # Uncertainty interval of the demand forecast, only used by the stochastic engine
+        self._list_demand_lower = self._list_demand_upper = None
+        if self.demand_prophet_lower is not None and self.demand_prophet_upper is not None:
+            lower = self.demand_prophet_lower.slice_from(current_date).to_list()
+            upper = self.demand_prophet_upper.slice_from(current_date).to_list()
+            if len(lower) >= max_index and len(upper) >= max_index and \
+                    np.isfinite(lower[0:max_index]).all() and np.isfinite(upper[0:max_index]).all():
+                self._list_demand_lower = lower[0:max_index]
+                self._list_demand_upper = upper[0:max_index]
+
+        if self.period_minutes < 60:
+            self.split_lists_into_periods(current_datetime)
         return True        
 
-                                                
-    async def pvpc_dict_to_list(self, dict_pvpc: dict[str, float], current_datetime: datetime) -> list[float]:
-        """Convert an electricity price dictionary into a list of floats."""
-        # The electricity price dictionary must be formatted by the coordinator to make it continuous
-        # using the utils.pvpc_raw_to_useful_dict function
-        # it has date_hours as keys in str format, e.g., '2024-10-28 07:00:00'        
-
-        # If the dictionary is empty, return an empty list
-        if not dict_pvpc:
-            return []
-
-        # Get a datetime with the current date removing minutes and seconds
-        current_date = current_datetime.replace(minute=0, second=0, microsecond=0) 
-
-        df = pd.DataFrame(dict_pvpc.items(), columns=['date', 'value'])
-
-        df['date'] = pd.to_datetime(df['date'])
-        df = df.set_index('date')
-
-        # Remove values earlier than current_date
-        df = df[df.index >= current_date]
-        # If df is empty, return an empty list
-        if df.empty:
-            return []
-        
-        return df['value'].tolist()  
-     
-
-    async def forecast_solar_dict_to_list(self, dict_forecast_solar: dict[str, float], current_datetime: datetime) -> list[float]:
-        """Convert a solar forecast dictionary into a list of floats."""
-        # The solar forecast dictionary must be formatted by the coordinator to make it continuous
-        # using the utils.get_forecast_solar_dict function
-        # it has date_hours as keys in str format, e.g., '2024-10-28 07:00:00'
-
-        # If the dictionary is empty, return an empty list
-        if not dict_forecast_solar:
-            return []
-        
-        # Get a datetime with the current date removing minutes and seconds
-        current_date = current_datetime.replace(minute=0, second=0, microsecond=0) 
-
-        df = pd.DataFrame(dict_forecast_solar.items(), columns=['date', 'value'])
-
-        df['date'] = pd.to_datetime(df['date'])
-        df = df.set_index('date')
-
-        # Remove values earlier than current_date
-        df = df[df.index >= current_date]
-        # If df is empty, return an empty list
-        if df.empty:
-            return []
-        
-        return df['value'].tolist()
+    def optimizer_inputs_key(self, current_datetime: datetime) -> str:
+        """
+        Return the hash of the inputs of pulp_calculations: the quantized lists, SoCs and prices, the installation
+        parameters and the start of the current period. The calculations of the same period share the result: the
+        first period of a cached result is pro-rated from the time of its calculation, the plan starts at that time.
+        """
+        def quantize(values, quantum):
+            return np.round(np.asarray(values, dtype=np.float64) / quantum).astype(np.int64).tobytes()
+
+        digest = hashlib.blake2b(digest_size=16)
+        for values in (self._list_demand, self._list_solar_production, self._list_demand_lower, self._list_demand_upper):
+            digest.update(b"-" if values is None else quantize(values, OPTIMIZER_CACHE_ENERGY_QUANTUM_WH))
+        for values in (self._list_buy_prices, self._list_sell_prices):
+            digest.update(quantize(values, OPTIMIZER_CACHE_PRICE_QUANTUM))
+        minute = current_datetime.minute - current_datetime.minute % self.period_minutes
+        parameters = (current_datetime.replace(minute=minute, second=0, microsecond=0).isoformat(),
+                      round(self._current_initial_soc_Wh / OPTIMIZER_CACHE_ENERGY_QUANTUM_WH),
+                      round(self._test_min_soc_Wh / OPTIMIZER_CACHE_ENERGY_QUANTUM_WH),
+                      self._battery_capacity_Wh, self._max_charge_energy_per_period_Wh, self._max_discharge_energy_per_period_Wh,
+                      self._max_buy_energy_per_period_Wh, self._charge_efficiency, self._discharge_efficiency,
+                      self.battery_purchase_price, self.battery_eol_cycles_if_min_soc_20, self.battery_eol_cycles_if_min_soc_50,
+                      self.final_soc_weight_factor, self.optimizer_engine, self.period_minutes)
+        digest.update(repr(parameters).encode())
+        return digest.hexdigest()
+
+    def split_lists_into_periods(self, current_datetime: datetime) -> None:
+        """
+        Split the hourly lists of the calculation into periods of period_minutes, from the current period
+        and for MPC_HORIZON_HOURS at most (96 periods of 15 minutes or 288 periods of 5 minutes).
+        """
+        periods_per_hour = self.periods_per_hour
+        # Periods of the current hour that have already finished
+        skip = current_datetime.minute // self.period_minutes
+        max_periods = MPC_HORIZON_HOURS * periods_per_hour
+        self._list_buy_prices = hourly_to_periods(self._list_buy_prices, periods_per_hour, skip, energy=False)[:max_periods]
+        self._list_sell_prices = hourly_to_periods(self._list_sell_prices, periods_per_hour, skip, energy=False)[:max_periods]
+        self._list_solar_production = hourly_to_periods(self._list_solar_production, periods_per_hour, skip)[:max_periods]
+        self._list_demand = hourly_to_periods(self._list_demand, periods_per_hour, skip)[:max_periods]
+        if self._list_demand_lower is not None and self._list_demand_upper is not None:
+            self._list_demand_lower = hourly_to_periods(self._list_demand_lower, periods_per_hour, skip)[:max_periods]
+            self._list_demand_upper = hourly_to_periods(self._list_demand_upper, periods_per_hour, skip)[:max_periods]
+        _LOGGER.info(f"Optimization will be performed for {len(self._list_demand)} periods of {self.period_minutes} minutes")
+
+    def soc_model(self, key: tuple, model_class=None):
+        """
+        Return the model of the SoC schedule with the structure key, built the first time it is used.
+        The horizon changes along the day, only the SOC_MODELS_MAX models used most recently are kept.
+        """
+        model = self._soc_models.pop(key, None)
+        if model is None:
+            model = model_class(*key) if model_class is not None else make_soc_model(*key)
+            if len(self._soc_models) >= SOC_MODELS_MAX:
+                # The dictionary keeps the order of use, the first model is the least recently used
+                self._soc_models.pop(next(iter(self._soc_models)))
+        self._soc_models[key] = model
+        return model
+
+    def solve_soc_model(self, key: tuple, model_class, *data) -> ScheduleSolution:
+        """
+        Update the model with the structure key with the data of the calculation, solve it and return its solution.
+        Building the model, updating and solving it are blocking, this method is run in a worker thread.
+        """
+        model = self.soc_model(key, model_class)
+        model.update(*data)
+        model.solve()
+        return model.solution()
 
-    
+                                                
     async def make_target_socs(self, current_datetime: datetime, force_update: bool = False) -> bool:
         """
         Calculate the target SoCs for as many periods as we have available information.
@@ -746,14 +1073,35 @@ class PVContollerAPI:
 
         # We can iterate and test diferents min_soc values
         self._test_min_soc_Wh = self._current_min_soc_Wh
-        result,objetive = await self.pulp_calculations(current_datetime)
+        # The same inputs give the same results, the solver only runs if they are not in the cache
+        # The key is calculated before pulp_calculations, which modifies the first period of the lists
+        key = self.optimizer_inputs_key(current_datetime)
+        cached = self._optimizer_cache.pop(key, None)
+        if cached is not None:
+            # The results (System Time, pro-rated first period) are those of the calculation at calc_datetime,
+            # the plan of the setpoint starts at that time and from the SoC of that calculation
+            result, objetive, self.pulp_parameters, calc_datetime, calc_initial_soc_Wh = cached
+            _LOGGER.debug(f"Target SoCs found in the cache of results, calculated at {calc_datetime}")
+            self.pulp_json_results = result
+        else:
+            result, objetive = await self.pulp_calculations(current_datetime)
+            if result is None:
+                _LOGGER.warning("The target SoCs could not be calculated")
+                return False
+            calc_datetime, calc_initial_soc_Wh = current_datetime, self._current_initial_soc_Wh
+            if len(self._optimizer_cache) >= OPTIMIZER_CACHE_SIZE:
+                # The dictionary keeps the order of use, the first result is the least recently used
+                self._optimizer_cache.pop(next(iter(self._optimizer_cache)))
+        self._optimizer_cache[key] = (result, objetive, self.pulp_parameters, calc_datetime, calc_initial_soc_Wh)
+        self.pulp_results_datetime = calc_datetime
 
         soc = result['SoC(%)']
-        soc_len = len(soc)
         current_date = current_datetime.replace(minute=0, second=0, microsecond=0)
-        date_list = [(current_date + timedelta(hours=x)).isoformat() for x in range(soc_len)]
-        self.dict_target_socs = dict(zip(date_list, soc))
+        # SoC at the end of each hour: with sub-hourly periods, the last period of each hour
+        last_period_current_hour = self.periods_per_hour - current_datetime.minute // self.period_minutes - 1
+        self.target_socs = HourlySeries.from_start(current_date, soc[last_period_current_hour::self.periods_per_hour])
 
+        # Target at the end of the first period (the current hour or the current sub-hourly period)
         self.target_soc_current_hour = result['SoC(%)'][0]
         _LOGGER.debug(f"Finishing PuLP: {datetime.now()} with result: {result} and objetive: {objetive}")
 
@@ -762,7 +1110,7 @@ class PVContollerAPI:
         # to compare if it is necessary to recalculate the target SoCs when the difference between them is large
         # This check is performed in need_new_target_socs
  
-        self._last_calc_initial_soc_Wh = self._current_initial_soc_Wh
+        self._last_calc_initial_soc_Wh = calc_initial_soc_Wh
         self._target_socs_last_update = datetime.now()
         return True
     
@@ -784,34 +1132,25 @@ class PVContollerAPI:
         min_soc = self._test_min_soc_Wh # self._current_min_soc_Wh  # Minimum allowed SoC (Wh)
 
         # Photovoltaic installation parameters
+        # The configured energies per period are hourly, they are divided by the periods of each hour
+        periods_per_hour = self.periods_per_hour
         battery_capacity = self._battery_capacity_Wh  # Maximum battery capacity (Wh)
-        max_charge_energy_per_period = self._max_charge_energy_per_period_Wh  # (Wh), due to the maximum charging power max_charge_power(W)
-        max_discharge_energy_per_period = self._max_discharge_energy_per_period_Wh  # (Wh), due to the maximum discharging power max_discharge_power(W)
-        max_buy_energy_per_period = self._max_buy_energy_per_period_Wh  # (Wh), due to the maximum contracted power with the grid max_grid_power(W)
+        max_charge_energy_per_period = self._max_charge_energy_per_period_Wh / periods_per_hour  # (Wh), due to the maximum charging power max_charge_power(W)
+        max_discharge_energy_per_period = self._max_discharge_energy_per_period_Wh / periods_per_hour  # (Wh), due to the maximum discharging power max_discharge_power(W)
+        max_buy_energy_per_period = self._max_buy_energy_per_period_Wh / periods_per_hour  # (Wh), due to the maximum contracted power with the grid max_grid_power(W)
         charge_efficiency = self._charge_efficiency  # Battery charging efficiency (AC-DC conversion efficiency)
         discharge_efficiency = self._discharge_efficiency  # Battery discharging efficiency (DC-AC conversion efficiency)
 
-        # Take into account the time remaining until the end of the current hour
-        max_charge_energy_first_period = max_charge_energy_per_period - (current_datetime.minute * max_charge_energy_per_period / 60)
-        max_discharge_energy_first_period = max_discharge_energy_per_period - (current_datetime.minute * max_discharge_energy_per_period / 60)
-        max_buy_energy_first_period = max_buy_energy_per_period - (current_datetime.minute * max_buy_energy_per_period / 60)
-        demand[0] = demand[0] - (current_datetime.minute * demand[0] / 60)
-        solar_production[0] = solar_production[0] - (current_datetime.minute * solar_production[0] / 60)
-
-        # Battery cost parameters
-        battery_purchase_price = self.battery_purchase_price  # 1000€ ?
-        battery_eol_cycles_if_min_soc_20 = 2500  # cycles
-        battery_eol_cycles_if_min_soc_50 = 5000  # cycles
-        min_soc_percent= min_soc / battery_capacity *100 # %
-        # Linear interpolation between 20% and 50% to estimate the battery lifetime at min_soc_percent
-        battery_eol_cycles_current_min_soc = battery_eol_cycles_if_min_soc_20 + \
-            (battery_eol_cycles_if_min_soc_50 - battery_eol_cycles_if_min_soc_20) * (min_soc_percent - 20) / 30  # cycles
-
-        # Battery energy cost. Only considered when discharging the battery
-        # In its lifetime, the battery can provide:
-        all_live_energy= (battery_eol_cycles_current_min_soc*battery_capacity*(100-min_soc_percent)/100)/1000 # kWh of energy
-        # Therefore, the cost of the energy from battery is battery_purchase_price / all_live_energy €/kWh
-        battery_energy_price = battery_purchase_price / all_live_energy  # €/kWh
+        # Take into account the time remaining until the end of the current period
+        period_minutes = self.period_minutes
+        elapsed_minutes = current_datetime.minute % period_minutes
+        first_period_fraction = 1 - elapsed_minutes / period_minutes
+        demand[0] = demand[0] - (elapsed_minutes * demand[0] / period_minutes)
+        solar_production[0] = solar_production[0] - (elapsed_minutes * solar_production[0] / period_minutes)
+
+        # Battery energy cost (€/kWh). Only considered when discharging the battery
+        energy_price_battery = battery_energy_price(self.battery_purchase_price, battery_capacity, min_soc,
+                                                    self.battery_eol_cycles_if_min_soc_20, self.battery_eol_cycles_if_min_soc_50)
 
         # Number of hours to consider       
         num_hours = min(len(demand), len(solar_production), len(buy_prices), len(sell_prices))
@@ -833,111 +1172,106 @@ class PVContollerAPI:
 
         # Set the weight we will give in the objective function to maximize the final SoC versus minimizing the cost of purchased energy
         # When solar production is greater than demand, maximizing the SoC will be prioritized
+        w = self.final_soc_weight_factor * final_soc_weight(demand, solar_production, buy_prices)
         if total_solar_production >= total_demand:
-            w = 2 * average_price / 1000
-            # w = 2 * max_price / 1000
             _LOGGER.debug(f"Solar production covers all demand! w={w}")
         else:
-            w = average_price / 1000
-            # w = max_price / 1000
             _LOGGER.debug(f"Solar production does not cover all demand! w={w}")
 
-        # NOTE: THE PROBLEM IS SOLVED CORRECTLY EVEN IF initial_soc < min_soc
-
-        # Create the optimization problem
-        problem = pulp.LpProblem("Optimal_SOC_with_Cost_Minimization", pulp.LpMinimize)
-
-        # Decision variables: energies and SoC of the battery at each hour
-        energy_from_grid = [pulp.LpVariable(f'f_grid_{i}', lowBound=0, upBound=max_buy_energy_per_period) for i in range(num_hours)]
-        energy_to_grid = [pulp.LpVariable(f't_grid_{i}', lowBound=0) for i in range(num_hours)]
-        soc = [pulp.LpVariable(f'soc_{i}', lowBound=0, upBound=battery_capacity) for i in range(num_hours)]
-        energy_to_battery = [pulp.LpVariable(f'charge_{i}', lowBound=0, upBound=max_charge_energy_per_period) for i in range(num_hours)]
-        energy_from_battery = [pulp.LpVariable(f'discharge_{i}', lowBound=0, upBound=max_discharge_energy_per_period) for i in range(num_hours)]
-
-        # Objective function: minimize the cost of energy and maximize the SoC
-        energy_cost = pulp.lpSum([(energy_from_grid[i] * buy_prices[i] + \
-                                energy_from_battery[i] * battery_energy_price - \
-                                energy_to_grid[i] * sell_prices[i] - \
-                                energy_to_battery[i] * battery_energy_price \
-                                )*(1/1000) \
-                                for i in range(num_hours)])  # Convert prices to €/Wh        
-        final_soc = soc[-1]  # The state of charge in the last period
-        problem += energy_cost - w * final_soc
-
-        # CONSTRAINTS
-        # Require that the SoC at the last period is greater than the initial SoC.
-        # The final SoC could have been set as an input parameter. Consider this in future versions
-        problem += soc[-1] >= initial_soc
-        for i in range(num_hours):
-            if i == 0:
-                # In the first hour, start from initial_soc and balance
-                problem += soc[i] == initial_soc + energy_to_battery[i] - energy_from_battery[i]
-                # Limit the energy that can enter the battery due to the maximum charging power in first period
-                problem += energy_to_battery[i] <= max_charge_energy_first_period
-                problem += energy_from_battery[i] <= max_discharge_energy_first_period
-                problem += energy_from_grid[i] <= max_buy_energy_first_period
-                # How much energy can be sent to the battery in the first period if the initial SoC is less than min_soc?
-                max_energy_available = max(max_buy_energy_first_period + solar_production[0] - demand[0],0)
-                max_energy_to_battery = min(max_charge_energy_first_period, max_energy_available*charge_efficiency)
-                # Try to recover the SoC as quickly as possible if it is below min_soc
-                if initial_soc < min_soc:
-                    problem += soc[i] >= initial_soc + max_energy_to_battery
-                else:
-                    # Require that the SoC does not fall below the minimum allowed
-                    problem += soc[i] >= min_soc      
+        solution = None
+        if self.optimizer_engine == OPTIMIZER_ENGINE_STOCHASTIC:
+            # Two-stage LP over scenarios sampled from the uncertainty of the demand and solar forecasts
+            demand_scenarios, solar_scenarios = self.demand_solar_scenarios(num_hours, first_period_fraction)
+            # The key has one more parameter than the keys of SocScheduleModel, they never collide
+            key = ScenarioScheduleModel.structure_key(num_hours, STOCHASTIC_SCENARIOS, battery_capacity,
+                                                      max_charge_energy_per_period, max_discharge_energy_per_period,
+                                                      max_buy_energy_per_period, charge_efficiency, discharge_efficiency)
+            try:
+                solution = await asyncio.to_thread(self.solve_soc_model, key, ScenarioScheduleModel,
+                    demand_scenarios, solar_scenarios, buy_prices, sell_prices, initial_soc, min_soc,
+                    first_period_fraction, energy_price_battery, w)
+            except pulp.PulpSolverError as e:
+                _LOGGER.error(f"Error running the PuLP solver with scenarios: {e}")
+            if solution is None or solution.status != 'Optimal':
+                # Extreme scenarios can make the problem infeasible, the deterministic problem is solved instead
+                _LOGGER.warning("No solution with scenarios, solving with the forecasts only")
+                solution = None
+
+        if self.optimizer_engine in (OPTIMIZER_ENGINE_PULP, OPTIMIZER_ENGINE_VALIDATE) \
+            or (self.optimizer_engine == OPTIMIZER_ENGINE_STOCHASTIC and solution is None):
+            # The structure of the model is built only once for each number of hours (and installation parameters)
+            key = SocScheduleModel.structure_key(num_hours, battery_capacity, max_charge_energy_per_period,
+                                                 max_discharge_energy_per_period, max_buy_energy_per_period,
+                                                 charge_efficiency, discharge_efficiency)
+            try:
+                # Build the model (first time), update the constant terms of the constraints and the objective
+                # function and run the solver in a separate thread
+                solution = await asyncio.to_thread(self.solve_soc_model, key, None,
+                    demand, solar_production, buy_prices, sell_prices, initial_soc, min_soc,
+                    first_period_fraction, energy_price_battery, w)
+            except pulp.PulpSolverError as e:
+                _LOGGER.error(f"Error running the PuLP solver: {e}")
+                # raise UpdateFailed(f"Error running the PuLP solver: {e}")
+                return None, None
+
+        if self.optimizer_engine in (OPTIMIZER_ENGINE_DP, OPTIMIZER_ENGINE_VALIDATE):
+            # Dynamic programming over discretized SoC levels (no external solver)
+            dp_solution = await asyncio.to_thread(solve_soc_schedule_dp,
+                demand[:num_hours], solar_production[:num_hours], buy_prices[:num_hours], sell_prices[:num_hours],
+                initial_soc, min_soc, first_period_fraction, energy_price_battery, w, battery_capacity,
+                max_charge_energy_per_period, max_discharge_energy_per_period, max_buy_energy_per_period,
+                charge_efficiency, discharge_efficiency)
+            if solution is None:
+                solution = dp_solution
+            elif solution.status == 'Optimal' and dp_solution.status == 'Optimal':
+                # Validation mode: the PuLP solution is used, log the objective gap of the DP engine
+                _LOGGER.info(f"Objective gap DP - PuLP: {dp_solution.objective - solution.objective:.4f} € "
+                             f"(PuLP: {solution.objective:.4f} €, DP: {dp_solution.objective:.4f} €)")
             else:
-                # In the following hours, the SoC depends on the previous state
-                problem += soc[i] == soc[i - 1] + energy_to_battery[i] - energy_from_battery[i]
-                # Require that the SoC does not fall below the minimum allowed
-                problem += soc[i] >= min_soc        
-
-            # Global energy balance
-            problem += demand[i] + pulp.lpSum(energy_to_battery[i])/charge_efficiency + energy_to_grid[i] == \
-                energy_from_grid[i] + solar_production[i] + pulp.lpSum(energy_from_battery[i]) * discharge_efficiency                  
-        try:
-            # Run problem.solve() in a separate thread
-            await asyncio.to_thread(problem.solve)
-        except pulp.PulpSolverError as e:
-            _LOGGER.error(f"Error running the PuLP solver: {e}")
-            # raise UpdateFailed(f"Error running the PuLP solver: {e}")
-            return None, None
+                _LOGGER.warning(f"Solution status PuLP: {solution.status}, DP: {dp_solution.status}")
 
         # Check the solution status
-        status = pulp.LpStatus[problem.status]
-        _LOGGER.info(f"PuLP solution status: {status}")
+        status = solution.status
+        _LOGGER.info(f"Solution status ({self.optimizer_engine}): {status}")
 
         if status != 'Optimal':
             return None, None
 
-        _LOGGER.info(f"Objective function: {pulp.value(problem.objective):.2f} €")
+        objective = solution.objective
+        _LOGGER.info(f"Objective function: {objective:.2f} €")
+        energy_from_grid = solution.energy_from_grid
+        energy_to_grid = solution.energy_to_grid
+        soc = solution.soc
+        energy_to_battery = solution.energy_to_battery
+        energy_from_battery = solution.energy_from_battery
 
         # Results
         total_grid_cost = 0
         for i in range(num_hours):
-            total_grid_cost += energy_from_grid[i].varValue * buy_prices[i] \
-                                - energy_to_grid[i].varValue * sell_prices[i]
+            total_grid_cost += energy_from_grid[i] * buy_prices[i] \
+                                - energy_to_grid[i] * sell_prices[i]
         total_grid_cost = total_grid_cost / 1000  # Convert to € (price is in €/kWh and energy in Wh)
         total_battery_cost = 0
         for i in range(num_hours):
-            total_battery_cost += energy_from_battery[i].varValue * battery_energy_price \
-                                - energy_to_battery[i].varValue * battery_energy_price
+            total_battery_cost += energy_from_battery[i] * energy_price_battery \
+                                - energy_to_battery[i] * energy_price_battery
         total_battery_cost = total_battery_cost / 1000  # Convert to € (price is in €/kWh and energy in Wh)
 
         # Create a dictionary with the results
-        current_date = current_datetime.replace(minute=0, second=0, microsecond=0)
+        current_period = current_datetime.replace(minute=current_datetime.minute - elapsed_minutes, second=0, microsecond=0)
         results = {
             "Hour": [i for i in range(1, num_hours + 1)],
-            "System Time": [(current_date + timedelta(hours=i)).strftime("%H:%M") for i in range(num_hours)],
+            "System Time": [(current_period + timedelta(minutes=i * period_minutes)).strftime("%H:%M") for i in range(num_hours)],
             "buy_price(€/kWh)": buy_prices,
             "sell_price(€/kWh)": sell_prices,
             "Demand(Wh)": [round(demand[i]) for i in range(num_hours)], 
             "from_solar(Wh)": [round(solar_production[i]) for i in range(num_hours)],
-            "from_grid(Wh)": [round(energy_from_grid[i].varValue) for i in range(num_hours)],
-            "to_grid(Wh)": [round(energy_to_grid[i].varValue) for i in range(num_hours)],
-            "to_battery(Wh)": [round(energy_to_battery[i].varValue) for i in range(num_hours)],
-            "from_battery(Wh)": [round(energy_from_battery[i].varValue) for i in range(num_hours)],
-            "SoC(Wh)": [round(soc[i].varValue) for i in range(num_hours)],
-            "SoC(%)": [round(soc[i].varValue / battery_capacity * 100) for i in range(num_hours)]
+            "from_grid(Wh)": [round(energy_from_grid[i]) for i in range(num_hours)],
+            "to_grid(Wh)": [round(energy_to_grid[i]) for i in range(num_hours)],
+            "to_battery(Wh)": [round(energy_to_battery[i]) for i in range(num_hours)],
+            "from_battery(Wh)": [round(energy_from_battery[i]) for i in range(num_hours)],
+            "SoC(Wh)": [round(soc[i]) for i in range(num_hours)],
+            "SoC(%)": [round(soc[i] / battery_capacity * 100) for i in range(num_hours)]
         }
         results['System Time'][0] = current_datetime.strftime("%H:%M")
         self.pulp_json_results = results
@@ -946,8 +1280,10 @@ class PVContollerAPI:
         _LOGGER.info(f"Results: {results}")
 
         # Make a dictionary with other optimization data for the frontend
-        self.pulp_parameters = {"Status": pulp.LpStatus[problem.status],
-                                "Objective function": pulp.value(problem.objective),
+        self.pulp_parameters = {"Status": status,
+                                "Engine": self.optimizer_engine,
+                                "Period minutes": period_minutes,
+                                "Objective function": objective,
                                 "w": w,
                                 "gross_demand_cost": gross_demand_cost,
                                 "total_grid_cost": total_grid_cost,
@@ -959,7 +1295,7 @@ class PVContollerAPI:
                                 "max_price": max_price,
                                 "min_price": min_price,
                                 "min_price_hour": min_price_hour+1,
-                                "battery_energy_price €/kWh": battery_energy_price, # €/kWh
+                                "battery_energy_price €/kWh": energy_price_battery, # €/kWh
                                 "initial_soc": initial_soc, 
                                 "min_soc": min_soc, 
                                 "demand": self._list_demand, 
@@ -969,8 +1305,35 @@ class PVContollerAPI:
                                 }
 
 
-        return results, pulp.value(problem.objective)
+        return results, objective
         
+    def demand_solar_scenarios(self, num_hours: int, first_period_fraction: float) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return the scenarios (STOCHASTIC_SCENARIOS x num_hours) of demand and solar production (Wh) around the lists
+        of the calculation. The demand uses the uncertainty interval of its forecast, or DEMAND_FORECAST_INTERVAL
+        if the engine does not provide it. The solar production uses SOLAR_FORECAST_INTERVAL.
+        """
+        demand = np.asarray(self._list_demand[:num_hours], dtype=np.float64)
+        if self._list_demand_lower is not None and self._list_demand_upper is not None:
+            lower = np.asarray(self._list_demand_lower[:num_hours], dtype=np.float64)
+            upper = np.asarray(self._list_demand_upper[:num_hours], dtype=np.float64)
+            # The first period of the demand list is already reduced to the rest of the period
+            lower[0] *= first_period_fraction
+            upper[0] *= first_period_fraction
+            # Hours without interval
+            missing = np.isnan(lower) | np.isnan(upper)
+            lower[missing] = demand[missing] * (1 - DEMAND_FORECAST_INTERVAL)
+            upper[missing] = demand[missing] * (1 + DEMAND_FORECAST_INTERVAL)
+        else:
+            lower, upper = demand * (1 - DEMAND_FORECAST_INTERVAL), demand * (1 + DEMAND_FORECAST_INTERVAL)
+        solar = np.asarray(self._list_solar_production[:num_hours], dtype=np.float64)
+        # The correlation of the errors is hourly, with sub-hourly periods it is the same after one hour
+        correlation = FORECAST_ERROR_CORRELATION ** (1 / self.periods_per_hour)
+        demand_scenarios = forecast_scenarios(demand, lower, upper, STOCHASTIC_SCENARIOS, seed=0, correlation=correlation)
+        solar_scenarios = forecast_scenarios(solar, solar * (1 - SOLAR_FORECAST_INTERVAL), solar * (1 + SOLAR_FORECAST_INTERVAL),
+                                             STOCHASTIC_SCENARIOS, seed=1, correlation=correlation)
+        return demand_scenarios, solar_scenarios
+
     async def make_hourly_df_between_dates(self, start, end, value) -> pd.DataFrame:
         """
         Create a DataFrame with hourly values between two dates.
@@ -1043,37 +1406,32 @@ class PVContollerAPI:
         Calculate the corrected solar forecast with the ratio between solar production and solar forecast.
         """
         # Check if it is necessary to update the corrected solar forecast
-        if self._dict_effective_forecast_solar_last_update is not None \
+        if self._effective_forecast_solar_last_update is not None \
             and self.last_history_solar_production_update is not None \
-            and self._dict_forecast_solar_last_update is not None:
-            most_recent_update = max(self.last_history_solar_production_update, self._dict_forecast_solar_last_update)
-            if most_recent_update < self._dict_effective_forecast_solar_last_update:
+            and self._forecast_solar_last_update is not None:
+            most_recent_update = max(self.last_history_solar_production_update, self._forecast_solar_last_update)
+            if most_recent_update < self._effective_forecast_solar_last_update:
                 _LOGGER.debug("The corrected solar forecast is still valid")
                 return True
 
-        if (self._dict_forecast_solar is not None) and (not self.enable_fore_to_real_correction):
-            self.dict_effective_forecast_solar = self._dict_forecast_solar
-            self._dict_effective_forecast_solar_last_update = datetime.now()
+        if (self._forecast_solar is not None) and (not self.enable_fore_to_real_correction):
+            self.effective_forecast_solar = self._forecast_solar
+            self._effective_forecast_solar_last_update = datetime.now()
             return True
 
         # Check if the necessary data is available
-        if self._dict_forecast_solar is None or self.fore_to_real_df is None:
+        if self._forecast_solar is None or self.fore_to_real_df is None or self.fore_to_real_df.empty:
             return False
         try:
-            # Create a dictionary with the corrected solar forecast
-            dict_effective_forecast_solar = self._dict_forecast_solar.copy()
-            for key, value in dict_effective_forecast_solar.items():
-                # Get the hour of the day
-                hour = pd.to_datetime(key).hour
-                # Get the fore_to_real value for the corresponding hour
-                fore_to_real = self.fore_to_real_df.loc[hour, 'fore_to_real']
-                # Correct the solar forecast value
-                dict_effective_forecast_solar[key] = value * fore_to_real
-
-            self._dict_effective_forecast_solar_last_update = datetime.now()
-            self.dict_effective_forecast_solar = dict_effective_forecast_solar
-            # Log the dictionary
-            _LOGGER.debug(f"Corrected solar forecast: {dict_effective_forecast_solar}")
+            # fore_to_real value for each hour of the day (1.0 for the hours without comparison data)
+            factors = hourly_factors_array(self.fore_to_real_df, 'fore_to_real')
+            # Correct all the solar forecast values at once
+            effective_forecast_solar = apply_hourly_factors(self._forecast_solar, factors)
+
+            self._effective_forecast_solar_last_update = datetime.now()
+            self.effective_forecast_solar = effective_forecast_solar
+            # Log the series
+            _LOGGER.debug(f"Corrected solar forecast: {effective_forecast_solar}")
             return True
         except Exception as e:
             _LOGGER.error(f"Error calculating the corrected solar forecast: {e}")
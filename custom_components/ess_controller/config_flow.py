@@ -6,7 +6,7 @@ from homeassistant.core import callback
 from .options_flow import PVcontrollerOptionsFlowHandler  # Ensure to import the class
 
 from .const import DOMAIN, TITLE
-from .const import create_step_one_schema, create_step_two_schema, create_step_three_schema, create_step_four_schema
+from .schemas import create_step_one_schema, create_step_two_schema, create_step_three_schema, create_step_four_schema
 
 class PVcontrollerConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     """Handle a config flow for pv_controller."""
@@ -9,12 +9,20 @@ from homeassistant.core import HomeAssistant
 from homeassistant.helpers.update_coordinator import DataUpdateCoordinator
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.helpers.storage import Store
+from homeassistant.helpers.event import async_track_time_interval, async_track_state_change_event
+from homeassistant.helpers.debounce import Debouncer
 from homeassistant.const import CONF_NAME
 
 from .api import PVContollerAPI
-from .utils import forecast_solar_api_to_dict, pvpc_raw_to_useful_dict, async_get_value_from_store
-from .const import DOMAIN, FORECAST_UPDATE_INTERVAL, COORDINATOR_UPDATE_INTERVAL, \
-    STORE_USER_INPUT_GLOBAL_KEY, STORE_FORECAST_SOLAR_GLOBAL_KEY
+from .setpoint import GridSetpointController
+from .series_store import HourlySeriesStore
+from .hourly_series import HourlySeries
+from .utils import forecast_solar_api_to_series, pvpc_raw_to_day_series, pvpc_series_from_hour, async_get_value_from_store
+from .const import DOMAIN, FORECAST_UPDATE_INTERVAL, COORDINATOR_UPDATE_INTERVAL, COORDINATOR_STAGE_TIMEOUTS, SETPOINT_UPDATE_INTERVAL, \
+    REFRESH_REQUEST_COOLDOWN, SOC_PERCENT_DEVIATION_FORCE_RECALC, \
+    STORE_USER_INPUT_GLOBAL_KEY, STORE_FORECAST_SOLAR_GLOBAL_KEY, HISTORY_SERIES_STORE_DIR, DEFAULT_OPTIMIZER_ENGINE, \
+    DEFAULT_DEMAND_HISTORY_DAYS, DEFAULT_DEMAND_HOURLY_DAYS, DEFAULT_DEMAND_ENGINE, DEFAULT_BATTERY_EOL_CYCLES_MIN_SOC_20, \
+    DEFAULT_BATTERY_EOL_CYCLES_MIN_SOC_50, DEFAULT_FINAL_SOC_WEIGHT_FACTOR, DEFAULT_PERIOD_MINUTES
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -37,20 +45,21 @@ class PVControllerUpdateCoordinator(DataUpdateCoordinator):
         self.sell_allowed = entry.data["sell_allowed"]
         self.battery_soc_sensor=entry.data["battery_soc_sensor"]
         self.security_min_soc_sensor=entry.data["battery_min_soc_overrides_sensor"]
+        self.grid_power_sensor = entry.data.get("grid_power_sensor")
 
         self.data = None
-        self.buy_prices_rawdata = None
-        self.sell_prices_rawdata = None
-        self.buy_prices_useful_dict = None
-        self.sell_prices_useful_dict = None        
+        # Prices of each ESIOS entity parsed from its attributes: {entity_id: ((last_updated, day), HourlySeries)}
+        self._esios_prices = {}
+        self.buy_prices_series = None
+        self.sell_prices_series = None        
 
         self.current_buy_price = None
         self.current_sell_price = None
 
         self.forecast_solar_energy_next_hour = None
         self.forecast_solar_rawdata = None  # Downloaded data from Forecast.Solar of estimated solar production (not continuous)
-        self.forecast_solar_useful_dict = None  # Useful data of estimated solar production by Forecast.Solar (continuous)
-        self.effective_forecast_solar_useful_dict = None  # Corrected estimated solar production data for scheduling calculation
+        self.forecast_solar_series = None  # Useful data of estimated solar production by Forecast.Solar (continuous)
+        self.effective_forecast_solar_series = None  # Corrected estimated solar production data for scheduling calculation
         self.fore_to_real_dict = None  # Coefficients for correcting the solar forecast with historical data
 
         self.predicted_demand = None
@@ -76,7 +85,10 @@ class PVControllerUpdateCoordinator(DataUpdateCoordinator):
         self.target_socs_last_update = None
 
         # Initialize the coordinator
-        super().__init__(hass, _LOGGER, name=DOMAIN, update_interval=COORDINATOR_UPDATE_INTERVAL)
+        # The updates requested by the state changes are debounced: one at most every REFRESH_REQUEST_COOLDOWN
+        super().__init__(hass, _LOGGER, name=DOMAIN, update_interval=COORDINATOR_UPDATE_INTERVAL,
+                         request_refresh_debouncer=Debouncer(hass, _LOGGER, cooldown=REFRESH_REQUEST_COOLDOWN.total_seconds(),
+                                                             immediate=True))
         self.logger.debug("The coordinator has been initialized")        
 
         # Get the Home Assistant timezone
@@ -91,11 +103,16 @@ class PVControllerUpdateCoordinator(DataUpdateCoordinator):
         # Initialize storage for user inputs
         self.store_user_inputs = Store(hass, version=1, key=STORE_USER_INPUT_GLOBAL_KEY)  
 
+        # Initialize the columnar storage for the hourly history read from InfluxDB
+        self.store_influx_history = HourlySeriesStore(hass.config.path(HISTORY_SERIES_STORE_DIR))
+
         # Initialize aiohttp session
         self._session = aiohttp.ClientSession()
 
         # Number to do cascading force update the predictions and the target SoC
         self.force_updates_step = 0
+        # Recalculation of the target SoCs requested by a change of the prices or of the minimum SoC
+        self._recalc_requested = False
 
 
         # Inputs from UI (inputs numbers) updates from store in async_initialize
@@ -105,6 +122,12 @@ class PVControllerUpdateCoordinator(DataUpdateCoordinator):
         # Since the period is one hour, the energy changes to power directly.
         self.max_setpoint_W=int(entry.data["max_buy_energy_per_period_Wh"])
         self.proposed_setpoint_W = self.max_setpoint_W
+        # The setpoint follows the grid energy planned in each period, on its own faster timer
+        self.setpoint_controller = GridSetpointController(self.max_setpoint_W, entry.data["battery_capacity_Wh"],
+                                                          entry.data["charge_efficiency"])
+        self._unsub_setpoint_timer = None
+        # Subscriptions to the state changes of the SoC, minimum SoC and ESIOS entities
+        self._unsub_state_listeners = []
 
         influx_db_pass = None
         if entry.data.get("influx_db_pass", False):
@@ -129,12 +152,27 @@ class PVControllerUpdateCoordinator(DataUpdateCoordinator):
             charge_efficiency=entry.data["charge_efficiency"],
             discharge_efficiency=entry.data["discharge_efficiency"],
             battery_purchase_price= entry.data["battery_purchase_price"],
+            battery_eol_cycles_if_min_soc_20=entry.data.get("battery_eol_cycles_min_soc_20", DEFAULT_BATTERY_EOL_CYCLES_MIN_SOC_20),
+            battery_eol_cycles_if_min_soc_50=entry.data.get("battery_eol_cycles_min_soc_50", DEFAULT_BATTERY_EOL_CYCLES_MIN_SOC_50),
+            final_soc_weight_factor=entry.data.get("final_soc_weight_factor", DEFAULT_FINAL_SOC_WEIGHT_FACTOR),
             str_local_timezone=self.str_local_timezone,
             enable_fore_to_real_correction=self.enable_fore_to_real_correction,
-            sell_allowed=self.sell_allowed)     
+            sell_allowed=self.sell_allowed,
+            history_store=self.store_influx_history,
+            optimizer_engine=entry.data.get("optimizer_engine", DEFAULT_OPTIMIZER_ENGINE),
+            demand_history_days=entry.data.get("demand_history_days", DEFAULT_DEMAND_HISTORY_DAYS),
+            demand_hourly_days=entry.data.get("demand_hourly_days", DEFAULT_DEMAND_HOURLY_DAYS),
+            demand_engine=entry.data.get("demand_engine", DEFAULT_DEMAND_ENGINE),
+            period_minutes=int(entry.data.get("period_minutes", DEFAULT_PERIOD_MINUTES)))     
 
     async def async_close(self):
         """Close the aiohttp session and the API."""
+        if self._unsub_setpoint_timer is not None:
+            self._unsub_setpoint_timer()
+            self._unsub_setpoint_timer = None
+        for unsub in self._unsub_state_listeners:
+            unsub()
+        self._unsub_state_listeners = []
         await self._session.close()
         await self.api.async_close()
 
@@ -147,14 +185,79 @@ class PVControllerUpdateCoordinator(DataUpdateCoordinator):
     async def async_initialize(self):
         self.soc_safety_margin = await async_get_value_from_store(
             self.store_user_inputs, "user_soc_safety_margin", 10)
+        self._unsub_setpoint_timer = async_track_time_interval(
+            self._hass, self.async_update_setpoint, SETPOINT_UPDATE_INTERVAL)
+
+        # The SoC and the minimum SoC are read once and then kept up to date by their state changes
+        await self.get_current_soc()
+        security_min_soc = self.get_sensor_float(self.security_min_soc_sensor)
+        if security_min_soc is not None:
+            self.current_security_min_soc = security_min_soc
+        self._unsub_state_listeners.append(async_track_state_change_event(
+            self._hass, [self.battery_soc_sensor], self.async_on_soc_change))
+        if self.security_min_soc_sensor:
+            self._unsub_state_listeners.append(async_track_state_change_event(
+                self._hass, [self.security_min_soc_sensor], self.async_on_security_min_soc_change))
+        self._unsub_state_listeners.append(async_track_state_change_event(
+            self._hass, [self.pvpc_buy_entity, self.pvpc_sell_entity], self.async_on_prices_change))
+
+    async def request_target_socs_update(self):
+        """Request an update of the coordinator that recalculates the target SoCs."""
+        # Kept apart from the cascade update of the first minute: it is cleared once the calculation
+        # is attempted, even if it fails, so that it neither blocks the cascade nor forces every update
+        self._recalc_requested = True
+        await self.async_request_refresh()
+
+    async def async_on_soc_change(self, event):
+        """Keep the current SoC and request an update if it deviates from the SoC of the last calculation."""
+        soc = self.state_to_float(event.data.get("new_state"))
+        if soc is None or soc == self.current_soc:
+            return
+        self.current_soc = soc
+        await self.api.set_current_initial_soc(soc)
+        last_calc_soc_Wh = self.api._last_calc_initial_soc_Wh
+        if last_calc_soc_Wh is None:
+            return
+        soc_deviation = abs(100 * last_calc_soc_Wh / self._entry.data["battery_capacity_Wh"] - soc)
+        if soc_deviation > SOC_PERCENT_DEVIATION_FORCE_RECALC:
+            # need_new_target_socs detects the deviation, the update does not need to be forced
+            self.logger.debug(f"SoC deviation of {soc_deviation:.2f}% from the last calculation, requesting an update")
+            await self.async_request_refresh()
+
+    async def async_on_security_min_soc_change(self, event):
+        """Keep the minimum SoC of the inverter and recalculate the target SoCs if the minimum SoC changes."""
+        security_min_soc = self.state_to_float(event.data.get("new_state"))
+        if security_min_soc is None or security_min_soc == self.current_security_min_soc:
+            return
+        self.current_security_min_soc = security_min_soc
+        previous_min_soc = self.current_min_soc
+        await self.update_current_min_soc()
+        if self.current_min_soc != previous_min_soc:
+            await self.request_target_socs_update()
+
+    async def async_on_prices_change(self, event):
+        """Recalculate the target SoCs when the prices of an ESIOS entity change (not only its current price)."""
+        new_state = event.data.get("new_state")
+        if new_state is None:
+            return
+        old_state = event.data.get("old_state")
+        desired_keys = await self.pvpc_desired_keys()
+        new_prices = {key: new_state.attributes.get(key) for key in desired_keys}
+        old_prices = {key: old_state.attributes.get(key) for key in desired_keys} if old_state is not None else None
+        if new_prices != old_prices:
+            self.logger.debug(f"New prices in {new_state.entity_id}, requesting the recalculation of the target SoCs")
+            await self.request_target_socs_update()
+
+    async def async_update_setpoint(self, now=None):
+        """Update the setpoint between the coordinator updates and notify the sensors if it changes."""
+        previous_setpoint_W = self.proposed_setpoint_W
+        await self.update_proposed_setpoint()
+        if self.proposed_setpoint_W != previous_setpoint_W:
+            self.async_update_listeners()
         
         
     async def update_current_min_soc(self):
-        """Update the current minimum SoC value."""
-        if self.security_min_soc_sensor is not None:
-            states=self._hass.states.get(self.security_min_soc_sensor)
-            if states is not None:
-                self.current_security_min_soc = float(states.state)
+        """Update the current minimum SoC value (the minimum SoC of the inverter is kept by its state changes)."""
         if self.current_security_min_soc is None:
             self.current_security_min_soc = 0
         self.current_min_soc = max(self.current_security_min_soc, self.user_min_soc) \
@@ -174,28 +277,96 @@ class PVControllerUpdateCoordinator(DataUpdateCoordinator):
         # Update the setpoint
         await self.update_proposed_setpoint()
 
-        # Get the current SoC value
-        await self.get_current_soc()
+        # The current SoC is kept by its state changes, it is only read while there is no value
+        if self.current_soc is None:
+            await self.get_current_soc()
+
+        # In the first minute of the hour, start cascade update all the API data
+        if self._skip_update >= 2 and current_datetime.minute == 0 and self.force_updates_step == 0:
+            self.force_updates_step = 1
+            self._skip_update += 2
+            self.logger.debug(f"Force first minute update: {current_datetime}")
+
+        # Dependency graph of the update stages: name -> (coroutine function, stages it depends on)
+        # Independent stages (prices, Forecast.Solar, InfluxDB...) run concurrently
+        stages = {
+            "buy_prices": (lambda: self.async_update_buy_prices(current_datetime), []),
+            "sell_prices": (lambda: self.async_update_sell_prices(current_datetime), [])
+        }
+        # Make the startup lighter by staggering costly processes
+        if self._skip_update >= 2:
+            stages.update({
+                "forecast_solar": (lambda: self.async_update_forecast_solar(current_datetime), []),
+                "influxdb": (self.async_update_influxdb, []),
+                "effective_forecast_solar": (self.async_update_effective_forecast_solar, ["forecast_solar", "influxdb"]),
+                # Set the true minimum SoC to be used in the calculation
+                "min_soc": (self.update_current_min_soc, [])
+            })
+        if self._skip_update >= 3:
+            stages["predictions"] = (lambda: self.async_update_predictions(current_datetime), ["influxdb"])
+        if self._skip_update >= 4:
+            stages["target_socs"] = (lambda: self.async_update_target_socs(current_datetime), \
+                ["buy_prices", "sell_prices", "effective_forecast_solar", "min_soc", "predictions"])
+
+        await self.async_run_stages(stages)
 
-        # Get buy prices
-        self.buy_prices_rawdata = await self.get_esios_sensor_dict(self.pvpc_buy_entity)      
-        self.buy_prices_useful_dict, self.current_buy_price = \
-            await pvpc_raw_to_useful_dict(self.buy_prices_rawdata, current_datetime) 
-        if self.buy_prices_useful_dict is not None:
-            await self.api.set_dict_pvpc_buy_prices(self.buy_prices_useful_dict)
+        # Make the startup lighter by staggering costly processes
+        if self._skip_update < 4:
+            self._skip_update += 1
+            return
+
+        if self.force_updates_step == 4 and current_datetime.minute != 0:
+            self.force_updates_step = 0
+            self.logger.debug(f"End of force first minute update: {current_datetime}")
+        # Temporary values read from the API
+        self.target_socs_last_update = self.api._target_socs_last_update                 
+
+    async def async_run_stages(self, stages: dict) -> dict:
+        """
+        Run the update stages as a dependency graph.
+        Each stage starts as soon as the stages it depends on have finished, so independent stages run concurrently.
+        Dependencies that are not in stages (skipped at startup) are considered satisfied.
+        """
+        tasks = {}
+
+        async def run_stage(name):
+            func, dependencies = stages[name]
+            await asyncio.gather(*(tasks[d] for d in dependencies if d in tasks))
+            try:
+                # Each stage has its own timeout, a slow source does not block the rest of the update
+                async with async_timeout.timeout(COORDINATOR_STAGE_TIMEOUTS.get(name, 60)):
+                    return await func()
+            except asyncio.TimeoutError:
+                self.logger.warning(f"Timeout in the update stage {name}")
+            except Exception as e:
+                self.logger.error(f"Error in the update stage {name}: {e}")
+            return None
+
+        # All the tasks are created before any of them runs, so every dependency is found in tasks
+        for name in stages:
+            tasks[name] = asyncio.create_task(run_stage(name))
+        results = await asyncio.gather(*tasks.values())
+        return dict(zip(tasks.keys(), results))
+
+    async def async_update_buy_prices(self, current_datetime):
+        """Get buy prices."""
+        self.buy_prices_series, self.current_buy_price = \
+            await self.get_esios_prices(self.pvpc_buy_entity, current_datetime)
+        if self.buy_prices_series is not None:
+            await self.api.set_pvpc_buy_prices(self.buy_prices_series)
         else:
             self.logger.warning("Buy prices could not be obtained")
         if self.current_buy_price is not None:
             self.logger.debug(f"The buy price is: {self.current_buy_price}")
         else:
             self.logger.warning("The buy price could not be obtained")
-        
-        # Get sell prices
-        self.sell_prices_rawdata = await self.get_esios_sensor_dict(self.pvpc_sell_entity)      
-        self.sell_prices_useful_dict, self.current_sell_price = \
-            await pvpc_raw_to_useful_dict(self.sell_prices_rawdata, current_datetime)         
-        if self.sell_prices_useful_dict is not None:
-            await self.api.set_dict_pvpc_sell_prices(self.sell_prices_useful_dict)
+
+    async def async_update_sell_prices(self, current_datetime):
+        """Get sell prices."""
+        self.sell_prices_series, self.current_sell_price = \
+            await self.get_esios_prices(self.pvpc_sell_entity, current_datetime)
+        if self.sell_prices_series is not None:
+            await self.api.set_pvpc_sell_prices(self.sell_prices_series)
         else:
             self.logger.warning("Sell prices could not be obtained")
         if self.current_sell_price is not None:
@@ -203,96 +374,63 @@ class PVControllerUpdateCoordinator(DataUpdateCoordinator):
         else:
             self.logger.warning("The sell price could not be obtained")
 
-        # Make the startup lighter by staggering costly processes
-        if self._skip_update == 1:
-            self._skip_update += 1
-            return
-
-        # Get estimated solar production data for the next 12 hours
+    async def async_update_forecast_solar(self, current_datetime):
+        """Get estimated solar production data for the next hours."""
         self.forecast_solar_rawdata, self.forecast_solar_last_update = await self.fetch_forecast_solar_data()
 
-        # Convert Forecast.Solar data to a continuous dictionary
-        await self.make_forecast_solar_useful_dict(current_datetime)
+        # Convert Forecast.Solar data to a continuous HourlySeries
+        await self.make_forecast_solar_series(current_datetime)
         
         # Update the value in the API
-        await self.api.set_dict_forecast_solar(self.forecast_solar_useful_dict)
+        await self.api.set_forecast_solar(self.forecast_solar_series)
 
-        # In the first minute of the hour, start cascade update all the API data
-        if current_datetime.minute == 0 and self.force_updates_step == 0:
-            self.force_updates_step = 1
-            self._skip_update += 2
-            self.logger.debug(f"Force first minute update: {current_datetime}")
- 
-        # Request the API to get consumption data from InfluxDB
+    async def async_update_influxdb(self):
+        """Request the API to get consumption data from InfluxDB."""
         if await self.api.update_influxdb(self.force_updates_step == 1):
             self.influx_last_update = self.api.influx_last_update
             if self.force_updates_step == 1:
                 self.logger.debug(f"Force first minute update step: {self.force_updates_step}")
                 self.force_updates_step = 2
 
-        # Request the API to calculate self._dict_effective_forecast_solar
+    async def async_update_effective_forecast_solar(self):
+        """Request the API to calculate self.effective_forecast_solar."""
         if await self.api.make_effective_forecast_solar():
-            self.effective_forecast_solar_useful_dict = self.api.dict_effective_forecast_solar
+            self.effective_forecast_solar_series = self.api.effective_forecast_solar
             self.fore_to_real_dict = self.api.fore_to_real_dict
 
-        # # Get the SoC value from the API
-        # soc = await self.api.read_soc_from_influxdb()
-        # if soc is not None and self.current_soc != soc:
-        #     # Update the SoC value
-        #     self.current_soc = soc
-        #     await self.api.set_current_initial_soc(soc) 
-        #     self.logger.debug(f"The current SoC is: {self.current_soc}%")
-
-        # # Get the Security minSoC value from the API
-        # minsoc = await self.api.read_minsoc_from_influxdb()
-        # if minsoc is not None and self.current_security_min_soc != minsoc:
-        #     # Update the current_security_min_soc value
-        #     self.current_security_min_soc = minsoc
-
-        # Set the true minimum SoC to be used in the calculation
-        await self.update_current_min_soc()
-           
-
-        # Make the startup lighter by staggering costly processes
-        if self._skip_update == 2:
-            self._skip_update += 1
-            return
-
-        # Request the API to make predictions
+    async def async_update_predictions(self, current_datetime):
+        """Request the API to make predictions."""
         if await self.api.make_predictions(current_datetime, self.force_updates_step == 2):
             if self.force_updates_step == 2:
                 self.logger.debug(f"Force first minute update step: {self.force_updates_step}")
                 self.force_updates_step = 3            
             # Update prediction values
-            if self.predicted_demand != self.api.dict_demand_prophet_predictions:
+            if self.predicted_demand != self.api.demand_prophet_predictions:
                 self.logger.debug("Predictions updated")
-                self.predicted_demand = self.api.dict_demand_prophet_predictions
+                self.predicted_demand = self.api.demand_prophet_predictions
                 self.predicted_demand_current_hour = self.api.demand_prophet_current_hour_prediction
                 self.predicted_demand_next_hour = self.api.demand_prophet_next_hour_prediction    
 
-        # Make the startup lighter by staggering costly processes
-        if self._skip_update == 3:
-            self._skip_update += 1
-            return
-
-        # Request the API to calculate target_socs
-        if await self.api.make_target_socs(current_datetime, self.force_updates_step == 3):
+    async def async_update_target_socs(self, current_datetime):
+        """Request the API to calculate target_socs."""
+        force = self.force_updates_step == 3 or self._recalc_requested
+        self._recalc_requested = False
+        if await self.api.make_target_socs(current_datetime, force):
             if self.force_updates_step == 3:
                 self.logger.debug(f"Force make_target_socs, step: {self.force_updates_step}")
                 self.force_updates_step = 4             
             # Update target_socs values
-            if self.target_socs != self.api.dict_target_socs:
-                self.target_socs = self.api.dict_target_socs
+            # With sub-hourly periods the target of the current period changes in every update
+            if self.target_socs != self.api.target_socs or self.api.period_minutes < 60:
+                self.target_socs = self.api.target_socs
                 self.target_soc_current_hour = self.api.target_soc_current_hour
                 self.pulp_json_results= self.api.pulp_json_results
                 self.pulp_parameters = self.api.pulp_parameters             
                 self.used_last_target_soc = False
-
-        if self.force_updates_step == 4 and current_datetime.minute != 0:
-            self.force_updates_step = 0
-            self.logger.debug(f"End of force first minute update: {current_datetime}")
-        # Temporary values read from the API
-        self.target_socs_last_update = self.api._target_socs_last_update                 
+            # Follow the plan of the new calculation
+            if self.api.pulp_json_results is not None and self.api.pulp_json_results is not self.setpoint_controller.results:
+                self.setpoint_controller.set_plan(self.api.pulp_json_results, self.api.pulp_results_datetime,
+                                                  self.api.period_minutes, self.api._last_calc_initial_soc_Wh)
 
         
     @property
@@ -329,6 +467,35 @@ class PVControllerUpdateCoordinator(DataUpdateCoordinator):
 
         
 
+    def get_sensor_float(self, entity_id: str | None) -> float | None:
+        """Return the numeric state of a sensor, or None if it is not available."""
+        if not entity_id:
+            return None
+        return self.state_to_float(self._hass.states.get(entity_id))
+
+    @staticmethod
+    def state_to_float(state) -> float | None:
+        """Return the numeric value of a state, or None if it is not available."""
+        try:
+            return float(state.state)
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    async def get_esios_prices(self, esios_sensor_name, current_datetime) -> tuple[HourlySeries | None, float | None]:
+        """
+        Return the prices of the PVPC sensor from the current hour and the current price.
+        The attributes are only parsed when the sensor changes (or the day changes), the rest of the updates slice the series.
+        """
+        esios_sensor = self._hass.states.get(esios_sensor_name)
+        if not esios_sensor:
+            return None, None
+        key = (esios_sensor.last_updated, current_datetime.date())
+        cached = self._esios_prices.get(esios_sensor_name)
+        if cached is None or cached[0] != key:
+            cached = (key, pvpc_raw_to_day_series(await self.get_esios_sensor_dict(esios_sensor_name), current_datetime))
+            self._esios_prices[esios_sensor_name] = cached
+        return pvpc_series_from_hour(cached[1], current_datetime)
+
     async def get_esios_sensor_dict(self, esios_sensor_name) -> dict | None:
         """
         Return today's and tomorrow's prices from the PVPC sensor with keys
@@ -452,18 +619,18 @@ class PVControllerUpdateCoordinator(DataUpdateCoordinator):
 
         await self.store.async_save(data)
 
-    async def make_forecast_solar_useful_dict(self, current_datetime):
-        """Convert Forecast.Solar data to a continuous dictionary starting at the current hour."""
+    async def make_forecast_solar_series(self, current_datetime):
+        """Convert Forecast.Solar data to a continuous HourlySeries starting at the current hour."""
         try:
-            self.forecast_solar_useful_dict, self.forecast_solar_energy_next_hour = \
-                await forecast_solar_api_to_dict(self.forecast_solar_rawdata, current_datetime)
+            self.forecast_solar_series, self.forecast_solar_energy_next_hour = \
+                await forecast_solar_api_to_series(self.forecast_solar_rawdata, current_datetime)
             # Here we need to see how to use self.enable_fore_to_real_correction
             # When are the corrections applied? To display them directly in the UI or only in the API
 
             self.logger.debug(f"The estimated solar production for the next hour is: {self.forecast_solar_energy_next_hour}")
             return True
         except Exception as e:
-            self.forecast_solar_useful_dict = None
+            self.forecast_solar_series = None
             self.forecast_solar_energy_next_hour = None
             self.logger.error(f"Error converting Forecast.Solar data: {e}")
             return False
@@ -488,6 +655,13 @@ class PVControllerUpdateCoordinator(DataUpdateCoordinator):
         if self.current_soc is None or self.target_soc_current_hour is None:
             self.proposed_setpoint_W = self.max_setpoint_W
             return
+
+        # La consigna sigue la energía de red planificada en el periodo actual, corregida con el SoC y la
+        # potencia de red medidos. Sin plan para este momento se usa la regla anterior (10 W o la potencia máxima)
+        setpoint_W = self.setpoint_controller.update(datetime.now(), self.current_soc, self.get_sensor_float(self.grid_power_sensor))
+        if setpoint_W is not None:
+            self.proposed_setpoint_W = setpoint_W
+            return
         
         if self.current_soc >= self.target_soc_current_hour:
             self.proposed_setpoint_W=10
@@ -0,0 +1,136 @@
+import logging
+import asyncio
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class InfluxHistoryCache:
+    """
+    Persistent per-entity cache of the hourly energy values read from InfluxDB.
+    For each entity it keeps a DataFrame indexed by the UTC time (naive) of each complete hour
+    with the column 'energy_kWh' (the value returned by SELECT last("value") ... GROUP BY time(1h)).
+    The UTC index keeps both hours when the clocks go back, get() converts it to local time.
+    Only the hours after the last cached one are requested to InfluxDB.
+    """
+
+    def __init__(self, store=None) -> None:
+        """Initialize the cache. store is a HourlySeriesStore (or None to keep the cache only in memory)."""
+        self._store = store
+        self._loaded = False
+        # Serialize the updates of the cache (several queries may be refreshing it at the same time)
+        self.lock = asyncio.Lock()
+        # entity_id -> DataFrame with the column 'energy_kWh'
+        self._frames: dict[str, pd.DataFrame] = {}
+        # entity_id -> first datetime requested for the entity (None means all the available history)
+        self._covered_from: dict[str, datetime | None] = {}
+
+    async def async_load(self) -> None:
+        """Load the cached series from persistent storage (only the first time)."""
+        if self._loaded:
+            return
+        self._loaded = True
+        if self._store is None:
+            return
+        try:
+            data = await self._store.async_load()
+        except Exception as e:
+            _LOGGER.warning(f"Error loading the InfluxDB history cache: {e}")
+            return
+        for entity_id, (times, values, covered_from) in data.items():
+            if len(times) == 0:
+                # Nothing cached (or stored by an older version), the entity is queried again from its start
+                continue
+            # Timestamps are stored as epoch seconds of the UTC time
+            index = pd.DatetimeIndex(times.astype('datetime64[s]'), name='time')
+            self._frames[entity_id] = pd.DataFrame({'energy_kWh': values}, index=index)
+            self._covered_from[entity_id] = covered_from
+        _LOGGER.debug(f"InfluxDB history cache loaded for entities: {list(self._frames.keys())}")
+
+    def last_timestamp(self, entity_id) -> datetime | None:
+        """Return the last cached hour (naive UTC) of an entity or None if there is nothing cached."""
+        df = self._frames.get(entity_id)
+        if df is None or df.empty:
+            return None
+        return df.index[-1].to_pydatetime()
+
+    def is_covered(self, entity_id, start=None) -> bool:
+        """Check if the cache of an entity contains the history from start."""
+        if entity_id not in self._frames:
+            return False
+        covered_from = self._covered_from.get(entity_id)
+        if covered_from is None:
+            # All the available history was requested
+            return True
+        if start is None:
+            return False
+        return pd.to_datetime(start) >= covered_from
+
+    async def async_replace(self, entity_id, df: pd.DataFrame, start=None, current_hour: datetime | None = None) -> None:
+        """Replace the cached series of an entity with the complete hours of a full query."""
+        df = self._complete_hours(df, current_hour)
+        covered_from = pd.to_datetime(start).to_pydatetime() if start is not None else None
+        self._frames[entity_id] = df
+        self._covered_from[entity_id] = covered_from
+        if self._store is not None:
+            await self._store.async_replace(entity_id, self._epoch_seconds(df), df['energy_kWh'].to_numpy(), covered_from)
+
+    async def async_append(self, entity_id, df: pd.DataFrame, current_hour: datetime | None = None) -> int:
+        """Append the complete hours of an incremental query to the cached series. Return the number of new rows."""
+        df = self._complete_hours(df, current_hour)
+        cached = self._frames.get(entity_id)
+        if cached is not None and not cached.empty:
+            # Keep only the rows after the last cached hour
+            df = df[df.index > cached.index[-1]]
+            if df.empty:
+                return 0
+            # fill(previous) can not fill the first hour of an incremental query, use the last cached value
+            df = df.copy()
+            if np.isnan(df.iloc[0, 0]):
+                df.iloc[0, 0] = cached.iloc[-1, 0]
+            df['energy_kWh'] = df['energy_kWh'].ffill()
+            df = pd.concat([cached, df])
+        if df.empty:
+            return 0
+        new_rows = len(df) - (len(cached) if cached is not None else 0)
+        self._frames[entity_id] = df
+        if self._store is not None:
+            # Only the new rows are written (append-only)
+            new_df = df.iloc[-new_rows:]
+            await self._store.async_append(entity_id, self._epoch_seconds(new_df), new_df['energy_kWh'].to_numpy())
+        return new_rows
+
+    def get(self, entity_id, start=None, end=None, timezone=None) -> pd.DataFrame:
+        """
+        Return a copy of the cached series of an entity between start and end (local times of timezone).
+        The index is the naive local time: the hour repeated when the clocks go back appears twice.
+        """
+        df = self._frames.get(entity_id)
+        if df is None or df.empty:
+            return pd.DataFrame()
+        if timezone is not None:
+            df = df.set_axis(df.index.tz_localize('UTC').tz_convert(timezone).tz_localize(None).rename('time'))
+        mask = np.ones(len(df), dtype=bool)
+        if start is not None:
+            mask &= df.index >= pd.to_datetime(start)
+        if end is not None:
+            mask &= df.index <= pd.to_datetime(end)
+        return df[mask].copy()
+
+    @staticmethod
+    def _epoch_seconds(df: pd.DataFrame) -> np.ndarray:
+        """Return the index of a DataFrame as int64 epoch seconds of the UTC time."""
+        return df.index.values.astype('datetime64[s]').astype(np.int64)
+
+    @staticmethod
+    def _complete_hours(df: pd.DataFrame, current_hour: datetime | None) -> pd.DataFrame:
+        """Remove the hour in progress: its last value will change until the hour is complete."""
+        if df is None or df.empty:
+            return pd.DataFrame(columns=['energy_kWh'], dtype=np.float64)
+        df = df[['energy_kWh']]
+        if current_hour is not None:
+            df = df[df.index < current_hour]
+        return df
+
@@ -0,0 +1,121 @@
+import logging
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def epoch_hour(date: datetime) -> int:
+    """Return the number of hours since 1970-01-01 of a naive local datetime (minutes and seconds are discarded)."""
+    return int(np.datetime64(pd.Timestamp(date).to_datetime64(), 'h').astype(np.int64))
+
+
+class HourlySeries:
+    """
+    Compact hourly time series.
+    The series is stored as the naive local time of its first hour, as an int64 epoch hour,
+    plus a float64 array with one value per hour (NaN for the hours without data).
+    Dictionaries with isoformat keys, such as {'2024-10-28T07:00:00': 0.1, ...}, are only used
+    at the boundaries (sensor attributes), so the dates are never parsed again in each update.
+    """
+
+    __slots__ = ("start_hour", "values")
+
+    def __init__(self, start_hour: int, values) -> None:
+        """Initialize the series with the epoch hour of the first value and the values of each hour."""
+        self.start_hour = int(start_hour)
+        self.values = np.asarray(values, dtype=np.float64)
+
+    @classmethod
+    def from_start(cls, start: datetime, values) -> "HourlySeries":
+        """Create a series whose first value corresponds to the hour of start."""
+        return cls(epoch_hour(start), values)
+
+    @classmethod
+    def from_index(cls, index: pd.DatetimeIndex, values) -> "HourlySeries":
+        """
+        Create a series from a naive DatetimeIndex and its values.
+        The dates are truncated to the hour and the missing hours are filled with NaN.
+        The values of the same hour are added: when the clocks go back the repeated local hour
+        holds the energy of both hours instead of overwriting one of them.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if len(index) == 0:
+            return cls(0, np.empty(0, dtype=np.float64))
+        hours = index.values.astype('datetime64[h]').astype(np.int64)
+        start = hours.min()
+        offsets = hours - start
+        length = int(hours.max() - start + 1)
+        series_values = np.zeros(length, dtype=np.float64)
+        np.add.at(series_values, offsets, values)
+        series_values[np.bincount(offsets, minlength=length) == 0] = np.nan
+        return cls(start, series_values)
+
+    @property
+    def start(self) -> datetime:
+        """Return the naive local datetime of the first hour."""
+        return np.datetime64(self.start_hour, 'h').astype('datetime64[s]').astype(datetime)
+
+    @property
+    def index(self) -> pd.DatetimeIndex:
+        """Return the naive local datetimes of each hour."""
+        hours = np.arange(self.start_hour, self.start_hour + len(self.values), dtype=np.int64)
+        return pd.DatetimeIndex(hours.astype('datetime64[h]').astype('datetime64[s]'))
+
+    def hours_of_day(self) -> np.ndarray:
+        """Return the hour of the day (0-23) of each value."""
+        return (np.arange(self.start_hour, self.start_hour + len(self.values), dtype=np.int64)) % 24
+
+    def slice_from(self, date: datetime) -> "HourlySeries":
+        """Return the part of the series from the hour of date."""
+        offset = max(epoch_hour(date) - self.start_hour, 0)
+        return HourlySeries(self.start_hour + offset, self.values[offset:])
+
+    def value_at(self, date: datetime) -> float | None:
+        """Return the value for the hour of date or None if there is no value for that hour."""
+        offset = epoch_hour(date) - self.start_hour
+        if offset < 0 or offset >= len(self.values) or np.isnan(self.values[offset]):
+            return None
+        return float(self.values[offset])
+
+    def fill_gaps(self) -> "HourlySeries":
+        """
+        Return the series with the NaN hours filled: linear interpolation between the known values and the
+        nearest known value at the ends (e.g. the local hour that does not exist when the clocks go forward).
+        A series without any known value is returned unchanged.
+        """
+        valid = np.isfinite(self.values)
+        if valid.all() or not valid.any():
+            return self
+        positions = np.arange(len(self.values))
+        return self.with_values(np.interp(positions, positions[valid], self.values[valid]))
+
+    def with_values(self, values) -> "HourlySeries":
+        """Return a series with the same hours and other values."""
+        return HourlySeries(self.start_hour, values)
+
+    def to_list(self) -> list[float]:
+        """Return the values as a list of floats."""
+        return self.values.tolist()
+
+    def to_dict(self) -> dict[str, float]:
+        """Return the series as a dictionary with isoformat keys, e.g. {'2024-10-28T07:00:00': 0.1, ...}."""
+        keys = np.datetime_as_string(
+            np.arange(self.start_hour, self.start_hour + len(self.values), dtype=np.int64).astype('datetime64[h]'),
+            unit='s')
+        return dict(zip(keys.tolist(), self.values.tolist()))
+
+    def __len__(self) -> int:
+        """Return the number of hours of the series."""
+        return len(self.values)
+
+    def __eq__(self, other) -> bool:
+        """Compare two series (NaN values are considered equal)."""
+        if not isinstance(other, HourlySeries):
+            return NotImplemented
+        return self.start_hour == other.start_hour and np.array_equal(self.values, other.values, equal_nan=True)
+
+    def __repr__(self) -> str:
+        """Return a short representation of the series."""
+        return f"HourlySeries(start={self.start.isoformat()}, values={self.values.tolist()})"
@@ -0,0 +1,104 @@
+import logging
+import json
+import numpy as np
+
+_LOGGER = logging.getLogger(__name__)
+
+# Number of points per chunk requested to InfluxDB with chunked=true
+INFLUX_CHUNK_SIZE = 10000
+
+
+class _SeriesBuffer:
+    """Preallocated NumPy arrays where the rows of a series are written chunk by chunk."""
+
+    def __init__(self, columns: list[str], capacity: int) -> None:
+        """Initialize the buffer for the columns of a series (the first one is the epoch time)."""
+        self.columns = columns
+        self.rows = 0
+        self.times = np.empty(capacity, dtype=np.int64)
+        self.values = np.empty((capacity, len(columns) - 1), dtype=np.float64)
+
+    def append(self, rows: list[list]) -> None:
+        """Write the rows of a chunk at the end of the buffer."""
+        n = len(rows)
+        if n == 0:
+            return
+        end = self.rows + n
+        if end > len(self.times):
+            # Grow the arrays doubling their capacity (amortized O(1) per row)
+            capacity = max(end, 2 * len(self.times))
+            self.times = np.resize(self.times, capacity)
+            self.values = np.resize(self.values, (capacity, self.values.shape[1]))
+        self.times[self.rows:end] = np.fromiter((row[0] for row in rows), dtype=np.int64, count=n)
+        for j in range(self.values.shape[1]):
+            # InfluxDB returns null for empty values, store them as NaN
+            self.values[self.rows:end, j] = np.fromiter(
+                (np.nan if row[j + 1] is None else row[j + 1] for row in rows), dtype=np.float64, count=n)
+        self.rows = end
+
+    def result(self) -> tuple[list[str], np.ndarray, np.ndarray]:
+        """Return the columns, the epoch times and the values written in the buffer."""
+        return self.columns, self.times[:self.rows], self.values[:self.rows]
+
+
+class InfluxChunkParser:
+    """
+    Incremental parser of the responses of the InfluxDB /query endpoint.
+    With chunked=true InfluxDB sends one JSON object per line, each one with a chunk of the values,
+    so only one chunk is decoded at a time and the values are copied to preallocated NumPy arrays.
+    The query must be made with epoch=s so that the times are integers.
+    """
+
+    def __init__(self, capacity: int = INFLUX_CHUNK_SIZE) -> None:
+        """Initialize the parser."""
+        self._capacity = capacity
+        self._pending = bytearray()
+        self._buffers: dict[int, _SeriesBuffer] = {}
+        # Errors returned by InfluxDB by statement_id (-1 for an error of the whole request)
+        self.errors: dict[int, str] = {}
+
+    def feed(self, data: bytes) -> None:
+        """Feed bytes of the response and decode the complete lines."""
+        self._pending.extend(data)
+        start = 0
+        while True:
+            end = self._pending.find(b"\n", start)
+            if end < 0:
+                break
+            self._parse_line(self._pending[start:end])
+            start = end + 1
+        del self._pending[:start]
+
+    def close(self) -> dict[int, tuple[list[str], np.ndarray, np.ndarray]]:
+        """
+        Decode the remaining bytes and return the results by statement_id:
+        statement_id -> (columns, epoch times, values)
+        Raise ValueError if InfluxDB returned an error for the whole request.
+        The errors of each statement are kept in self.errors.
+        """
+        self._parse_line(self._pending)
+        self._pending = bytearray()
+        if -1 in self.errors:
+            raise ValueError(f"InfluxDB error: {self.errors[-1]}")
+        return {statement_id: buffer.result() for statement_id, buffer in self._buffers.items()}
+
+    def _parse_line(self, line: bytes) -> None:
+        """Decode one JSON object of the response."""
+        line = bytes(line).strip()
+        if not line:
+            return
+        chunk = json.loads(line)
+        if "error" in chunk:
+            self.errors[-1] = chunk["error"]
+            return
+        for result in chunk.get("results", []):
+            statement_id = result.get("statement_id", 0)
+            if "error" in result:
+                self.errors[statement_id] = result["error"]
+                continue
+            for series in result.get("series", []):
+                buffer = self._buffers.get(statement_id)
+                if buffer is None:
+                    buffer = _SeriesBuffer(series["columns"], self._capacity)
+                    self._buffers[statement_id] = buffer
+                buffer.append(series.get("values", []))
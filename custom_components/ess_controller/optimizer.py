@@ -0,0 +1,664 @@
+import logging
+from typing import NamedTuple
+import numpy as np
+import pulp
+from .const import BATTERY_EOL_CYCLES_IF_MIN_SOC_20, BATTERY_EOL_CYCLES_IF_MIN_SOC_50
+
+try:
+    import highspy
+except ImportError:
+    highspy = None
+
+_LOGGER = logging.getLogger(__name__)
+
+# Number of SoC steps in the battery capacity of the dynamic programming engine. The time grows with the square
+# of the levels, the objective gap with the LP halves when they are doubled (see the README)
+DP_SOC_LEVELS = 1000
+
+# Scenarios of the stochastic engine
+STOCHASTIC_SCENARIOS = 10
+# Correlation of the forecast errors of consecutive hours (the errors persist for several hours)
+FORECAST_ERROR_CORRELATION = 0.8
+# Half width (standard deviations) of the 80% uncertainty interval, the default interval of Prophet
+INTERVAL_Z = 1.2816
+# Relative half width of the 80% interval of the solar forecast, and of the demand forecast without interval
+SOLAR_FORECAST_INTERVAL = 0.3
+DEMAND_FORECAST_INTERVAL = 0.25
+
+# Models of the SoC schedule kept for reuse (one for each number of periods and installation parameters)
+SOC_MODELS_MAX = 8
+
+
+class ScheduleSolution(NamedTuple):
+    """Solution of the SoC schedule (energies in Wh of each hour)."""
+    status: str
+    objective: float | None
+    energy_from_grid: list[float]
+    energy_to_grid: list[float]
+    energy_to_battery: list[float]
+    energy_from_battery: list[float]
+    soc: list[float]
+
+
+def battery_energy_price(battery_purchase_price: float, battery_capacity: float, min_soc: float,
+                         eol_cycles_if_min_soc_20: float = BATTERY_EOL_CYCLES_IF_MIN_SOC_20,
+                         eol_cycles_if_min_soc_50: float = BATTERY_EOL_CYCLES_IF_MIN_SOC_50) -> float:
+    """
+    Return the cost (€/kWh) of the energy provided by the battery.
+    The battery lifetime at min_soc is estimated by linear interpolation between 20% and 50%.
+    """
+    min_soc_percent = min_soc / battery_capacity * 100  # %
+    battery_eol_cycles_current_min_soc = eol_cycles_if_min_soc_20 + \
+        (eol_cycles_if_min_soc_50 - eol_cycles_if_min_soc_20) * (min_soc_percent - 20) / 30  # cycles
+    # In its lifetime, the battery can provide:
+    all_live_energy = (battery_eol_cycles_current_min_soc * battery_capacity * (100 - min_soc_percent) / 100) / 1000  # kWh of energy
+    # Therefore, the cost of the energy from battery is battery_purchase_price / all_live_energy €/kWh
+    return battery_purchase_price / all_live_energy
+
+
+def final_soc_weight(demand: list[float], solar_production: list[float], buy_prices: list[float]) -> float:
+    """
+    Return the weight w given in the objective function to maximize the final SoC
+    versus minimizing the cost of purchased energy.
+    When solar production is greater than demand, maximizing the SoC is prioritized.
+    """
+    average_price = sum(buy_prices) / len(buy_prices)
+    if sum(solar_production) >= sum(demand):
+        return 2 * average_price / 1000
+    return average_price / 1000
+
+
+def first_period_min_soc(initial_soc: float, min_soc: float, demand_0: float, solar_production_0: float,
+                         max_charge_energy_first_period: float, max_buy_energy_first_period: float,
+                         charge_efficiency: float) -> float:
+    """Return the minimum SoC at the end of the first period."""
+    # NOTE: THE PROBLEM IS SOLVED CORRECTLY EVEN IF initial_soc < min_soc
+    if initial_soc < min_soc:
+        # How much energy can be sent to the battery in the first period if the initial SoC is less than min_soc?
+        max_energy_available = max(max_buy_energy_first_period + solar_production_0 - demand_0, 0)
+        max_energy_to_battery = min(max_charge_energy_first_period, max_energy_available * charge_efficiency)
+        # Try to recover the SoC as quickly as possible if it is below min_soc
+        return initial_soc + max_energy_to_battery
+    # Require that the SoC does not fall below the minimum allowed
+    return min_soc
+
+
+def hourly_to_periods(values: list[float], periods_per_hour: int, skip: int = 0, energy: bool = True) -> list[float]:
+    """
+    Return the hourly values split into periods_per_hour periods per hour, without the first skip periods.
+    The energies are divided equally between the periods of the hour, the prices are repeated.
+    """
+    periods = np.repeat(np.asarray(values, dtype=np.float64), periods_per_hour)
+    if energy:
+        periods = periods / periods_per_hour
+    return periods[skip:].tolist()
+
+
+def solve_soc_schedule_dp(demand: list[float], solar_production: list[float], buy_prices: list[float], sell_prices: list[float],
+                          initial_soc: float, min_soc: float, first_period_fraction: float,
+                          battery_energy_price: float, w: float, battery_capacity: float,
+                          max_charge_energy_per_period: float, max_discharge_energy_per_period: float,
+                          max_buy_energy_per_period: float, charge_efficiency: float, discharge_efficiency: float,
+                          levels: int = DP_SOC_LEVELS) -> ScheduleSolution:
+    """
+    Solve the same problem as SocScheduleModel with dynamic programming over discretized SoC levels.
+    The SoC moves on a grid of steps of battery_capacity / levels anchored at the initial SoC,
+    so the cost of each hour only depends on the number of steps charged or discharged.
+    Each hour is then a min-plus convolution of the accumulated cost with a short cost vector.
+    The minimum SoC is rounded up to the grid and the energies of each hour are multiples of the step, so the
+    objective is worse than the LP one: with DP_SOC_LEVELS levels, by 0.3% (hourly periods) to 0.8% (periods of 5 minutes).
+    """
+    n = min(len(demand), len(solar_production), len(buy_prices), len(sell_prices))
+    infeasible = ScheduleSolution("Infeasible", None, [], [], [], [], [])
+    eps = 1e-9
+    if initial_soc < -eps or initial_soc > battery_capacity + eps:
+        return infeasible
+    demand = np.asarray(demand[:n], dtype=np.float64)
+    solar_production = np.asarray(solar_production[:n], dtype=np.float64)
+    buy_prices = np.asarray(buy_prices[:n], dtype=np.float64)
+    sell_prices = np.asarray(sell_prices[:n], dtype=np.float64)
+
+    # Limits of each hour (the first one only for the time remaining until the end of the hour)
+    fractions = np.ones(n)
+    fractions[0] = first_period_fraction
+    max_charge = max_charge_energy_per_period * fractions
+    max_discharge = max_discharge_energy_per_period * fractions
+    max_buy = max_buy_energy_per_period * fractions
+
+    # SoC levels: initial_soc + step * m, with m between m_min and m_max (inside [0, battery_capacity])
+    step = battery_capacity / levels
+    m_min = -int(np.floor(initial_soc / step + eps))
+    m_max = int(np.floor((battery_capacity - initial_soc) / step + eps))
+    soc_levels = initial_soc + step * np.arange(m_min, m_max + 1)
+    num_levels = len(soc_levels)
+    initial_level = -m_min
+
+    # Lowest level allowed at the end of each hour
+    lower = np.full(n, int(np.ceil((min_soc - initial_soc) / step - eps)))
+    if initial_soc < min_soc:
+        # The SoC has to be recovered as much as possible in the first hour (rounded down, it is the maximum)
+        min_soc_0 = first_period_min_soc(initial_soc, min_soc, demand[0], solar_production[0],
+                                         max_charge[0], max_buy[0], charge_efficiency)
+        lower[0] = int(np.floor((min_soc_0 - initial_soc) / step + eps))
+    lower = lower - m_min
+    # Require that the SoC at the last period is greater than the initial SoC
+    lower[-1] = max(lower[-1], initial_level)
+
+    # Cost of charging (k > 0) or discharging (k < 0) k steps in each hour, for all the hours at once
+    band = int(np.floor(max(max_charge_energy_per_period, max_discharge_energy_per_period) / step + eps))
+    band = min(band, num_levels - 1)
+    steps = np.arange(-band, band + 1)
+
+    def hour_energies(i, delta):
+        """Return the energies of hours i when the SoC changes by delta."""
+        to_battery = np.maximum(delta, 0)
+        from_battery = np.maximum(-delta, 0)
+        # Global energy balance: energy that has to be bought (>0) or sold (<0)
+        net = demand[i] - solar_production[i] + to_battery / charge_efficiency - from_battery * discharge_efficiency
+        # Unusual case: if the sold energy is paid more than the bought one, buy as much as possible
+        from_grid = np.where(buy_prices[i] >= sell_prices[i], np.maximum(net, 0), max_buy[i])
+        to_grid = from_grid - net
+        return from_grid, to_grid, to_battery, from_battery
+
+    hours = np.arange(n)[:, None]
+    delta = steps[None, :] * step
+    from_grid, to_grid, to_battery, from_battery = hour_energies(hours, delta)
+    cost = (from_grid * buy_prices[hours] - to_grid * sell_prices[hours]
+            + (from_battery - to_battery) * battery_energy_price) / 1000
+    feasible = (to_battery <= max_charge[hours] + eps) & (from_battery <= max_discharge[hours] + eps) \
+        & (from_grid <= max_buy[hours] + eps) & (to_grid >= -eps)
+    # Reversed so that the position t of a window is the transition from level j + t - band to level j
+    cost = np.where(feasible, cost, np.inf)[:, ::-1]
+
+    # Forward pass: minimum cost to reach each level at the end of each hour
+    accumulated = np.full(num_levels + 2 * band, np.inf)
+    accumulated[band + initial_level] = 0.0
+    predecessors = np.zeros((n, num_levels), dtype=np.int64)
+    level_index = np.arange(num_levels)
+    for i in range(n):
+        total = np.lib.stride_tricks.sliding_window_view(accumulated, 2 * band + 1) + cost[i]
+        best = np.argmin(total, axis=1)
+        predecessors[i] = level_index + best - band
+        accumulated = np.full(num_levels + 2 * band, np.inf)
+        accumulated[band:band + num_levels] = total[level_index, best]
+        accumulated[band:band + lower[i]] = np.inf
+
+    # Objective: cost of energy minus the weight of the final SoC
+    final = accumulated[band:band + num_levels] - w * soc_levels
+    last = int(np.argmin(final))
+    if not np.isfinite(final[last]):
+        return infeasible
+
+    # Backward pass: recover the path of levels
+    path = np.zeros(n + 1, dtype=np.int64)
+    path[0] = initial_level
+    path[n] = last
+    for i in range(n - 1, 0, -1):
+        path[i] = predecessors[i, path[i + 1]]
+
+    # Energies of the chosen transitions
+    energies = hour_energies(np.arange(n), step * np.diff(path))
+    return ScheduleSolution("Optimal", float(final[last]), *(energy.tolist() for energy in energies),
+                            soc_levels[path[1:]].tolist())
+
+
+def forecast_scenarios(center, lower, upper, num_scenarios: int, seed: int = 0,
+                       correlation: float = FORECAST_ERROR_CORRELATION) -> np.ndarray:
+    """
+    Return num_scenarios x hours samples of a forecast with the 80% uncertainty interval [lower, upper].
+    The errors are normal with INTERVAL_Z standard deviations between center and each limit (the interval
+    can be asymmetric) and correlated between hours (AR(1)). Negative samples are set to 0.
+    The same seed gives the same scenarios, so consecutive calculations are not changed by the sampling.
+    """
+    center = np.asarray(center, dtype=np.float64)
+    n = len(center)
+    rng = np.random.default_rng(seed)
+    # Standard normal errors with correlation**|i - j| between the hours i and j
+    lag = np.abs(np.subtract.outer(np.arange(n), np.arange(n)))
+    z = rng.standard_normal((num_scenarios, n)) @ np.linalg.cholesky(correlation ** lag).T
+    sigma_up = np.maximum(np.asarray(upper, dtype=np.float64) - center, 0) / INTERVAL_Z
+    sigma_down = np.maximum(center - np.asarray(lower, dtype=np.float64), 0) / INTERVAL_Z
+    return np.clip(center + np.where(z >= 0, z * sigma_up, z * sigma_down), 0, None)
+
+
+class _WarmStartHiGHS(pulp.HiGHS):
+    """PuLP in-process HiGHS solver that starts from the basis of its previous solve."""
+
+    def __init__(self, **kwargs) -> None:
+        """Initialize the solver."""
+        super().__init__(**kwargs)
+        self._basis = None
+
+    def callSolver(self, lp):
+        """Solve the model starting from the previous basis (the model structure does not change)."""
+        if self._basis is not None:
+            try:
+                lp.solverModel.setBasis(self._basis)
+            except Exception as e:
+                _LOGGER.debug(f"The previous basis could not be used: {e}")
+        lp.solverModel.run()
+        try:
+            self._basis = lp.solverModel.getBasis()
+        except Exception:
+            self._basis = None
+
+
+def make_solver():
+    """Return the HiGHS solver if highspy is installed, else the CBC solver included with PuLP."""
+    solver = _WarmStartHiGHS(msg=False)
+    if solver.available():
+        return solver
+    # CBC runs as a subprocess, the values of the previous solve are passed as initial solution
+    return pulp.PULP_CBC_CMD(msg=False, warmStart=True)
+
+
+class SocScheduleModel:
+    """
+    Linear programming model of the optimal SoC schedule for a fixed number of hours.
+    The variables and constraints are built only once. Each solve only updates the constant
+    terms of the constraints (demand, solar production, initial SoC, minimum SoC...)
+    and the objective function (prices), so the same model and solver are reused.
+    """
+
+    def __init__(self, num_hours: int, battery_capacity: float,
+                 max_charge_energy_per_period: float, max_discharge_energy_per_period: float,
+                 max_buy_energy_per_period: float, charge_efficiency: float, discharge_efficiency: float) -> None:
+        """Build the structure of the model."""
+        self.key = self.structure_key(num_hours, battery_capacity, max_charge_energy_per_period,
+                                      max_discharge_energy_per_period, max_buy_energy_per_period,
+                                      charge_efficiency, discharge_efficiency)
+        self.num_hours = num_hours
+        self.battery_capacity = battery_capacity
+        self.max_charge_energy_per_period = max_charge_energy_per_period
+        self.max_discharge_energy_per_period = max_discharge_energy_per_period
+        self.max_buy_energy_per_period = max_buy_energy_per_period
+        self.charge_efficiency = charge_efficiency
+        self.discharge_efficiency = discharge_efficiency
+        self._solver = make_solver()
+
+        # Create the optimization problem
+        problem = pulp.LpProblem("Optimal_SOC_with_Cost_Minimization", pulp.LpMinimize)
+
+        # Decision variables: energies and SoC of the battery at each hour
+        self.energy_from_grid = [pulp.LpVariable(f'f_grid_{i}', lowBound=0, upBound=max_buy_energy_per_period) for i in range(num_hours)]
+        self.energy_to_grid = [pulp.LpVariable(f't_grid_{i}', lowBound=0) for i in range(num_hours)]
+        self.soc = [pulp.LpVariable(f'soc_{i}', lowBound=0, upBound=battery_capacity) for i in range(num_hours)]
+        self.energy_to_battery = [pulp.LpVariable(f'charge_{i}', lowBound=0, upBound=max_charge_energy_per_period) for i in range(num_hours)]
+        self.energy_from_battery = [pulp.LpVariable(f'discharge_{i}', lowBound=0, upBound=max_discharge_energy_per_period) for i in range(num_hours)]
+        soc = self.soc
+
+        # CONSTRAINTS
+        # The constant terms of the named constraints are updated in each solve
+        # Require that the SoC at the last period is greater than the initial SoC
+        problem += soc[-1] >= 0, "final_soc"
+        # In the first hour, start from initial_soc and balance
+        problem += soc[0] - self.energy_to_battery[0] + self.energy_from_battery[0] == 0, "soc_balance_0"
+        # Limit the energies in the first period to the time remaining until the end of the hour
+        problem += self.energy_to_battery[0] <= max_charge_energy_per_period, "max_charge_first_period"
+        problem += self.energy_from_battery[0] <= max_discharge_energy_per_period, "max_discharge_first_period"
+        problem += self.energy_from_grid[0] <= max_buy_energy_per_period, "max_buy_first_period"
+        for i in range(num_hours):
+            if i > 0:
+                # In the following hours, the SoC depends on the previous state
+                problem += soc[i] == soc[i - 1] + self.energy_to_battery[i] - self.energy_from_battery[i], f"soc_balance_{i}"
+            # Require that the SoC does not fall below the minimum allowed
+            problem += soc[i] >= 0, f"min_soc_{i}"
+            # Global energy balance: demand - solar_production is the constant term
+            problem += self.energy_to_battery[i] / charge_efficiency + self.energy_to_grid[i] \
+                - self.energy_from_grid[i] - self.energy_from_battery[i] * discharge_efficiency == 0, f"energy_balance_{i}"
+        self.problem = problem
+
+    @staticmethod
+    def structure_key(*args) -> tuple:
+        """Return the parameters that define the structure of the model."""
+        return tuple(args)
+
+    def _set_rhs(self, name: str, value: float) -> None:
+        """Set the right hand side of a constraint (the constraints are stored as expression + constant)."""
+        self.problem.constraints[name].constant = -value
+
+    def update(self, demand: list[float], solar_production: list[float], buy_prices: list[float], sell_prices: list[float],
+               initial_soc: float, min_soc: float, first_period_fraction: float,
+               battery_energy_price: float, w: float) -> None:
+        """
+        Update the model with the data of a new calculation.
+        first_period_fraction is the fraction of the first hour that is still to come.
+        demand and solar_production of the first period must be already reduced to that fraction.
+        """
+        n = self.num_hours
+        max_charge_energy_first_period = self.max_charge_energy_per_period * first_period_fraction
+        max_discharge_energy_first_period = self.max_discharge_energy_per_period * first_period_fraction
+        max_buy_energy_first_period = self.max_buy_energy_per_period * first_period_fraction
+
+        self._set_rhs("final_soc", initial_soc)
+        self._set_rhs("soc_balance_0", initial_soc)
+        self._set_rhs("max_charge_first_period", max_charge_energy_first_period)
+        self._set_rhs("max_discharge_first_period", max_discharge_energy_first_period)
+        self._set_rhs("max_buy_first_period", max_buy_energy_first_period)
+
+        self._set_rhs("min_soc_0", first_period_min_soc(initial_soc, min_soc, demand[0], solar_production[0],
+                                                        max_charge_energy_first_period, max_buy_energy_first_period,
+                                                        self.charge_efficiency))
+        for i in range(1, n):
+            self._set_rhs(f"min_soc_{i}", min_soc)
+        for i in range(n):
+            self._set_rhs(f"energy_balance_{i}", solar_production[i] - demand[i])
+
+        # Objective function: minimize the cost of energy and maximize the SoC
+        # The expression is built from the coefficients, much faster than adding the products of variables
+        # with hundreds of periods. The prices are converted to €/Wh
+        price_battery = battery_energy_price / 1000
+        objective = [(self.energy_from_grid[i], buy_prices[i] / 1000) for i in range(n)] \
+            + [(self.energy_to_grid[i], -sell_prices[i] / 1000) for i in range(n)] \
+            + [(self.energy_from_battery[i], price_battery) for i in range(n)] \
+            + [(self.energy_to_battery[i], -price_battery) for i in range(n)]
+        objective.append((self.soc[-1], -w))
+        self.problem.setObjective(pulp.LpAffineExpression(objective))
+
+    def solve(self) -> str:
+        """Solve the model (blocking) and return the status."""
+        self.problem.solve(self._solver)
+        return pulp.LpStatus[self.problem.status]
+
+    @property
+    def objective(self) -> float:
+        """Return the value of the objective function of the last solve."""
+        return pulp.value(self.problem.objective)
+
+    def solution(self) -> ScheduleSolution:
+        """Return the solution of the last solve."""
+        def values(variables):
+            return [v.varValue for v in variables]
+        return ScheduleSolution(pulp.LpStatus[self.problem.status], self.objective,
+                                values(self.energy_from_grid), values(self.energy_to_grid),
+                                values(self.energy_to_battery), values(self.energy_from_battery), values(self.soc))
+
+
+class HighsScheduleModel:
+    """
+    The same model as SocScheduleModel built directly in HiGHS (highspy), without PuLP.
+    The matrix is passed once. Each solve only changes the costs of the columns and the bounds of
+    the columns and rows, and HiGHS starts from the basis of the previous solve. It avoids building
+    the PuLP expressions and copying the model to the solver in every solve, which take most of the
+    time with the hundreds of periods of the sub-hourly calculations.
+    Columns: from_grid, to_grid, soc, to_battery and from_battery of each period (in blocks of num_hours).
+    Rows: SoC balance and energy balance of each period. The minimum SoC and the final SoC are column bounds.
+    """
+
+    def __init__(self, num_hours: int, battery_capacity: float,
+                 max_charge_energy_per_period: float, max_discharge_energy_per_period: float,
+                 max_buy_energy_per_period: float, charge_efficiency: float, discharge_efficiency: float) -> None:
+        """Build the structure of the model."""
+        self.key = SocScheduleModel.structure_key(num_hours, battery_capacity, max_charge_energy_per_period,
+                                                  max_discharge_energy_per_period, max_buy_energy_per_period,
+                                                  charge_efficiency, discharge_efficiency)
+        n = num_hours
+        self.num_hours = n
+        self.battery_capacity = battery_capacity
+        self.max_charge_energy_per_period = max_charge_energy_per_period
+        self.max_discharge_energy_per_period = max_discharge_energy_per_period
+        self.max_buy_energy_per_period = max_buy_energy_per_period
+        self.charge_efficiency = charge_efficiency
+        self.discharge_efficiency = discharge_efficiency
+        self._status = "Not Solved"
+        self._values = None
+        self._objective = None
+
+        inf = highspy.kHighsInf
+        from_grid, to_grid, soc, to_battery, from_battery = (np.arange(n) + k * n for k in range(5))
+        self._columns = {"from_grid": from_grid, "to_grid": to_grid, "soc": soc,
+                         "to_battery": to_battery, "from_battery": from_battery}
+        self._upper = np.concatenate([np.full(n, float(max_buy_energy_per_period)), np.full(n, inf),
+                                      np.full(n, float(battery_capacity)), np.full(n, float(max_charge_energy_per_period)),
+                                      np.full(n, float(max_discharge_energy_per_period))])
+
+        # Rows (the constant terms are the row bounds, updated in each solve):
+        # soc_i - soc_{i-1} - to_battery_i + from_battery_i = 0 (initial_soc in the first period)
+        # to_battery_i / charge_efficiency + to_grid_i - from_grid_i - from_battery_i * discharge_efficiency = solar_i - demand_i
+        rows, columns, values = [], [], []
+
+        def add(row, column, value):
+            rows.append(row)
+            columns.append(column)
+            values.append(value)
+
+        for i in range(n):
+            add(i, soc[i], 1.0)
+            if i > 0:
+                add(i, soc[i - 1], -1.0)
+            add(i, to_battery[i], -1.0)
+            add(i, from_battery[i], 1.0)
+            add(n + i, to_battery[i], 1 / charge_efficiency)
+            add(n + i, to_grid[i], 1.0)
+            add(n + i, from_grid[i], -1.0)
+            add(n + i, from_battery[i], -discharge_efficiency)
+        # Row-wise sparse matrix
+        order = np.argsort(rows, kind="stable")
+        starts = np.searchsorted(np.asarray(rows)[order], np.arange(2 * n))
+
+        lp = highspy.HighsLp()
+        lp.num_col_ = 5 * n
+        lp.num_row_ = 2 * n
+        lp.col_cost_ = np.zeros(5 * n)
+        lp.col_lower_ = np.zeros(5 * n)
+        lp.col_upper_ = self._upper.copy()
+        lp.row_lower_ = np.zeros(2 * n)
+        lp.row_upper_ = np.zeros(2 * n)
+        lp.a_matrix_.format_ = highspy.MatrixFormat.kRowwise
+        lp.a_matrix_.start_ = np.append(starts, len(rows)).astype(np.int32)
+        lp.a_matrix_.index_ = np.asarray(columns, dtype=np.int32)[order]
+        lp.a_matrix_.value_ = np.asarray(values, dtype=np.float64)[order]
+
+        self._highs = highspy.Highs()
+        self._highs.setOptionValue("output_flag", False)
+        self._highs.passModel(lp)
+        self._all_columns = np.arange(5 * n, dtype=np.int32)
+        self._all_rows = np.arange(2 * n, dtype=np.int32)
+
+    def update(self, demand: list[float], solar_production: list[float], buy_prices: list[float], sell_prices: list[float],
+               initial_soc: float, min_soc: float, first_period_fraction: float,
+               battery_energy_price: float, w: float) -> None:
+        """Update the model with the data of a new calculation (the same arguments as SocScheduleModel.update)."""
+        n = self.num_hours
+        columns = self._columns
+        demand = np.asarray(demand[:n], dtype=np.float64)
+        solar_production = np.asarray(solar_production[:n], dtype=np.float64)
+
+        # Costs in €/Wh, the final SoC is maximized with the weight w
+        cost = np.concatenate([np.asarray(buy_prices[:n], dtype=np.float64), -np.asarray(sell_prices[:n], dtype=np.float64),
+                               np.zeros(n), np.full(n, -battery_energy_price), np.full(n, battery_energy_price)]) / 1000
+        cost[columns["soc"][-1]] -= w
+        self._highs.changeColsCost(len(cost), self._all_columns, cost)
+
+        # Limits of the first period for the time remaining until its end, and minimum SoC of each period
+        upper = self._upper.copy()
+        max_charge_energy_first_period = self.max_charge_energy_per_period * first_period_fraction
+        max_buy_energy_first_period = self.max_buy_energy_per_period * first_period_fraction
+        upper[columns["to_battery"][0]] = max_charge_energy_first_period
+        upper[columns["from_battery"][0]] = self.max_discharge_energy_per_period * first_period_fraction
+        upper[columns["from_grid"][0]] = max_buy_energy_first_period
+        lower = np.zeros(5 * n)
+        soc_lower = np.full(n, float(min_soc))
+        soc_lower[0] = first_period_min_soc(initial_soc, min_soc, demand[0], solar_production[0],
+                                            max_charge_energy_first_period, max_buy_energy_first_period,
+                                            self.charge_efficiency)
+        # Require that the SoC at the last period is greater than the initial SoC
+        soc_lower[-1] = max(soc_lower[-1], initial_soc)
+        lower[columns["soc"]] = soc_lower
+        self._highs.changeColsBounds(len(lower), self._all_columns, lower, upper)
+
+        bounds = np.zeros(2 * n)
+        bounds[0] = initial_soc
+        bounds[n:] = solar_production - demand
+        self._highs.changeRowsBounds(len(bounds), self._all_rows, bounds, bounds)
+
+    def solve(self) -> str:
+        """Solve the model (blocking) and return the status."""
+        self._highs.run()
+        model_status = self._highs.getModelStatus()
+        if model_status == highspy.HighsModelStatus.kOptimal:
+            self._status = "Optimal"
+            self._values = np.asarray(self._highs.getSolution().col_value)
+            self._objective = self._highs.getInfo().objective_function_value
+        else:
+            self._status = "Infeasible" if model_status == highspy.HighsModelStatus.kInfeasible else "Not Solved"
+            self._values = None
+            self._objective = None
+        return self._status
+
+    @property
+    def objective(self) -> float | None:
+        """Return the value of the objective function of the last solve."""
+        return self._objective
+
+    def solution(self) -> ScheduleSolution:
+        """Return the solution of the last solve."""
+        if self._values is None:
+            return ScheduleSolution(self._status, None, [], [], [], [], [])
+
+        def values(name):
+            return self._values[self._columns[name]].tolist()
+        return ScheduleSolution(self._status, self._objective, values("from_grid"), values("to_grid"),
+                                values("to_battery"), values("from_battery"), values("soc"))
+
+
+def make_soc_model(*key) -> SocScheduleModel | HighsScheduleModel:
+    """
+    Return the model of the SoC schedule for the structure key of SocScheduleModel.
+    The model is built directly in HiGHS if highspy is installed, else with PuLP and its CBC solver.
+    """
+    if highspy is not None:
+        return HighsScheduleModel(*key)
+    return SocScheduleModel(*key)
+
+
+class ScenarioScheduleModel:
+    """
+    Two-stage stochastic version of SocScheduleModel over several scenarios of demand and solar production.
+    The battery energies of the first hour are the same in all the scenarios (non-anticipativity: they are
+    applied now, before the real demand and production are known). The grid energies of the first hour and
+    all the energies of the next hours adapt to each scenario. The objective is the mean of the objective of
+    SocScheduleModel over the scenarios. All the scenarios are stacked in a single LP solved in one call.
+    """
+
+    def __init__(self, num_hours: int, num_scenarios: int, battery_capacity: float,
+                 max_charge_energy_per_period: float, max_discharge_energy_per_period: float,
+                 max_buy_energy_per_period: float, charge_efficiency: float, discharge_efficiency: float) -> None:
+        """Build the structure of the model."""
+        self.key = self.structure_key(num_hours, num_scenarios, battery_capacity, max_charge_energy_per_period,
+                                      max_discharge_energy_per_period, max_buy_energy_per_period,
+                                      charge_efficiency, discharge_efficiency)
+        self.num_hours = num_hours
+        self.num_scenarios = num_scenarios
+        self.battery_capacity = battery_capacity
+        self.max_charge_energy_per_period = max_charge_energy_per_period
+        self.max_discharge_energy_per_period = max_discharge_energy_per_period
+        self.max_buy_energy_per_period = max_buy_energy_per_period
+        self.charge_efficiency = charge_efficiency
+        self.discharge_efficiency = discharge_efficiency
+        self._solver = make_solver()
+
+        problem = pulp.LpProblem("Optimal_SOC_with_Scenarios", pulp.LpMinimize)
+
+        # First stage: battery energies and SoC of the first hour, shared by all the scenarios
+        charge_0 = pulp.LpVariable('charge_0', lowBound=0, upBound=max_charge_energy_per_period)
+        discharge_0 = pulp.LpVariable('discharge_0', lowBound=0, upBound=max_discharge_energy_per_period)
+        soc_0 = pulp.LpVariable('soc_0', lowBound=0, upBound=battery_capacity)
+        # Second stage: the rest of the energies of each scenario s
+        self.energy_from_grid = [[pulp.LpVariable(f'f_grid_{s}_{i}', lowBound=0, upBound=max_buy_energy_per_period)
+                                  for i in range(num_hours)] for s in range(num_scenarios)]
+        self.energy_to_grid = [[pulp.LpVariable(f't_grid_{s}_{i}', lowBound=0) for i in range(num_hours)]
+                               for s in range(num_scenarios)]
+        self.energy_to_battery = [[charge_0] + [pulp.LpVariable(f'charge_{s}_{i}', lowBound=0, upBound=max_charge_energy_per_period)
+                                                for i in range(1, num_hours)] for s in range(num_scenarios)]
+        self.energy_from_battery = [[discharge_0] + [pulp.LpVariable(f'discharge_{s}_{i}', lowBound=0, upBound=max_discharge_energy_per_period)
+                                                     for i in range(1, num_hours)] for s in range(num_scenarios)]
+        self.soc = [[soc_0] + [pulp.LpVariable(f'soc_{s}_{i}', lowBound=0, upBound=battery_capacity)
+                               for i in range(1, num_hours)] for s in range(num_scenarios)]
+
+        # CONSTRAINTS (the constant terms of the named constraints are updated in each solve)
+        problem += soc_0 - charge_0 + discharge_0 == 0, "soc_balance_0"
+        problem += charge_0 <= max_charge_energy_per_period, "max_charge_first_period"
+        problem += discharge_0 <= max_discharge_energy_per_period, "max_discharge_first_period"
+        problem += soc_0 >= 0, "min_soc_0"
+        for s in range(num_scenarios):
+            soc = self.soc[s]
+            problem += soc[-1] >= 0, f"final_soc_{s}"
+            problem += self.energy_from_grid[s][0] <= max_buy_energy_per_period, f"max_buy_first_period_{s}"
+            for i in range(num_hours):
+                if i > 0:
+                    problem += soc[i] == soc[i - 1] + self.energy_to_battery[s][i] - self.energy_from_battery[s][i], f"soc_balance_{s}_{i}"
+                    problem += soc[i] >= 0, f"min_soc_{s}_{i}"
+                problem += self.energy_to_battery[s][i] / charge_efficiency + self.energy_to_grid[s][i] \
+                    - self.energy_from_grid[s][i] - self.energy_from_battery[s][i] * discharge_efficiency == 0, f"energy_balance_{s}_{i}"
+        self.problem = problem
+
+    @staticmethod
+    def structure_key(*args) -> tuple:
+        """Return the parameters that define the structure of the model."""
+        return tuple(args)
+
+    def _set_rhs(self, name: str, value: float) -> None:
+        """Set the right hand side of a constraint (the constraints are stored as expression + constant)."""
+        self.problem.constraints[name].constant = -value
+
+    def update(self, demand: np.ndarray, solar_production: np.ndarray, buy_prices: list[float], sell_prices: list[float],
+               initial_soc: float, min_soc: float, first_period_fraction: float,
+               battery_energy_price: float, w: float) -> None:
+        """
+        Update the model with the scenarios (num_scenarios x num_hours arrays) of demand and solar production.
+        The first period of the scenarios must be already reduced to first_period_fraction.
+        """
+        n = self.num_hours
+        max_charge_energy_first_period = self.max_charge_energy_per_period * first_period_fraction
+        max_buy_energy_first_period = self.max_buy_energy_per_period * first_period_fraction
+
+        self._set_rhs("soc_balance_0", initial_soc)
+        self._set_rhs("max_charge_first_period", max_charge_energy_first_period)
+        self._set_rhs("max_discharge_first_period", self.max_discharge_energy_per_period * first_period_fraction)
+        # The SoC of the first hour is shared, its minimum is calculated with the mean of the scenarios
+        self._set_rhs("min_soc_0", first_period_min_soc(initial_soc, min_soc, float(np.mean(demand[:, 0])),
+                                                        float(np.mean(solar_production[:, 0])),
+                                                        max_charge_energy_first_period, max_buy_energy_first_period,
+                                                        self.charge_efficiency))
+        for s in range(self.num_scenarios):
+            self._set_rhs(f"final_soc_{s}", initial_soc)
+            self._set_rhs(f"max_buy_first_period_{s}", max_buy_energy_first_period)
+            for i in range(1, n):
+                self._set_rhs(f"min_soc_{s}_{i}", min_soc)
+            for i in range(n):
+                self._set_rhs(f"energy_balance_{s}_{i}", float(solar_production[s, i] - demand[s, i]))
+
+        # Objective function: mean over the scenarios of the cost of energy minus the weight of the final SoC
+        # The expression is built from the coefficients as in SocScheduleModel. The variables of the first hour
+        # are shared by all the scenarios, their coefficients are accumulated. The prices are converted to €/Wh
+        probability = 1 / self.num_scenarios
+        price_battery = battery_energy_price / 1000 * probability
+        coefficients = {}
+        for s in range(self.num_scenarios):
+            for i in range(n):
+                coefficients[self.energy_from_grid[s][i]] = buy_prices[i] / 1000 * probability
+                coefficients[self.energy_to_grid[s][i]] = -sell_prices[i] / 1000 * probability
+                for variable, coefficient in ((self.energy_from_battery[s][i], price_battery),
+                                              (self.energy_to_battery[s][i], -price_battery)):
+                    coefficients[variable] = coefficients.get(variable, 0) + coefficient
+            coefficients[self.soc[s][-1]] = coefficients.get(self.soc[s][-1], 0) - w * probability
+        self.problem.setObjective(pulp.LpAffineExpression(coefficients))
+
+    def solve(self) -> str:
+        """Solve the model (blocking) and return the status."""
+        self.problem.solve(self._solver)
+        return pulp.LpStatus[self.problem.status]
+
+    @property
+    def objective(self) -> float:
+        """Return the value of the objective function of the last solve."""
+        return pulp.value(self.problem.objective)
+
+    def solution(self) -> ScheduleSolution:
+        """Return the solution of the last solve, the energies and the SoC are the means of the scenarios."""
+        def values(variables):
+            return np.array([[v.varValue for v in row] for row in variables]).mean(axis=0).tolist()
+        return ScheduleSolution(pulp.LpStatus[self.problem.status], self.objective,
+                                values(self.energy_from_grid), values(self.energy_to_grid),
+                                values(self.energy_to_battery), values(self.energy_from_battery), values(self.soc))
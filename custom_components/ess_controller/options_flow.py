@@ -3,7 +3,7 @@ from homeassistant import config_entries
 from homeassistant.core import callback
 
 from .const import DOMAIN, TITLE
-from .const import create_step_one_schema, create_step_two_schema, create_step_three_schema, create_step_four_schema
+from .schemas import create_step_one_schema, create_step_two_schema, create_step_three_schema, create_step_four_schema
 
 class PVcontrollerOptionsFlowHandler(config_entries.OptionsFlow):
     """Handle pv_controller options flow."""
@@ -0,0 +1,129 @@
+"""Schemas of the steps of the config flow and of the options flow."""
+from __future__ import annotations
+import voluptuous as vol
+from homeassistant.helpers import selector
+from .const import DEFAULT_ACIN_TO_ACOUT_SENSOR, DEFAULT_BATTERY_CAPACITY_WH, DEFAULT_BATTERY_EOL_CYCLES_MIN_SOC_20, \
+    DEFAULT_BATTERY_EOL_CYCLES_MIN_SOC_50, DEFAULT_BATTERY_MIN_SOC_OVERRIDES_SENSOR, DEFAULT_BATTERY_SOC_SENSOR, \
+    DEFAULT_CHARGE_EFFICIENCY, DEFAULT_DEMAND_ENGINE, DEFAULT_DEMAND_HISTORY_DAYS, DEFAULT_DEMAND_HOURLY_DAYS, \
+    DEFAULT_DISCHARGE_EFFICIENCY, DEFAULT_FINAL_SOC_WEIGHT_FACTOR, DEFAULT_FORECAST_SOLAR_API_BASE_URL, \
+    DEFAULT_FORECAST_SOLAR_AZIMUTH, DEFAULT_FORECAST_SOLAR_DECLINATION, DEFAULT_FORECAST_SOLAR_ENTITY, \
+    DEFAULT_FORECAST_SOLAR_LATITUDE, DEFAULT_FORECAST_SOLAR_LONGITUDE, DEFAULT_FORECAST_SOLAR_PEAK_POWER, \
+    DEFAULT_GRID_POWER_SENSOR, DEFAULT_INFLUX_DB_DATABASE, DEFAULT_INFLUX_DB_PASS, DEFAULT_INFLUX_DB_URL, \
+    DEFAULT_INFLUX_DB_USER, DEFAULT_INVERTER_TO_ACOUT_SENSOR, DEFAULT_MAX_BUY_ENERGY_PER_PERIOD_WH, \
+    DEFAULT_MAX_CHARGE_ENERGY_PER_PERIOD_WH, DEFAULT_MAX_DISCHARGE_ENERGY_PER_PERIOD_WH, DEFAULT_MIN_SOC_PERCENT, \
+    DEFAULT_OPTIMIZER_ENGINE, DEFAULT_PERIOD_MINUTES, DEFAULT_PROPHET_INFLUXDB_ADDON_URL, DEFAULT_PVPC_BUY_ENTITY, \
+    DEFAULT_PVPC_SELL_ENTITY, DEFAULT_SOLAR_PRODUCTION_SENSOR, DEMAND_ENGINES, OPTIMIZER_ENGINES, \
+    PERIOD_MINUTES_OPTIONS
+
+
+def get_existing_or_default(config_entry, key, default):
+    """Get the existing configuration value or the default value."""
+    if config_entry is None:
+        return default
+    else:
+        return config_entry.options.get(key, config_entry.data.get(key, default))
+    
+def create_step_one_schema(config_entry=None):
+    return vol.Schema({
+        vol.Required("battery_capacity_Wh", default=get_existing_or_default(config_entry, "battery_capacity_Wh", DEFAULT_BATTERY_CAPACITY_WH)): vol.All(
+            vol.Coerce(int),
+            vol.Range(min=1, msg="The value must be a positive integer")
+        ),
+        vol.Required("max_charge_energy_per_period_Wh", default=get_existing_or_default(config_entry, "max_charge_energy_per_period_Wh", DEFAULT_MAX_CHARGE_ENERGY_PER_PERIOD_WH)): vol.All(
+            vol.Coerce(int),
+            vol.Range(min=1, msg="The value must be a positive integer")
+        ),
+        vol.Required("max_discharge_energy_per_period_Wh", default=get_existing_or_default(config_entry, "max_discharge_energy_per_period_Wh", DEFAULT_MAX_DISCHARGE_ENERGY_PER_PERIOD_WH)): vol.All(
+            vol.Coerce(int),
+            vol.Range(min=1, msg="The value must be a positive integer")
+        ),
+        vol.Required("max_buy_energy_per_period_Wh", default=get_existing_or_default(config_entry, "max_buy_energy_per_period_Wh", DEFAULT_MAX_BUY_ENERGY_PER_PERIOD_WH)): vol.All(
+            vol.Coerce(int),
+            vol.Range(min=1, msg="The value must be a positive integer")
+        ),
+        vol.Required("charge_efficiency", default=get_existing_or_default(config_entry, "charge_efficiency", DEFAULT_CHARGE_EFFICIENCY)): vol.All(
+            vol.Coerce(float),
+            vol.Range(min=0, max=1, msg="The value must be between 0 and 1.")
+        ),
+        vol.Required("discharge_efficiency", default=get_existing_or_default(config_entry, "discharge_efficiency", DEFAULT_DISCHARGE_EFFICIENCY)): vol.All(
+            vol.Coerce(float),
+            vol.Range(min=0, max=1, msg="The value must be between 0 and 1.")
+        ),
+        vol.Required("min_soc_percent", default=get_existing_or_default(config_entry, "min_soc_percent", DEFAULT_MIN_SOC_PERCENT)): vol.All(
+            vol.Coerce(int),
+            vol.Range(min=1, max=100, msg="The value must be between 1 and 100")
+        ),
+        vol.Required("battery_purchase_price", default=get_existing_or_default(config_entry, "battery_purchase_price", 0)): vol.All(
+            vol.Coerce(int),
+            vol.Range(min=0, msg="The value must be a positive integer")
+        ),
+        vol.Required("battery_eol_cycles_min_soc_20", default=get_existing_or_default(config_entry, "battery_eol_cycles_min_soc_20", DEFAULT_BATTERY_EOL_CYCLES_MIN_SOC_20)): vol.All(
+            vol.Coerce(int),
+            vol.Range(min=1, msg="The value must be a positive integer")
+        ),
+        vol.Required("battery_eol_cycles_min_soc_50", default=get_existing_or_default(config_entry, "battery_eol_cycles_min_soc_50", DEFAULT_BATTERY_EOL_CYCLES_MIN_SOC_50)): vol.All(
+            vol.Coerce(int),
+            vol.Range(min=1, msg="The value must be a positive integer")
+        ),
+        vol.Required("final_soc_weight_factor", default=get_existing_or_default(config_entry, "final_soc_weight_factor", DEFAULT_FINAL_SOC_WEIGHT_FACTOR)): vol.All(
+            vol.Coerce(float),
+            vol.Range(min=0, msg="The value must be a positive number or 0")
+        ),
+        vol.Required("optimizer_engine", default=get_existing_or_default(config_entry, "optimizer_engine", DEFAULT_OPTIMIZER_ENGINE)): \
+            selector.SelectSelector(selector.SelectSelectorConfig(options=OPTIMIZER_ENGINES, translation_key="optimizer_engine")),
+        vol.Required("demand_engine", default=get_existing_or_default(config_entry, "demand_engine", DEFAULT_DEMAND_ENGINE)): \
+            selector.SelectSelector(selector.SelectSelectorConfig(options=DEMAND_ENGINES, translation_key="demand_engine")),
+        vol.Required("period_minutes", default=get_existing_or_default(config_entry, "period_minutes", DEFAULT_PERIOD_MINUTES)): \
+            selector.SelectSelector(selector.SelectSelectorConfig(options=PERIOD_MINUTES_OPTIONS, translation_key="period_minutes"))
+    })
+
+def create_step_two_schema(config_entry=None):
+    return vol.Schema({
+        vol.Required("acin_to_acout_sensor", default=get_existing_or_default(config_entry, "acin_to_acout_sensor", DEFAULT_ACIN_TO_ACOUT_SENSOR)): \
+            selector.EntitySelector(selector.EntitySelectorConfig(domain="sensor")),
+        vol.Required("inverter_to_acout_sensor", default=get_existing_or_default(config_entry, "inverter_to_acout_sensor", DEFAULT_INVERTER_TO_ACOUT_SENSOR)): \
+            selector.EntitySelector(selector.EntitySelectorConfig(domain="sensor")),
+        vol.Required("battery_soc_sensor", default=get_existing_or_default(config_entry, "battery_soc_sensor", DEFAULT_BATTERY_SOC_SENSOR)): \
+            selector.EntitySelector(selector.EntitySelectorConfig(domain="sensor")),
+        #vol.Required("battery_min_soc_overrides_sensor", default=get_existing_or_default(config_entry, "battery_min_soc_overrides_sensor", DEFAULT_BATTERY_MIN_SOC_OVERRIDES_SENSOR)): str,
+        vol.Optional("battery_min_soc_overrides_sensor", default=get_existing_or_default(config_entry, "battery_min_soc_overrides_sensor", DEFAULT_BATTERY_MIN_SOC_OVERRIDES_SENSOR)): \
+            selector.EntitySelector(selector.EntitySelectorConfig()),
+        vol.Optional("grid_power_sensor", default=get_existing_or_default(config_entry, "grid_power_sensor", DEFAULT_GRID_POWER_SENSOR)): \
+            selector.EntitySelector(selector.EntitySelectorConfig(domain="sensor")),
+        vol.Required("solar_production_sensor", default=get_existing_or_default(config_entry, "solar_production_sensor", DEFAULT_SOLAR_PRODUCTION_SENSOR)): \
+            selector.EntitySelector(selector.EntitySelectorConfig(domain="sensor")),
+        vol.Required("pvpc_buy_entity", default=get_existing_or_default(config_entry, "pvpc_buy_entity", DEFAULT_PVPC_BUY_ENTITY)): \
+            selector.EntitySelector(selector.EntitySelectorConfig(domain="sensor")),
+        vol.Required("pvpc_sell_entity", default=get_existing_or_default(config_entry, "pvpc_sell_entity", DEFAULT_PVPC_SELL_ENTITY)): \
+            selector.EntitySelector(selector.EntitySelectorConfig(domain="sensor")),
+        vol.Required("sell_allowed", default=get_existing_or_default(config_entry, "sell_allowed", False)): bool
+    })
+
+def create_step_three_schema(config_entry=None):
+    return vol.Schema({
+        vol.Required("forecast_solar_entity", default=get_existing_or_default(config_entry, "forecast_solar_entity", DEFAULT_FORECAST_SOLAR_ENTITY)): str,
+        vol.Required("forecast_solar_latitude", default=get_existing_or_default(config_entry, "forecast_solar_latitude", DEFAULT_FORECAST_SOLAR_LATITUDE)): vol.Coerce(float),
+        vol.Required("forecast_solar_longitude", default=get_existing_or_default(config_entry, "forecast_solar_longitude", DEFAULT_FORECAST_SOLAR_LONGITUDE)): vol.Coerce(float),
+        vol.Required("forecast_solar_peak_power", default=get_existing_or_default(config_entry, "forecast_solar_peak_power", DEFAULT_FORECAST_SOLAR_PEAK_POWER)): vol.Coerce(float),
+        vol.Required("forecast_solar_declination", default=get_existing_or_default(config_entry, "forecast_solar_declination", DEFAULT_FORECAST_SOLAR_DECLINATION)): vol.Coerce(int),
+        vol.Required("forecast_solar_azimuth", default=get_existing_or_default(config_entry, "forecast_solar_azimuth", DEFAULT_FORECAST_SOLAR_AZIMUTH)): vol.Coerce(int),
+        vol.Required("enable_fore_to_real_correction", default=get_existing_or_default(config_entry, "enable_fore_to_real_correction", False)): bool
+    })
+
+def create_step_four_schema(config_entry=None):
+    return vol.Schema({
+        vol.Required("forecast_solar_api_base_url", default=get_existing_or_default(config_entry, "forecast_solar_api_base_url", DEFAULT_FORECAST_SOLAR_API_BASE_URL)): str,
+        vol.Required("influx_db_url", default=get_existing_or_default(config_entry, "influx_db_url", DEFAULT_INFLUX_DB_URL)): str,
+        vol.Required("influx_db_user", default=get_existing_or_default(config_entry, "influx_db_user", DEFAULT_INFLUX_DB_USER)): str,
+        vol.Required("influx_db_pass", default=get_existing_or_default(config_entry, "influx_db_pass", DEFAULT_INFLUX_DB_PASS)): str,
+        vol.Required("influx_db_database", default=get_existing_or_default(config_entry, "influx_db_database", DEFAULT_INFLUX_DB_DATABASE)): str,        
+        vol.Required("prophet_influxdb_addon_url", default=get_existing_or_default(config_entry, "prophet_influxdb_addon_url", DEFAULT_PROPHET_INFLUXDB_ADDON_URL)): str,
+        vol.Required("demand_history_days", default=get_existing_or_default(config_entry, "demand_history_days", DEFAULT_DEMAND_HISTORY_DAYS)): vol.All(
+            vol.Coerce(int),
+            vol.Range(min=0, msg="The value must be a positive integer or 0")
+        ),
+        vol.Required("demand_hourly_days", default=get_existing_or_default(config_entry, "demand_hourly_days", DEFAULT_DEMAND_HOURLY_DAYS)): vol.All(
+            vol.Coerce(int),
+            vol.Range(min=0, msg="The value must be a positive integer or 0")
+        )
+    })
\ No newline at end of file
@@ -116,8 +116,8 @@ class PVPC_Buy_Sensor(SensorEntity):
         """Return the state attributes of the sensor."""
         attributes = {}
         attributes['unit_of_measurement'] = self._attr_unit_of_measurement
-        if self._coordinator.buy_prices_useful_dict:
-            attributes.update({str(k): v for k, v in self._coordinator.buy_prices_useful_dict.items()})
+        if self._coordinator.buy_prices_series:
+            attributes.update(self._coordinator.buy_prices_series.to_dict())
         return attributes  
     
     async def async_update(self):
@@ -170,8 +170,8 @@ class PVPC_Sell_Sensor(SensorEntity):
         """Return the state attributes of the sensor."""
         attributes = {}
         attributes['unit_of_measurement'] = self._attr_unit_of_measurement
-        if self._coordinator.sell_prices_useful_dict:
-            attributes.update({str(k): v for k, v in self._coordinator.sell_prices_useful_dict.items()})
+        if self._coordinator.sell_prices_series:
+            attributes.update(self._coordinator.sell_prices_series.to_dict())
         return attributes 
     
     async def async_update(self):
@@ -229,8 +229,8 @@ class ForecastSolar_Sensor(SensorEntity):
         """Return the state attributes of the sensor."""
         attributes = {}
         attributes['unit_of_measurement'] = self._attr_unit_of_measurement
-        if self._coordinator.forecast_solar_useful_dict:
-            attributes.update({str(k): v for k, v in self._coordinator.forecast_solar_useful_dict.items()})
+        if self._coordinator.forecast_solar_series:
+            attributes.update(self._coordinator.forecast_solar_series.to_dict())
         return attributes
     
     async def async_update(self):
@@ -289,7 +289,7 @@ class ForecastDemand_Sensor(SensorEntity):
         attributes = {}
         attributes['unit_of_measurement'] = self._attr_unit_of_measurement
         if self._coordinator.predicted_demand:
-            attributes.update({str(k): v for k, v in self._coordinator.predicted_demand.items()})
+            attributes.update(self._coordinator.predicted_demand.to_dict())
         return attributes
 
     async def async_update(self):
@@ -347,7 +347,7 @@ class TargetSoC_Sensor(SensorEntity):
         attributes = {}
         attributes['unit_of_measurement'] = self._attr_unit_of_measurement
         if self._coordinator.target_socs:
-            attributes.update({str(k): v for k, v in self._coordinator.target_socs.items()})
+            attributes.update(self._coordinator.target_socs.to_dict())
         return attributes
     
     async def async_update(self):
@@ -583,18 +583,16 @@ class EffectiveForecastSolar_Sensor(SensorEntity):
         """Return the state attributes of the sensor."""
         attributes = {}
         attributes['unit_of_measurement'] = self._attr_unit_of_measurement
-        if self._coordinator.effective_forecast_solar_useful_dict:
-            attributes.update({str(k): v for k, v in self._coordinator.effective_forecast_solar_useful_dict.items()})
+        if self._coordinator.effective_forecast_solar_series:
+            attributes.update(self._coordinator.effective_forecast_solar_series.to_dict())
         return attributes
     
     async def async_update(self):
         """Update the sensor."""
         await self._coordinator.async_request_refresh()
-        if self._coordinator.effective_forecast_solar_useful_dict:
-            # Extract the value where the key is current_datetime, keys in iso format '2024-11-02T22:00:00'
-            current_datetime = datetime.now().replace(minute=0, second=0, microsecond=0)
-            current_datetime = current_datetime.isoformat()
-            value = self._coordinator.effective_forecast_solar_useful_dict.get(current_datetime)
+        if self._coordinator.effective_forecast_solar_series:
+            # Extract the value for the current hour
+            value = self._coordinator.effective_forecast_solar_series.value_at(datetime.now())
         else:
             value = None
         self._state = value
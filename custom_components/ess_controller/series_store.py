@@ -0,0 +1,125 @@
+import logging
+import asyncio
+import json
+import os
+import re
+from datetime import datetime
+import numpy as np
+
+_LOGGER = logging.getLogger(__name__)
+
+# Each entity is stored in two raw column files plus a small metadata file:
+#   <entity>.time.i8   -> int64 epoch seconds of the UTC time of each hour
+#   <entity>.value.f8  -> float64 value of each hour
+#   <entity>.meta.json -> {"covered_from": iso date or null, "utc": true}
+# The first versions stored the local time (without the "utc" key): the repeated hour when the clocks
+# go back was lost, so those series are ignored and queried again.
+TIME_SUFFIX = ".time.i8"
+VALUE_SUFFIX = ".value.f8"
+META_SUFFIX = ".meta.json"
+
+
+class HourlySeriesStore:
+    """
+    On-disk columnar store for hourly series.
+    The columns are raw NumPy files that are read with memory mapping and written in append-only mode,
+    so a warm start does not need to parse any JSON with the history.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Initialize the store in the directory path."""
+        self._path = path
+
+    def _file(self, entity_id: str, suffix: str) -> str:
+        """Return the path of a file of the store for an entity."""
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', entity_id)
+        return os.path.join(self._path, name + suffix)
+
+    def _entity_ids(self) -> list[str]:
+        """Return the entities with data in the store."""
+        if not os.path.isdir(self._path):
+            return []
+        return [f[:-len(TIME_SUFFIX)] for f in os.listdir(self._path) if f.endswith(TIME_SUFFIX)]
+
+    def read(self, entity_id: str) -> tuple[np.ndarray, np.ndarray, datetime | None]:
+        """Read the series of an entity using memory mapped files."""
+        times = self._memmap(self._file(entity_id, TIME_SUFFIX), np.int64)
+        values = self._memmap(self._file(entity_id, VALUE_SUFFIX), np.float64)
+        # If an append was interrupted the columns may have different lengths
+        rows = min(len(times), len(values))
+        covered_from = None
+        try:
+            with open(self._file(entity_id, META_SUFFIX), encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("covered_from"):
+                covered_from = datetime.fromisoformat(meta["covered_from"])
+        except (OSError, ValueError):
+            meta = {}
+        if not meta.get("utc"):
+            _LOGGER.debug(f"Ignoring the stored series of {entity_id} with local times")
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), None
+        return times[:rows], values[:rows], covered_from
+
+    def read_all(self) -> dict[str, tuple[np.ndarray, np.ndarray, datetime | None]]:
+        """Read the series of all the entities in the store."""
+        return {entity_id: self.read(entity_id) for entity_id in self._entity_ids()}
+
+    def replace(self, entity_id: str, times: np.ndarray, values: np.ndarray, covered_from: datetime | None) -> None:
+        """Replace the series of an entity."""
+        os.makedirs(self._path, exist_ok=True)
+        self._write_atomic(self._file(entity_id, TIME_SUFFIX), np.ascontiguousarray(times, dtype=np.int64).tobytes())
+        self._write_atomic(self._file(entity_id, VALUE_SUFFIX), np.ascontiguousarray(values, dtype=np.float64).tobytes())
+        meta = {"covered_from": covered_from.isoformat() if covered_from else None, "utc": True}
+        self._write_atomic(self._file(entity_id, META_SUFFIX), json.dumps(meta).encode("utf-8"))
+
+    def append(self, entity_id: str, times: np.ndarray, values: np.ndarray) -> None:
+        """Append rows at the end of the series of an entity."""
+        os.makedirs(self._path, exist_ok=True)
+        self._truncate_to_common_rows(entity_id)
+        with open(self._file(entity_id, TIME_SUFFIX), "ab") as f:
+            f.write(np.ascontiguousarray(times, dtype=np.int64).tobytes())
+        with open(self._file(entity_id, VALUE_SUFFIX), "ab") as f:
+            f.write(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+
+    async def async_load(self) -> dict[str, tuple[np.ndarray, np.ndarray, datetime | None]]:
+        """Read the series of all the entities in a separate thread."""
+        return await asyncio.to_thread(self.read_all)
+
+    async def async_replace(self, entity_id: str, times: np.ndarray, values: np.ndarray, covered_from: datetime | None) -> None:
+        """Replace the series of an entity in a separate thread."""
+        await asyncio.to_thread(self.replace, entity_id, times, values, covered_from)
+
+    async def async_append(self, entity_id: str, times: np.ndarray, values: np.ndarray) -> None:
+        """Append rows to the series of an entity in a separate thread."""
+        await asyncio.to_thread(self.append, entity_id, times, values)
+
+    def _truncate_to_common_rows(self, entity_id: str) -> None:
+        """Discard the rows of an interrupted append so that both columns stay aligned."""
+        time_file = self._file(entity_id, TIME_SUFFIX)
+        value_file = self._file(entity_id, VALUE_SUFFIX)
+        if not os.path.exists(time_file) or not os.path.exists(value_file):
+            return
+        rows = min(os.path.getsize(time_file) // 8, os.path.getsize(value_file) // 8)
+        for file in (time_file, value_file):
+            if os.path.getsize(file) != rows * 8:
+                _LOGGER.warning(f"Discarding incomplete rows in {file}")
+                os.truncate(file, rows * 8)
+
+    @staticmethod
+    def _memmap(file: str, dtype) -> np.ndarray:
+        """Map a column file in memory. Return an empty array if the file does not exist or is empty."""
+        try:
+            rows = os.path.getsize(file) // np.dtype(dtype).itemsize
+        except OSError:
+            return np.empty(0, dtype=dtype)
+        if rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(file, dtype=dtype, mode="r", shape=(rows,))
+
+    @staticmethod
+    def _write_atomic(file: str, content: bytes) -> None:
+        """Write a file through a temporary file so a reader never sees it half written."""
+        tmp_file = file + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(content)
+        os.replace(tmp_file, file)
@@ -0,0 +1,96 @@
+import logging
+from datetime import datetime, timedelta
+import numpy as np
+
+_LOGGER = logging.getLogger(__name__)
+
+# Setpoint (W) when no energy has to be bought: the battery covers the demand (self-consumption)
+SETPOINT_IDLE_W = 10
+# Resolution (W) of the setpoint, small changes are not sent to the inverter
+SETPOINT_RESOLUTION_W = 10
+# Fraction of the SoC deviation from the plan corrected in the rest of the period
+SETPOINT_SOC_GAIN = 0.5
+# The rest of the period is never considered shorter than this (the setpoint would grow without limit)
+SETPOINT_MIN_REMAINING = timedelta(minutes=1)
+
+
+class GridSetpointController:
+    """
+    Grid setpoint that follows the dispatch plan of the last calculation of the target SoCs.
+    In each period of the plan the grid energy delivered since the start of the period (measured by the
+    grid power sensor, or the setpoint itself if there is no sensor) is integrated and compared with the
+    planned grid energy. The energy still pending is spread over the rest of the period, corrected in
+    proportion to the deviation of the measured SoC from the SoC planned at this moment (a linear ramp
+    between the SoCs planned at the start and at the end of the period).
+    """
+
+    def __init__(self, max_setpoint_W: float, battery_capacity_Wh: float, charge_efficiency: float,
+                 soc_gain: float = SETPOINT_SOC_GAIN) -> None:
+        """Initialize the controller without a plan."""
+        self.max_setpoint_W = max_setpoint_W
+        self.battery_capacity_Wh = battery_capacity_Wh
+        self.charge_efficiency = charge_efficiency
+        self.soc_gain = soc_gain
+        self.results = None
+        self.setpoint_W = None
+        self._net_grid = None
+        self._soc = None
+        self._period_ends = None
+        self._plan_start = None
+        self._initial_soc_Wh = None
+        self._period_index = None
+        self._delivered_Wh = 0.0
+        self._last_update = None
+
+    def set_plan(self, results: dict, start: datetime, period_minutes: int, initial_soc_Wh: float) -> None:
+        """
+        Follow a new plan: the results of pulp_calculations calculated at start from initial_soc_Wh.
+        The first period of the plan goes from start to the end of the current period.
+        """
+        self.results = results
+        self._net_grid = np.asarray(results["from_grid(Wh)"], dtype=np.float64) - np.asarray(results["to_grid(Wh)"], dtype=np.float64)
+        self._soc = np.asarray(results["SoC(Wh)"], dtype=np.float64)
+        period = timedelta(minutes=period_minutes)
+        first_end = start.replace(minute=start.minute - start.minute % period_minutes, second=0, microsecond=0) + period
+        self._period_ends = [first_end + i * period for i in range(len(self._soc))]
+        self._plan_start = start
+        self._initial_soc_Wh = initial_soc_Wh
+        self._period_index = None
+        _LOGGER.debug(f"New setpoint plan from {start} with {len(self._soc)} periods of {period_minutes} minutes")
+
+    def update(self, now: datetime, soc_percent: float | None, grid_power_W: float | None = None) -> int | None:
+        """
+        Return the setpoint (W) at now, or None if there is no plan for now.
+        grid_power_W is the measured power from the grid (negative when sending energy), None if unknown.
+        """
+        if self._period_ends is None or now < self._plan_start or now >= self._period_ends[-1]:
+            return None
+        k = next(i for i, end in enumerate(self._period_ends) if now < end)
+        period_start = self._plan_start if k == 0 else self._period_ends[k - 1]
+        duration_h = (self._period_ends[k] - period_start).total_seconds() / 3600
+        elapsed_h = (now - period_start).total_seconds() / 3600
+        planned_Wh = self._net_grid[k]
+
+        if k != self._period_index:
+            # New period: the energy before the first update of the period is assumed to follow the plan
+            self._period_index = k
+            self._delivered_Wh = planned_Wh * elapsed_h / duration_h
+        else:
+            # Energy delivered since the last update, at the measured power or at the last setpoint
+            power_W = grid_power_W if grid_power_W is not None else self.setpoint_W
+            if power_W is not None:
+                self._delivered_Wh += power_W * (now - self._last_update).total_seconds() / 3600
+        self._last_update = now
+
+        # Deviation (Wh) of the measured SoC from the SoC planned at this moment (positive if the battery is behind)
+        soc_error_Wh = 0.0
+        if soc_percent is not None:
+            soc_start = self._initial_soc_Wh if k == 0 else self._soc[k - 1]
+            planned_soc = soc_start + (self._soc[k] - soc_start) * elapsed_h / duration_h
+            soc_error_Wh = planned_soc - soc_percent * self.battery_capacity_Wh / 100
+
+        remaining_h = max((self._period_ends[k] - now).total_seconds(), SETPOINT_MIN_REMAINING.total_seconds()) / 3600
+        pending_Wh = planned_Wh - self._delivered_Wh + self.soc_gain * soc_error_Wh / self.charge_efficiency
+        setpoint = round(pending_Wh / remaining_h / SETPOINT_RESOLUTION_W) * SETPOINT_RESOLUTION_W
+        self.setpoint_W = int(min(max(setpoint, SETPOINT_IDLE_W), self.max_setpoint_W))
+        return self.setpoint_W
@@ -1,9 +1,16 @@
+from __future__ import annotations
 import logging
-from homeassistant.core import HomeAssistant
-import homeassistant.helpers.entity_registry as er
+import re
+from typing import TYPE_CHECKING
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 from .const import DOMAIN, TITLE
+from .hourly_series import HourlySeries, epoch_hour
+
+# The conversions of this module are also used by the tools, which run without Home Assistant
+if TYPE_CHECKING:
+    from homeassistant.core import HomeAssistant
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -32,6 +39,8 @@ def get_entity_description(hass: HomeAssistant, entity_name: str):
 
 def get_coordinator_from_entity_name(hass: HomeAssistant, entity_name: str):
     """Get the coordinator from the entity name."""
+    import homeassistant.helpers.entity_registry as er
+
     entity_registry = er.async_get(hass)
     entity_entry = entity_registry.entities.get(entity_name)
     entity_domain = None
@@ -59,11 +68,12 @@ def get_coordinator_from_entity_name(hass: HomeAssistant, entity_name: str):
         _LOGGER.warning("Entity '%s' not found", entity_name)  
         return None
 
-async def forecast_solar_api_to_dict(forecast_solar_api_data: dict[str, float], current_datetime: datetime) -> dict[str, float]:
+async def forecast_solar_api_to_series(forecast_solar_api_data: dict[str, float], current_datetime: datetime) -> tuple[HourlySeries | None, float | None]:
     """
     Convert a solar forecast dictionary as downloaded from the Forecast.Solar API
-    into a continuous dictionary with data starting from current_datetime.
+    into a continuous HourlySeries with data starting from current_datetime.
     The download is a dictionary of the type {'2024-10-28 07:31:26': 0.0, '2024-10-28 08:31:26': 0.0, ...}
+    Return the series and the value of its first hour.
     """
     # The solar forecast dictionary has date_times as keys in str format, e.g., '2024-10-28 07:31:26'
     # Forecast.Solar returns date times in the local timezone of the request user
@@ -74,94 +84,115 @@ async def forecast_solar_api_to_dict(forecast_solar_api_data: dict[str, float],
         return None, None
     if len(forecast_solar_api_data) == 0:
         return None, None
-    df = pd.DataFrame(forecast_solar_api_data.items(), columns=['date', 'value'])
-
-    # Group the values by hours calculating the sum of each hour
-    df['date'] = pd.to_datetime(df['date'])
-    df = df.set_index('date')
-    df = df.resample('h').sum()  # Sum the values of each hour
-
-    # Find the last date in df
-    last_date = df.index[-1]
+    # Parse all the dates at once and truncate them to the hour
+    dates = pd.to_datetime(list(forecast_solar_api_data.keys()), format='ISO8601')
+    hours = dates.values.astype('datetime64[h]').astype(np.int64)
+    values = np.fromiter(forecast_solar_api_data.values(), dtype=np.float64, count=len(forecast_solar_api_data))
 
     # Remove the minutes and seconds from the date to create 1-hour intervals
-    current_date = current_datetime.replace(minute=0, second=0, microsecond=0)
+    current_hour = epoch_hour(current_datetime)
 
-    # Calculate the number of periods remaining from current_date to last_date
-    periods = (last_date - current_date).days * 24 + (last_date - current_date).seconds // 3600
-
-    continuous_df = pd.DataFrame({'date': pd.date_range(start=current_date, periods=periods, freq='h'), 'value': 0})
-
-    # Set date as the index to be able to dump the values from df into continuous_df
-    continuous_df = continuous_df.set_index('date')
-
-    # Dump the values from df into continuous_df where the indices (date) match
-    continuous_df.update(df)
+    # Number of periods remaining from the current hour to the last hour (the last hour is not included)
+    periods = int(hours.max()) - current_hour
+    if periods <= 0:
+        return None, None
 
-    # Store the first value of the series in a variable
-    first_value = continuous_df.iloc[0]['value']
+    # Sum the values of each hour dumping them into a continuous array (0 for the hours without values)
+    mask = (hours >= current_hour) & (hours < current_hour + periods)
+    series_values = np.bincount(hours[mask] - current_hour, weights=values[mask], minlength=periods)
+    series = HourlySeries(current_hour, series_values)
 
-    # Modify the index directly to use isoformat date format for the dictionary keys
-    continuous_df.index = continuous_df.index.map(lambda x: x.isoformat())
+    # Return the series and the first value of the series
+    return series, float(series_values[0])
 
-    # Convert the DataFrame to a dictionary and return it
-    return continuous_df.to_dict()['value'], first_value 
+async def forecast_solar_api_to_dict(forecast_solar_api_data: dict[str, float], current_datetime: datetime) -> dict[str, float]:
+    """
+    Convert a solar forecast dictionary as downloaded from the Forecast.Solar API
+    into a continuous dictionary with data starting from current_datetime.
+    The download is a dictionary of the type {'2024-10-28 07:31:26': 0.0, '2024-10-28 08:31:26': 0.0, ...}
+    """
+    series, first_value = await forecast_solar_api_to_series(forecast_solar_api_data, current_datetime)
+    if series is None:
+        return None, None
+    return series.to_dict(), first_value
 
-async def pvpc_raw_to_useful_dict(dict_pvpc: dict[str, float], current_datetime: datetime) -> list[float]:
+async def pvpc_raw_to_series(dict_pvpc: dict[str, float], current_datetime: datetime) -> tuple[HourlySeries | None, float | None]:
     """
     Convert a dictionary of electricity prices as obtained from the attributes of
-    the ESIOS integration sensor into a continuous dictionary with data starting from current_datetime.
+    the ESIOS integration sensor into a continuous HourlySeries with data starting from current_datetime.
     The sensor has a dictionary of the type {'price_00h': 0.1178, 'price_01h': 0.11417, ...}
-    Sometimes it also has keys for the next day, such as 'price_00h_next_day': 0.1178
+    Sometimes it also has keys for the next day, such as 'price_next_day_00h': 0.1178
+    Return the series and the value of its first hour.
     """
-    df = pd.DataFrame(dict_pvpc.items(), columns=['oldKey', 'value'])
-
-    # Create a new column with the hour
-    df['hour'] = df['oldKey'].str.extract(r'(\d+)').astype(int)
-
-    current_date = current_datetime.replace(hour=0, minute=0, second=0, microsecond=0)
+    return pvpc_series_from_hour(pvpc_raw_to_day_series(dict_pvpc, current_datetime), current_datetime)
 
-    # Create a new column with the date that has current_date + delta hours indicated in the hour column
-    df['date'] = current_date + pd.to_timedelta(df['hour'], unit='h')
-
-    # In the columns where oldKey contains 'next_day', add one day to the date
-    df.loc[df['oldKey'].str.contains('next_day'), 'date'] = df['date'] + pd.to_timedelta(1, unit='d')
-
-    # Drop the oldKey and hour columns
-    df = df.drop(columns=['oldKey', 'hour'])
-
-    # Set the date column as the index of the DataFrame
-    df = df.set_index('date')
+def pvpc_raw_to_day_series(dict_pvpc: dict[str, float], day: datetime) -> HourlySeries | None:
+    """
+    Convert a dictionary of electricity prices of the ESIOS integration sensor into an HourlySeries
+    starting at 00h of day. The hours without a price (e.g. the hour skipped when the clocks go forward)
+    are interpolated, the optimizer cannot use NaN prices. It only depends on the attributes
+    of the sensor, so it can be parsed once and sliced with pvpc_series_from_hour in every update.
+    """
+    if not dict_pvpc:
+        return None
 
-    # Remove minutes and seconds from current_datetime to compare with the dates in df
-    current_datetime = current_datetime.replace(minute=0, second=0, microsecond=0)
+    # Hours since the start of the day: the hour of the key plus 24 for the keys of the next day
+    hours = np.fromiter((int(re.search(r'(\d+)', key).group(1)) + (24 if 'next_day' in key else 0) \
+                         for key in dict_pvpc.keys()), dtype=np.int64, count=len(dict_pvpc))
+    values = np.fromiter(dict_pvpc.values(), dtype=np.float64, count=len(dict_pvpc))
+    series_values = np.full(int(hours.max()) + 1, np.nan, dtype=np.float64)
+    series_values[hours] = values
+    return HourlySeries.from_start(day.replace(hour=0, minute=0, second=0, microsecond=0), series_values).fill_gaps()
 
-    # Remove rows from df that have a date earlier than current_datetime
-    df = df[df.index >= current_datetime]
-    # If it is empty, end the function
-    if df.empty:
+def pvpc_series_from_hour(prices: HourlySeries | None, current_datetime: datetime) -> tuple[HourlySeries | None, float | None]:
+    """
+    Return the prices from the hour of current_datetime (a view of the values) and the value of its first hour.
+    """
+    # If there are no prices from the current hour, end the function
+    if prices is None or epoch_hour(current_datetime) >= prices.start_hour + len(prices):
+        return None, None
+    series = prices.slice_from(current_datetime)
+    if not np.isfinite(series.values).all():
+        _LOGGER.warning("The PVPC prices from the current hour are not valid numbers")
         return None, None
-    # Store the first value of the series in a variable
-    first_value = float(df.iloc[0]['value'])
-    
-    # Find the length of df
-    largo_df = len(df)
 
     # At the end of the evening, there is very little information about electricity prices
     # We can assume that the price at 23h will be similar to that at 00h and 01h
-    if largo_df < 6:
+    if len(series) < 6:
         # Repeat the last value until there are 6 values
-        last_value = df['value'].iloc[-1]
-        last_date = df.index[-1]      
-        for i in range(6 - largo_df):
-            last_date = last_date + timedelta(hours=1)
-            df.loc[last_date] = last_value
+        series = series.with_values(np.concatenate([series.values, np.full(6 - len(series), series.values[-1])]))
 
-    # Modify the index directly to use isoformat date format for the dictionary keys
-    df.index = df.index.map(lambda x: x.isoformat())
+    # Return the series and the first value of the series
+    return series, float(series.values[0])
 
-    # Convert the DataFrame to a dictionary and return it
-    return df.to_dict()['value'], first_value
+async def pvpc_raw_to_useful_dict(dict_pvpc: dict[str, float], current_datetime: datetime) -> list[float]:
+    """
+    Convert a dictionary of electricity prices as obtained from the attributes of
+    the ESIOS integration sensor into a continuous dictionary with data starting from current_datetime.
+    The sensor has a dictionary of the type {'price_00h': 0.1178, 'price_01h': 0.11417, ...}
+    Sometimes it also has keys for the next day, such as 'price_00h_next_day': 0.1178
+    """
+    series, first_value = await pvpc_raw_to_series(dict_pvpc, current_datetime)
+    if series is None:
+        return None, None
+    return series.to_dict(), first_value
+
+def hourly_factors_array(df: pd.DataFrame, column: str, default: float = 1.0) -> np.ndarray:
+    """
+    Return a 24-entry array with the values of a column of a DataFrame indexed by the hour of the day.
+    The hours that are not in the DataFrame get the default value.
+    """
+    factors = np.full(24, default, dtype=np.float64)
+    if df is None or df.empty or column not in df:
+        return factors
+    hours = df.index.to_numpy(dtype=np.int64)
+    valid = (hours >= 0) & (hours < 24)
+    factors[hours[valid]] = df[column].to_numpy(dtype=np.float64)[valid]
+    return factors
+
+def apply_hourly_factors(series: HourlySeries, factors: np.ndarray) -> HourlySeries:
+    """Multiply each value of an hourly series by the factor (24-entry array) of its hour of the day."""
+    return series.with_values(series.values * factors[series.hours_of_day()])
 
 def dict_to_markdown_table(data):
     # Obtener los encabezados de las columnas
@@ -0,0 +1,112 @@
+"""
+Equivalence of the hourly energy differences calculated by InfluxDB and by pandas.
+
+The recorded counter points below are turned into the responses of the two InfluxDB 1.8 queries of
+energy_query_string: SELECT last("value") ... GROUP BY time(1h) fill(previous) (cumulative counter) and
+SELECT non_negative_difference(last("value")) ... (delta, fill(previous) applies to the hourly last values,
+the first hour and the hours where the counter decreases are omitted). The responses go through:
+- PVContollerAPI.hourly_delta_energy_dataframe (cumulative counter, differenced in pandas)
+- the add-on's hourly_energy_deltas, with the cumulative counter and with the deltas of InfluxDB
+Run with: python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+sys.path.insert(0, os.path.join(ROOT, "AnexosTFG", "Anexo15", "full_repo", "prophet-influx-multi-addon"))
+
+from component import register_package  # noqa: E402
+
+register_package()
+
+from custom_components.ess_controller.api import PVContollerAPI  # noqa: E402
+from energy_data import hourly_energy_deltas  # noqa: E402
+
+# Counter (kWh) recorded by Home Assistant at irregular times (UTC). The counter is reset at 06:40
+# (restart of the inverter) and there are no points between 08:00 and 11:00 (Home Assistant stopped)
+RECORDED_POINTS = [
+    ("2024-03-04T00:05:00Z", 10.00), ("2024-03-04T00:35:00Z", 10.20), ("2024-03-04T01:10:00Z", 10.45),
+    ("2024-03-04T01:50:00Z", 10.70), ("2024-03-04T02:20:00Z", 10.90), ("2024-03-04T03:15:00Z", 11.30),
+    ("2024-03-04T03:45:00Z", 11.45), ("2024-03-04T04:30:00Z", 11.80), ("2024-03-04T05:05:00Z", 12.00),
+    ("2024-03-04T05:55:00Z", 12.35), ("2024-03-04T06:20:00Z", 12.50), ("2024-03-04T06:40:00Z", 0.05),
+    ("2024-03-04T06:55:00Z", 0.15), ("2024-03-04T07:30:00Z", 0.40), ("2024-03-04T07:58:00Z", 0.60),
+    ("2024-03-04T11:10:00Z", 2.10), ("2024-03-04T11:50:00Z", 2.40), ("2024-03-04T12:25:00Z", 2.70),
+    ("2024-03-04T13:05:00Z", 2.95), ("2024-03-04T13:40:00Z", 3.20),
+]
+RESET_HOUR = pd.Timestamp("2024-03-04T06:00:00")
+GAP_HOURS = pd.date_range("2024-03-04T08:00:00", "2024-03-04T10:00:00", freq="h")
+
+
+def influx_last_by_hour(points) -> list[dict]:
+    """Result of SELECT last("value") AS "energy_kWh" ... GROUP BY time(1h) fill(previous)."""
+    series = pd.Series([value for _, value in points], index=pd.to_datetime([time for time, _ in points]))
+    hourly = series.resample("1h").last().ffill()
+    return [{"time": time.strftime("%Y-%m-%dT%H:%M:%SZ"), "energy_kWh": value} for time, value in hourly.items()]
+
+
+def influx_non_negative_difference(hourly: list[dict]) -> list[dict]:
+    """Result of SELECT non_negative_difference(last("value")) AS "delta_energy" ... GROUP BY time(1h) fill(previous)."""
+    rows = []
+    for previous, current in zip(hourly, hourly[1:]):
+        difference = current["energy_kWh"] - previous["energy_kWh"]
+        if difference >= 0:
+            rows.append({"time": current["time"], "delta_energy": difference})
+    return rows
+
+
+async def component_deltas(hourly: list[dict]) -> pd.DataFrame:
+    """Hourly deltas of PVContollerAPI.hourly_delta_energy_dataframe with the cumulative counter as InfluxDB response."""
+    api = PVContollerAPI(str_local_timezone="UTC")
+    try:
+        while api.class_local_timezone is None:
+            await asyncio.sleep(0)
+
+        async def dfs_from_influxdb(queries, utc=False):
+            df = pd.DataFrame({"energy_kWh": [row["energy_kWh"] for row in hourly]},
+                              index=pd.to_datetime([row["time"] for row in hourly]).tz_localize(None))
+            return [df for _ in queries]
+
+        api.dfs_from_influxdb = dfs_from_influxdb
+        return await api.hourly_delta_energy_dataframe("energy", start=datetime(2024, 3, 4), end=datetime(2024, 3, 5))
+    finally:
+        await api.async_close()
+
+
+def test_addon_delta_query_matches_cumulative_query():
+    """The add-on gets the same deltas, and the NaN in the same hours, with both kinds of query."""
+    hourly = influx_last_by_hour(RECORDED_POINTS)
+    cumulative = hourly_energy_deltas(hourly)["delta_energy"]
+    # The hours omitted by InfluxDB are missing values for Prophet, as the NaN of the cumulative branch
+    delta = hourly_energy_deltas(influx_non_negative_difference(hourly))["delta_energy"]
+    assert delta.index.isin(cumulative.index).all()
+    delta = delta.reindex(cumulative.index)
+
+    np.testing.assert_array_equal(cumulative.isna().to_numpy(), delta.isna().to_numpy())
+    assert list(cumulative.index[cumulative.isna()]) == [RESET_HOUR]
+    np.testing.assert_allclose(cumulative.dropna().to_numpy(), delta.dropna().to_numpy())
+    # fill(previous): the hours of the gap have no consumption, the first hour after it has all of it
+    assert (cumulative[GAP_HOURS] == 0).all()
+
+
+def test_component_pandas_deltas_match_influx_deltas():
+    """The deltas differenced in pandas by the component are the deltas of InfluxDB except in the reset hour."""
+    hourly = influx_last_by_hour(RECORDED_POINTS)
+    pandas_deltas = asyncio.run(component_deltas(hourly))["delta_energy"]
+    influx_deltas = hourly_energy_deltas(influx_non_negative_difference(hourly))["delta_energy"]
+    # The add-on drops the last hour (incomplete), the rest of the hours are compared
+    both = pd.DataFrame({"pandas": pandas_deltas, "influx": influx_deltas})
+    both = both[both.index <= influx_deltas.index[-1]]
+
+    assert not both["pandas"].isna().any()
+    # InfluxDB omits the hour of the reset, the component counts it as 0
+    assert list(both.index[both["influx"].isna()]) == [RESET_HOUR]
+    assert both.loc[RESET_HOUR, "pandas"] == 0
+    both = both.drop(RESET_HOUR)
+    np.testing.assert_allclose(both["pandas"].to_numpy(), both["influx"].to_numpy())
+    assert (both.loc[GAP_HOURS, "pandas"] == 0).all()
@@ -0,0 +1,110 @@
+"""
+Tests of HourlySeries and of the conversion of the forecasts and prices on the days of the DST changes.
+
+The Prophet predictions have UTC keys and are converted to naive local hours: on the day the clocks go
+forward a local hour does not exist and on the day they go back a local hour is repeated. The series
+must stay finite (the optimizer cannot use NaN) and keep the energy of all the UTC hours.
+Run with: python -m pytest tests
+"""
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from component import register_package  # noqa: E402
+
+register_package()
+
+from custom_components.ess_controller.hourly_series import HourlySeries  # noqa: E402
+from custom_components.ess_controller.utils import pvpc_raw_to_day_series, pvpc_series_from_hour  # noqa: E402
+
+TIMEZONE = "Europe/Madrid"
+# Days of the DST changes in Europe/Madrid: 02:00 does not exist, 02:00 is repeated
+SPRING_FORWARD = datetime(2026, 3, 29)
+FALL_BACK = datetime(2025, 10, 26)
+
+
+def local_index(utc_start: str, hours: int) -> pd.DatetimeIndex:
+    """Return the naive local hours of hours UTC hours from utc_start, as make_predictions converts them."""
+    return pd.date_range(utc_start, periods=hours, freq="h", tz="UTC").tz_convert(TIMEZONE).tz_localize(None)
+
+
+def test_from_index_fills_missing_hours_with_nan():
+    """The hours between the first and the last date without a value are NaN, the minutes are truncated."""
+    index = pd.DatetimeIndex(["2024-03-04 10:15", "2024-03-04 11:00", "2024-03-04 14:45"])
+    series = HourlySeries.from_index(index, [1.0, 2.0, 5.0])
+
+    assert series.start == datetime(2024, 3, 4, 10)
+    np.testing.assert_array_equal(series.values, [1.0, 2.0, np.nan, np.nan, 5.0])
+    assert len(HourlySeries.from_index(pd.DatetimeIndex([]), [])) == 0
+
+
+def test_from_index_adds_values_of_the_same_hour():
+    """The values of the same hour are added (np.add.at), not overwritten by the last one."""
+    index = pd.DatetimeIndex(["2024-03-04 10:00", "2024-03-04 10:30", "2024-03-04 10:00", "2024-03-04 11:00"])
+    series = HourlySeries.from_index(index, [1.0, 2.0, 4.0, 8.0])
+
+    np.testing.assert_array_equal(series.values, [7.0, 8.0])
+
+
+def test_fill_gaps():
+    """The NaN hours are interpolated, the ends take the nearest value and series without values are kept."""
+    series = HourlySeries(0, [np.nan, 1.0, np.nan, np.nan, 4.0, np.nan])
+    np.testing.assert_array_equal(series.fill_gaps().values, [1.0, 1.0, 2.0, 3.0, 4.0, 4.0])
+
+    complete = HourlySeries(0, [1.0, 2.0])
+    empty = HourlySeries(0, [np.nan, np.nan])
+    assert complete.fill_gaps() is complete
+    assert empty.fill_gaps() is empty
+
+
+def test_value_at():
+    """value_at returns the value of the hour of the date, None outside the series or for NaN hours."""
+    series = HourlySeries.from_start(datetime(2024, 3, 4, 10), [1.0, np.nan, 3.0])
+
+    assert series.value_at(datetime(2024, 3, 4, 10, 59)) == 1.0
+    assert series.value_at(datetime(2024, 3, 4, 12)) == 3.0
+    assert series.value_at(datetime(2024, 3, 4, 11)) is None
+    assert series.value_at(datetime(2024, 3, 4, 9)) is None
+    assert series.value_at(datetime(2024, 3, 4, 13)) is None
+
+
+@pytest.mark.parametrize("day, utc_start, utc_hours", [
+    # 00:00 local is 23:00 UTC of the previous day in winter, 22:00 UTC in summer
+    (SPRING_FORWARD, "2026-03-28T23:00:00", 23),
+    (FALL_BACK, "2025-10-25T22:00:00", 25),
+])
+def test_predictions_on_dst_days(day, utc_start, utc_hours):
+    """The predictions of the UTC hours of a DST day become a finite local series that keeps their total energy."""
+    values = np.arange(1, utc_hours + 1, dtype=np.float64) * 100
+    series = HourlySeries.from_index(local_index(utc_start, utc_hours), values).fill_gaps()
+
+    assert series.start == day
+    assert len(series) == 24
+    assert np.isfinite(series.values).all()
+    if day == SPRING_FORWARD:
+        # 02:00 does not exist, it is interpolated between 01:00 and 03:00
+        assert series.value_at(day.replace(hour=2)) == pytest.approx((values[1] + values[2]) / 2)
+        assert series.values.sum() == pytest.approx(values.sum() + series.value_at(day.replace(hour=2)))
+    else:
+        # 02:00 is repeated, it holds the energy of both hours
+        assert series.value_at(day.replace(hour=2)) == values[2] + values[3]
+        assert series.values.sum() == pytest.approx(values.sum())
+
+
+def test_pvpc_prices_on_spring_forward_day():
+    """The ESIOS sensor has no price for the skipped hour, it is interpolated so the optimizer gets finite prices."""
+    prices = {f"price_{hour:02d}h": 0.1 + hour / 100 for hour in range(24) if hour != 2}
+    series = pvpc_raw_to_day_series(prices, SPRING_FORWARD.replace(hour=5))
+
+    assert series.start == SPRING_FORWARD
+    assert series.value_at(SPRING_FORWARD.replace(hour=2)) == pytest.approx(0.12)
+    sliced, first_price = pvpc_series_from_hour(series, SPRING_FORWARD.replace(hour=1, minute=30))
+    assert sliced is not None and np.isfinite(sliced.values).all()
+    assert first_price == pytest.approx(0.11)
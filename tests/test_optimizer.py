@@ -0,0 +1,154 @@
+"""
+Regression tests of the engines of the SoC schedule.
+
+The persistent LP models (SocScheduleModel with the PuLP solvers, HighsScheduleModel built directly in HiGHS)
+must give the same objective, also when a model is reused for a new calculation, and the dynamic
+programming engine must stay close to them.
+Run with: python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pulp
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from component import register_package  # noqa: E402
+
+register_package()
+
+from custom_components.ess_controller.optimizer import SocScheduleModel, HighsScheduleModel, highspy, \
+    battery_energy_price, final_soc_weight, solve_soc_schedule_dp  # noqa: E402
+
+BATTERY_CAPACITY = 10000
+CHARGE_EFFICIENCY = 0.95
+DISCHARGE_EFFICIENCY = 0.95
+# Relative gap of the objective of the DP engine (DP_SOC_LEVELS) with hourly periods
+DP_MAX_RELATIVE_GAP = 0.01
+
+requires_highspy = pytest.mark.skipif(highspy is None, reason="highspy is not installed")
+
+
+def random_instance(seed: int, num_hours: int = 24, first_period_fraction: float = 0.7) -> dict:
+    """Return the inputs of a calculation with random forecasts and prices (the first period is pro-rated)."""
+    rng = np.random.default_rng(seed)
+    hour_of_day = np.arange(num_hours) % 24
+    solar = 3000 * np.clip(np.sin((hour_of_day - 7) / 12 * np.pi), 0, None) * rng.uniform(0.3, 1.0, num_hours)
+    demand = rng.uniform(200, 900, num_hours)
+    solar[0] *= first_period_fraction
+    demand[0] *= first_period_fraction
+    buy_prices = rng.uniform(0.05, 0.30, num_hours).tolist()
+    min_soc = 2000
+    return {
+        "demand": demand.tolist(),
+        "solar_production": solar.tolist(),
+        "buy_prices": buy_prices,
+        "sell_prices": rng.uniform(0.0, 0.10, num_hours).tolist(),
+        "initial_soc": float(rng.uniform(2500, 9000)),
+        "min_soc": min_soc,
+        "first_period_fraction": first_period_fraction,
+        "battery_energy_price": battery_energy_price(3000, BATTERY_CAPACITY, min_soc),
+        "w": final_soc_weight(demand.tolist(), solar.tolist(), buy_prices),
+    }
+
+
+def structure_key(num_hours: int, max_charge: float = 3000, max_discharge: float = 3000, max_buy: float = 5000) -> tuple:
+    """Return the structure key of the models for num_hours periods of the test battery."""
+    return SocScheduleModel.structure_key(num_hours, BATTERY_CAPACITY, max_charge, max_discharge, max_buy,
+                                          CHARGE_EFFICIENCY, DISCHARGE_EFFICIENCY)
+
+
+def solve_model(model, instance: dict):
+    """Update the model with the instance, solve it and return its solution."""
+    model.update(**instance)
+    model.solve()
+    return model.solution()
+
+
+def solve_dp(key: tuple, instance: dict):
+    """Solve the instance with the dynamic programming engine and the installation of key."""
+    _, battery_capacity, max_charge, max_discharge, max_buy, charge_efficiency, discharge_efficiency = key
+    return solve_soc_schedule_dp(instance["demand"], instance["solar_production"], instance["buy_prices"],
+                                 instance["sell_prices"], instance["initial_soc"], instance["min_soc"],
+                                 instance["first_period_fraction"], instance["battery_energy_price"], instance["w"],
+                                 battery_capacity, max_charge, max_discharge, max_buy,
+                                 charge_efficiency, discharge_efficiency)
+
+
+# PuLP solvers of SocScheduleModel and the relative tolerance of their objective (CBC reads the model from a
+# file and stops with a slightly worse objective, about 1e-4)
+PULP_SOLVER_TOLERANCES = {"HiGHS": 1e-6, "PULP_CBC_CMD": 1e-3}
+
+
+def pulp_solvers() -> list:
+    """Return the available PuLP solvers used by SocScheduleModel (the CBC included with PuLP and HiGHS)."""
+    available = pulp.listSolvers(onlyAvailable=True)
+    return [name for name in PULP_SOLVER_TOLERANCES if name in available]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_dp_objective_close_to_lp(seed):
+    """The DP engine is feasible for the LP, its objective is at most DP_MAX_RELATIVE_GAP worse."""
+    instance = random_instance(seed)
+    key = structure_key(24)
+    lp = solve_model(SocScheduleModel(*key), instance)
+    dp = solve_dp(key, instance)
+
+    assert lp.status == dp.status == "Optimal"
+    assert dp.objective >= lp.objective - 1e-6
+    assert dp.objective - lp.objective <= DP_MAX_RELATIVE_GAP * abs(lp.objective)
+    assert min(dp.soc[1:]) >= instance["min_soc"] - 1e-6
+    assert dp.soc[-1] >= instance["initial_soc"] - 1e-6
+
+
+@requires_highspy
+@pytest.mark.parametrize("solver", pulp_solvers())
+@pytest.mark.parametrize("num_hours", [24, 96])
+def test_highs_model_matches_pulp_model(solver, num_hours):
+    """The model built directly in HiGHS gives the objective of the PuLP model."""
+    instance = random_instance(num_hours, num_hours)
+    key = structure_key(num_hours)
+    pulp_model = SocScheduleModel(*key)
+    pulp_model._solver = pulp.getSolver(solver, msg=False)
+    expected = solve_model(pulp_model, instance)
+    solution = solve_model(HighsScheduleModel(*key), instance)
+
+    assert expected.status == solution.status == "Optimal"
+    assert solution.objective == pytest.approx(expected.objective, rel=PULP_SOLVER_TOLERANCES[solver], abs=1e-6)
+    assert solution.objective <= expected.objective + 1e-6
+
+
+@pytest.mark.parametrize("model_class", [SocScheduleModel, pytest.param(HighsScheduleModel, marks=requires_highspy)])
+def test_model_reused_across_updates(model_class):
+    """A model updated with new data (and warm started) gives the objective of a model built for that data."""
+    key = structure_key(24)
+    model = model_class(*key)
+    first = solve_model(model, random_instance(10))
+    second = solve_model(model, random_instance(11, first_period_fraction=0.25))
+    fresh = solve_model(model_class(*key), random_instance(11, first_period_fraction=0.25))
+
+    assert first.status == second.status == fresh.status == "Optimal"
+    assert second.objective == pytest.approx(fresh.objective, rel=1e-6, abs=1e-6)
+    assert second.objective != pytest.approx(first.objective)
+
+
+@pytest.mark.parametrize("model_class", [SocScheduleModel, pytest.param(HighsScheduleModel, marks=requires_highspy)])
+def test_initial_soc_below_min_soc(model_class):
+    """Below the minimum SoC, the SoC is recovered in the first period, or the problem is infeasible if it cannot be."""
+    key = structure_key(6, max_charge=1000, max_discharge=1000, max_buy=3000)
+    instance = random_instance(0, 6, first_period_fraction=1.0)
+    instance.update(initial_soc=1000, min_soc=2000)
+
+    # 1000 Wh can be charged in the first period
+    for solution in (solve_model(model_class(*key), instance), solve_dp(key, instance)):
+        assert solution.status == "Optimal"
+        assert solution.soc[0] == pytest.approx(2000, abs=1e-3)
+        assert min(solution.soc) >= 2000 - 1e-3
+
+    # 3000 Wh more are needed at the end of the second period, only 1000 Wh can be charged
+    instance.update(min_soc=5000)
+    assert solve_model(model_class(*key), instance).status == "Infeasible"
+    assert solve_dp(key, instance).status == "Infeasible"
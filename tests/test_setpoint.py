@@ -0,0 +1,101 @@
+"""
+Tests of the grid setpoint that follows the dispatch plan (GridSetpointController).
+
+The setpoint follows the net grid energy of the plan (from_grid - to_grid) of each period, corrected by the
+deviation of the SoC from the plan, and is sent to the inverter between SETPOINT_IDLE_W and the maximum power.
+Run with: python -m pytest tests
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+from component import register_package  # noqa: E402
+
+register_package()
+
+from custom_components.ess_controller.setpoint import GridSetpointController, SETPOINT_IDLE_W, \
+    SETPOINT_SOC_GAIN  # noqa: E402
+
+START = datetime(2024, 3, 4, 10, 0)
+MAX_SETPOINT_W = 3000
+BATTERY_CAPACITY_WH = 10000
+CHARGE_EFFICIENCY = 0.95
+INITIAL_SOC_WH = 5000
+
+
+def controller_with_plan(from_grid: list[float], to_grid: list[float], soc: list[float],
+                         start: datetime = START, period_minutes: int = 60) -> GridSetpointController:
+    """Return a controller following a plan with the grid energies and SoCs (Wh) of each period."""
+    controller = GridSetpointController(MAX_SETPOINT_W, BATTERY_CAPACITY_WH, CHARGE_EFFICIENCY)
+    controller.set_plan({"from_grid(Wh)": from_grid, "to_grid(Wh)": to_grid, "SoC(Wh)": soc},
+                        start, period_minutes, INITIAL_SOC_WH)
+    return controller
+
+
+def soc_percent(soc_Wh: float) -> float:
+    """Return the SoC (%) of the test battery."""
+    return 100 * soc_Wh / BATTERY_CAPACITY_WH
+
+
+@pytest.mark.parametrize("from_grid, to_grid, expected_W", [
+    (1000, 0, 1000),
+    # The setpoint follows the net energy from the grid
+    (1200, 200, 1000),
+    # Energy sent to the grid: the battery covers the demand, the setpoint is the idle one
+    (500, 1500, SETPOINT_IDLE_W),
+])
+def test_setpoint_follows_net_grid_energy(from_grid, to_grid, expected_W):
+    """On plan, the setpoint is the net grid energy (from_grid - to_grid) of the period spread over the period."""
+    controller = controller_with_plan([from_grid], [to_grid], [INITIAL_SOC_WH])
+
+    assert controller.update(START, soc_percent(INITIAL_SOC_WH)) == expected_W
+
+
+def test_setpoint_clamped_to_max():
+    """The setpoint never exceeds the maximum power, even if the plan or the SoC deviation ask for more."""
+    controller = controller_with_plan([5000], [0], [INITIAL_SOC_WH])
+    assert controller.update(START, soc_percent(INITIAL_SOC_WH)) == MAX_SETPOINT_W
+
+    controller = controller_with_plan([2000], [0], [INITIAL_SOC_WH])
+    assert controller.update(START, soc_percent(INITIAL_SOC_WH - 3000)) == MAX_SETPOINT_W
+
+
+def test_soc_deviation_gain():
+    """A SoC behind the plan increases the setpoint by SETPOINT_SOC_GAIN of the charge needed to recover it."""
+    controller = controller_with_plan([1000], [0], [INITIAL_SOC_WH + 1000])
+    on_plan = controller.update(START, soc_percent(INITIAL_SOC_WH))
+    # At half of the period the plan expects 5500 Wh, the battery is 1000 Wh behind
+    behind = controller.update(START + timedelta(minutes=30), soc_percent(INITIAL_SOC_WH - 500))
+
+    expected_W = (1000 / 2 + SETPOINT_SOC_GAIN * 1000 / CHARGE_EFFICIENCY) / 0.5
+    assert on_plan == 1000
+    assert behind == pytest.approx(expected_W, abs=10)
+
+    # A SoC ahead of the plan lowers the setpoint, at most down to the idle setpoint
+    ahead = controller.update(START + timedelta(minutes=31), soc_percent(INITIAL_SOC_WH + 2000))
+    assert ahead == SETPOINT_IDLE_W
+
+
+def test_end_of_period():
+    """The rest of the period is at least one minute, and the next period starts from its own planned energy."""
+    controller = controller_with_plan([1000, 500], [0, 0], [INITIAL_SOC_WH, INITIAL_SOC_WH], period_minutes=15)
+    assert controller.update(START, None, grid_power_W=4000) == MAX_SETPOINT_W
+
+    # 15 seconds before the end 33 Wh are pending: spread over the minimum of one minute, not 15 seconds
+    controller.update(START + timedelta(minutes=14, seconds=30), None, grid_power_W=4000)
+    before_end = controller.update(START + timedelta(minutes=14, seconds=45), None, grid_power_W=0)
+    delivered_Wh = 4000 * 14.5 / 60
+    assert before_end == pytest.approx((1000 - delivered_Wh) * 60, abs=10)
+
+    # The second period starts: the energy delivered before its first update is assumed to follow the plan
+    assert controller.update(START + timedelta(minutes=15), None) == 2000
+    assert controller.update(START + timedelta(minutes=20), None, grid_power_W=2000) == 2000
+
+    # After the end of the plan there is no setpoint
+    assert controller.update(START + timedelta(minutes=30), None) is None
+    assert controller.update(START - timedelta(minutes=1), None) is None
@@ -0,0 +1,367 @@
+"""
+Backtest of the ESS Controller: replays historical days through the calculation pipeline.
+
+Every hour of the replayed days runs the same steps as the coordinator with the data known at that moment:
+- prices: attributes of the ESIOS sensor (today, and tomorrow from NEXT_DAY_PRICES_HOUR) -> pvpc_raw_to_series
+- solar forecast: Forecast.Solar data (today and tomorrow) -> forecast_solar_api_to_series, corrected by
+  make_effective_forecast_solar with the comparison of production and forecast of the previous days
+- demand forecast: the recorded forecast if there is one, else the built-in ridge forecaster trained with the previous days
+- target SoCs: make_target_socs (pulp_calculations with the selected optimizer engine)
+Then a simulated battery follows the target SoC of the hour as the setpoint of the coordinator does, with the
+real demand and solar production. The realized cost is compared with the cost without battery and with the
+battery in self-consumption only (never charged from the grid).
+
+The days are replayed in chunks of consecutive days (the SoC carries over between the days of a chunk) that run
+in parallel in a process pool. The history is a CSV file with an hourly 'time' column (naive local time) and the
+columns buy, sell (€/kWh), demand, solar and solar_forecast (Wh), optionally demand_forecast (Wh), or the
+synthetic data of tools/benchmark.py. Examples:
+
+    python tools/backtest.py --synthetic --days 365
+    python tools/backtest.py --csv history.csv --start 2024-01-01 --days 180 --engine dp --save days.csv
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# The modules of the integration are imported without its Home Assistant __init__
+from component import register_package
+
+register_package()
+
+from custom_components.ess_controller.api import PVContollerAPI  # noqa: E402
+from custom_components.ess_controller.const import DEMAND_FORECAST_PERIODS, HISTORY_SOLAR_MAX_DAYS, OPTIMIZER_ENGINES, \
+    OPTIMIZER_ENGINE_PULP, BATTERY_EOL_CYCLES_IF_MIN_SOC_20, BATTERY_EOL_CYCLES_IF_MIN_SOC_50  # noqa: E402
+from custom_components.ess_controller.demand_forecast import FourierRidgeForecaster  # noqa: E402
+from custom_components.ess_controller.hourly_series import HourlySeries, epoch_hour  # noqa: E402
+from custom_components.ess_controller.optimizer import battery_energy_price  # noqa: E402
+from custom_components.ess_controller.utils import forecast_solar_api_to_series, pvpc_raw_to_series  # noqa: E402
+from benchmark import START, synthetic_hourly  # noqa: E402
+
+_LOGGER = logging.getLogger(__name__)
+
+# Columns of the history (prices in €/kWh, energies in Wh of each hour)
+COLUMNS = ["buy", "sell", "demand", "solar", "solar_forecast"]
+# Hour from which the ESIOS sensor has the prices of the next day (they are published at about 20:30)
+NEXT_DAY_PRICES_HOUR = 21
+# Days of history before the first replayed day (solar forecast comparison and demand forecaster training)
+WARMUP_DAYS = max(HISTORY_SOLAR_MAX_DAYS, 7)
+# Days of history used to train the demand forecaster
+DEMAND_TRAIN_DAYS = 90
+
+
+@dataclass
+class BacktestConfig:
+    """Installation and controller parameters of the replay (the same meaning as in the configuration flow)."""
+    battery_capacity_Wh: float = 10000
+    max_charge_energy_per_period_Wh: float = 3000
+    max_discharge_energy_per_period_Wh: float = 3000
+    max_buy_energy_per_period_Wh: float = 5000
+    charge_efficiency: float = 0.95
+    discharge_efficiency: float = 0.95
+    battery_purchase_price: float = 3000
+    battery_eol_cycles_if_min_soc_20: float = BATTERY_EOL_CYCLES_IF_MIN_SOC_20
+    battery_eol_cycles_if_min_soc_50: float = BATTERY_EOL_CYCLES_IF_MIN_SOC_50
+    final_soc_weight_factor: float = 1.0
+    min_soc_percent: float = 20
+    soc_safety_margin: float = 10
+    initial_soc_percent: float = 50
+    sell_allowed: bool = False
+    enable_fore_to_real_correction: bool = True
+    optimizer_engine: str = OPTIMIZER_ENGINE_PULP
+
+    @property
+    def current_min_soc(self) -> float:
+        """Return the minimum SoC (%) used in the calculation, as update_current_min_soc of the coordinator."""
+        return self.min_soc_percent + self.soc_safety_margin
+
+
+def synthetic_history(days: int, seed: int) -> pd.DataFrame:
+    """Return the synthetic hourly history of tools/benchmark.py with a biased and noisy solar forecast."""
+    data = synthetic_hourly(24 * days, seed)
+    rng = np.random.default_rng(seed + 1)
+    # Error of the solar forecast: a random factor for each day and an overestimation of 15%
+    daily_error = np.repeat(rng.lognormal(0, 0.25, days), 24)
+    index = pd.date_range(START, periods=24 * days, freq="h", name="time")
+    return pd.DataFrame({"buy": data["buy"], "sell": data["sell"], "demand": data["demand"], "solar": data["solar"],
+                         "solar_forecast": data["solar"] * daily_error * 1.15}, index=index)
+
+
+def load_history(path: str) -> pd.DataFrame:
+    """Read the hourly history from a CSV file (the missing hours are NaN)."""
+    df = pd.read_csv(path, parse_dates=["time"], index_col="time")
+    missing = [column for column in COLUMNS if column not in df.columns]
+    if missing:
+        raise ValueError(f"Missing columns in {path}: {', '.join(missing)}")
+    return df.resample("h").mean()
+
+
+def esios_attributes(prices: np.ndarray, day: int, hour: int) -> dict[str, float]:
+    """Return the price attributes of the ESIOS sensor at the given hour of the day starting at the index day."""
+    data = {f"price_{h:02d}h": float(prices[day + h]) for h in range(24)}
+    if hour >= NEXT_DAY_PRICES_HOUR and day + 48 <= len(prices):
+        data.update({f"price_next_day_{h:02d}h": float(prices[day + 24 + h]) for h in range(24)})
+    return data
+
+
+def forecast_solar_data(index: pd.DatetimeIndex, forecast: np.ndarray, day: int) -> dict[str, float]:
+    """Return the data downloaded from Forecast.Solar at the day starting at the index day (today and tomorrow, Wh)."""
+    end = min(day + 48, len(forecast))
+    return {(index[i] + timedelta(minutes=30)).strftime("%Y-%m-%d %H:%M:%S"): float(forecast[i]) for i in range(day, end)}
+
+
+def simulate_hour(config: BacktestConfig, soc: float, target: float | None, demand: float, solar: float) -> tuple:
+    """
+    Return the SoC at the end of the hour and the energies (Wh) from the grid, to the grid, to and from the battery
+    when the battery follows the target SoC as update_proposed_setpoint does. Below the target the grid setpoint is
+    the maximum and the battery is charged up to the target. At the target or above it the grid setpoint is 10 W:
+    the battery covers the demand not covered by the solar production down to the minimum SoC and stores the surplus.
+    Without target SoC (failed calculation) the coordinator uses the maximum setpoint.
+    """
+    capacity = config.battery_capacity_Wh
+    min_soc = config.current_min_soc * capacity / 100
+    if target is None:
+        target = capacity
+    net = demand - solar
+    to_battery = from_battery = 0.0
+    if soc < target:
+        # Energy that the grid can provide beyond the demand not covered by the solar production
+        available = max(config.max_buy_energy_per_period_Wh - net, 0)
+        to_battery = min(target - soc, config.max_charge_energy_per_period_Wh, available * config.charge_efficiency)
+        if net < 0:
+            # The solar surplus is also stored, even beyond the target
+            to_battery = max(to_battery, min(-net * config.charge_efficiency, config.max_charge_energy_per_period_Wh, capacity - soc))
+        net += to_battery / config.charge_efficiency
+    elif net > 0:
+        from_battery = min(net / config.discharge_efficiency, config.max_discharge_energy_per_period_Wh, max(soc - min_soc, 0))
+        net -= from_battery * config.discharge_efficiency
+    else:
+        to_battery = min(-net * config.charge_efficiency, config.max_charge_energy_per_period_Wh, max(capacity - soc, 0))
+        net += to_battery / config.charge_efficiency
+    return soc + to_battery - from_battery, max(net, 0.0), max(-net, 0.0), to_battery, from_battery
+
+
+async def replay_chunk(history: pd.DataFrame, first_day: int, num_days: int, config: BacktestConfig) -> list[dict]:
+    """
+    Replay num_days days from the day index first_day of the history (hourly, starting at 00:00)
+    and return the results of each day. The SoC carries over between the days.
+    """
+    api = PVContollerAPI(battery_capacity_Wh=config.battery_capacity_Wh,
+                         max_charge_energy_per_period_Wh=config.max_charge_energy_per_period_Wh,
+                         max_discharge_energy_per_period_Wh=config.max_discharge_energy_per_period_Wh,
+                         max_buy_energy_per_period_Wh=config.max_buy_energy_per_period_Wh,
+                         charge_efficiency=config.charge_efficiency, discharge_efficiency=config.discharge_efficiency,
+                         battery_purchase_price=config.battery_purchase_price,
+                         battery_eol_cycles_if_min_soc_20=config.battery_eol_cycles_if_min_soc_20,
+                         battery_eol_cycles_if_min_soc_50=config.battery_eol_cycles_if_min_soc_50,
+                         final_soc_weight_factor=config.final_soc_weight_factor,
+                         enable_fore_to_real_correction=config.enable_fore_to_real_correction,
+                         sell_allowed=config.sell_allowed, optimizer_engine=config.optimizer_engine)
+    capacity = config.battery_capacity_Wh
+    await api.set_current_min_soc(config.current_min_soc)
+    energy_price_battery = battery_energy_price(config.battery_purchase_price, capacity, api._current_min_soc_Wh,
+                                                config.battery_eol_cycles_if_min_soc_20, config.battery_eol_cycles_if_min_soc_50)
+
+    index = history.index
+    columns = {column: history[column].to_numpy(dtype=np.float64) for column in history.columns}
+    sell = columns["sell"] if config.sell_allowed else np.zeros(len(index))
+    demand_forecast = columns.get("demand_forecast")
+    # SoC of the battery controlled by the target SoCs and of the battery in self-consumption only
+    soc = self_soc = config.initial_soc_percent * capacity / 100
+    results = []
+    try:
+        for day in range(first_day, first_day + num_days):
+            d0 = 24 * day
+            window = slice(d0, d0 + 24)
+            if any(np.isnan(columns[column][window]).any() for column in COLUMNS):
+                _LOGGER.warning(f"Day {index[d0]:%Y-%m-%d} skipped, there are hours without data")
+                continue
+            t0 = time.perf_counter()
+
+            # Solar forecast correction with the production and the forecast of the previous days (kWh)
+            previous = slice(max(d0 - 24 * HISTORY_SOLAR_MAX_DAYS, 0), d0)
+            api.df_history_solar_production = pd.DataFrame({"delta_energy": columns["solar"][previous] / 1000}, index=index[previous])
+            api.df_hystory_forecast_solar = pd.DataFrame({"delta_energy": columns["solar_forecast"][previous] / 1000}, index=index[previous])
+            await api.compare_solar_production_forecast()
+
+            # Demand forecast of the day and of the next hours
+            if demand_forecast is not None and not np.isnan(demand_forecast[window]).any():
+                demand_predictions = HourlySeries.from_start(index[d0], demand_forecast[d0:d0 + 24 + DEMAND_FORECAST_PERIODS])
+                demand_bands = None
+            else:
+                train = slice(max(d0 - 24 * DEMAND_TRAIN_DAYS, 0), d0)
+                forecaster = FourierRidgeForecaster().fit(HourlySeries.from_start(index[train.start], columns["demand"][train]))
+                demand_predictions = forecaster.predict(epoch_hour(index[d0]), 24 + DEMAND_FORECAST_PERIODS)
+                demand_bands = forecaster.predict_interval(epoch_hour(index[d0]), 24 + DEMAND_FORECAST_PERIODS)
+
+            forecast_solar = forecast_solar_data(index, columns["solar_forecast"], d0)
+            day_result = {"date": index[d0].date(), "initial_soc": 100 * soc / capacity, "baseline_cost": 0.0,
+                          "self_consumption_cost": 0.0, "cost": 0.0, "battery_cost": 0.0, "discharged_Wh": 0.0,
+                          "min_soc": 100 * soc / capacity, "failed_calculations": 0}
+            for hour in range(24):
+                i = d0 + hour
+                current_datetime = index[i].to_pydatetime()
+                buy_prices, _ = await pvpc_raw_to_series(esios_attributes(columns["buy"], d0, hour), current_datetime)
+                sell_prices, _ = await pvpc_raw_to_series(esios_attributes(columns["sell"], d0, hour), current_datetime)
+                await api.set_pvpc_buy_prices(buy_prices)
+                await api.set_pvpc_sell_prices(sell_prices)
+                forecast_solar_series, _ = await forecast_solar_api_to_series(forecast_solar, current_datetime)
+                await api.set_forecast_solar(forecast_solar_series)
+                await api.make_effective_forecast_solar()
+                if demand_bands is None:
+                    api.store_demand_predictions(demand_predictions.slice_from(current_datetime))
+                else:
+                    api.store_demand_predictions(demand_predictions.slice_from(current_datetime),
+                                                 *(band.slice_from(current_datetime) for band in demand_bands))
+                await api.set_current_initial_soc(100 * soc / capacity)
+
+                target = None
+                try:
+                    if await api.make_target_socs(current_datetime, force_update=True):
+                        target = api.pulp_json_results["SoC(Wh)"][0]
+                except TypeError:
+                    # pulp_calculations did not find a solution
+                    pass
+                if target is None:
+                    day_result["failed_calculations"] += 1
+
+                demand, solar = columns["demand"][i], columns["solar"][i]
+                buy = columns["buy"][i]
+                soc, from_grid, to_grid, _, from_battery = simulate_hour(config, soc, target, demand, solar)
+                day_result["cost"] += (from_grid * buy - to_grid * sell[i]) / 1000
+                day_result["battery_cost"] += from_battery * energy_price_battery / 1000
+                day_result["discharged_Wh"] += from_battery
+                day_result["min_soc"] = min(day_result["min_soc"], 100 * soc / capacity)
+                self_soc, from_grid, to_grid, _, _ = simulate_hour(config, self_soc, 0.0, demand, solar)
+                day_result["self_consumption_cost"] += (from_grid * buy - to_grid * sell[i]) / 1000
+                net = demand - solar
+                day_result["baseline_cost"] += (max(net, 0) * buy - max(-net, 0) * sell[i]) / 1000
+
+            day_result["final_soc"] = 100 * soc / capacity
+            day_result["seconds"] = time.perf_counter() - t0
+            results.append(day_result)
+    finally:
+        await api.async_close()
+    return results
+
+
+def run_chunk(task: tuple) -> list[dict]:
+    """Replay a chunk of days in a worker process."""
+    history, first_day, num_days, config = task
+    logging.basicConfig(level=logging.WARNING)
+    return asyncio.run(replay_chunk(history, first_day, num_days, config))
+
+
+def backtest_tasks(history: pd.DataFrame, start: datetime, days: int, config: BacktestConfig, chunk_days: int = 7) -> list[tuple]:
+    """
+    Return the tasks of run_chunk that replay days days of the history from the date start in chunks of chunk_days days.
+    The history must begin at 00:00 and have at least WARMUP_DAYS days before start.
+    """
+    first_day = (epoch_hour(start) - epoch_hour(history.index[0].to_pydatetime())) // 24
+    if first_day < WARMUP_DAYS:
+        raise ValueError(f"The history must have at least {WARMUP_DAYS} days before {start:%Y-%m-%d}")
+    # The prices and the forecasts of the next day are needed in the last replayed day
+    last_day = min(first_day + days, len(history) // 24 - 1)
+    tasks = []
+    for chunk_start in range(first_day, last_day, chunk_days):
+        chunk_end = min(chunk_start + chunk_days, last_day)
+        # Each worker receives the days of its chunk, the warmup days before them and the next day
+        offset = max(chunk_start - max(WARMUP_DAYS, DEMAND_TRAIN_DAYS), 0)
+        piece = history.iloc[24 * offset:24 * (chunk_end + 1)]
+        tasks.append((piece, chunk_start - offset, chunk_end - chunk_start, config))
+    return tasks
+
+
+def backtest(history: pd.DataFrame, start: datetime, days: int, config: BacktestConfig,
+             chunk_days: int = 7, workers: int | None = None) -> pd.DataFrame:
+    """Replay the days in a process pool and return the results of each day."""
+    tasks = backtest_tasks(history, start, days, config, chunk_days)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = [day for chunk in executor.map(run_chunk, tasks) for day in chunk]
+    return pd.DataFrame(results)
+
+
+def summary(days: pd.DataFrame) -> pd.DataFrame:
+    """Return the costs (€) of each month and of the whole backtest."""
+    costs = days.assign(month=pd.to_datetime(days["date"]).dt.strftime("%Y-%m"))
+    costs["total_cost"] = costs["cost"] + costs["battery_cost"]
+    costs = costs.groupby("month")[["baseline_cost", "self_consumption_cost", "cost", "battery_cost", "total_cost"]].sum()
+    costs.loc["total"] = costs.sum()
+    costs["savings"] = costs["baseline_cost"] - costs["total_cost"]
+    return costs
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--synthetic", action="store_true", help="Use the synthetic data of tools/benchmark.py")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    parser.add_argument("--csv", help="CSV file with the hourly history")
+    parser.add_argument("--start", help="First replayed day (YYYY-MM-DD), by default after the warmup days")
+    parser.add_argument("--days", type=int, default=365, help="Number of replayed days")
+    parser.add_argument("--chunk-days", type=int, default=7, help="Consecutive days replayed by each task")
+    parser.add_argument("--workers", type=int, help="Worker processes, by default the number of CPUs")
+    parser.add_argument("--engine", choices=OPTIMIZER_ENGINES, default=OPTIMIZER_ENGINE_PULP, help="Optimizer engine")
+    parser.add_argument("--capacity", type=float, default=10000, help="Battery capacity (Wh)")
+    parser.add_argument("--max-charge", type=float, default=3000, help="Maximum charge energy per hour (Wh)")
+    parser.add_argument("--max-discharge", type=float, default=3000, help="Maximum discharge energy per hour (Wh)")
+    parser.add_argument("--max-buy", type=float, default=5000, help="Maximum energy bought per hour (Wh)")
+    parser.add_argument("--efficiency", type=float, default=0.95, help="Charge and discharge efficiency")
+    parser.add_argument("--battery-price", type=float, default=3000, help="Battery purchase price (€)")
+    parser.add_argument("--min-soc", type=float, default=20, help="Minimum SoC chosen by the user (%%)")
+    parser.add_argument("--safety-margin", type=float, default=10, help="SoC safety margin (%%)")
+    parser.add_argument("--sell", action="store_true", help="The energy sent to the grid is paid at the sell price")
+    parser.add_argument("--no-correction", action="store_true", help="Do not correct the solar forecast with the history")
+    parser.add_argument("--save", help="Save the results of each day to a CSV file")
+    args = parser.parse_args()
+    if args.synthetic == bool(args.csv):
+        parser.error("use either --synthetic or --csv")
+    if args.days < 1 or args.chunk_days < 1:
+        parser.error("--days and --chunk-days must be at least 1")
+    return args
+
+
+def main(args: argparse.Namespace) -> int:
+    """Run the backtest and print the costs."""
+    if args.synthetic:
+        history = synthetic_history(WARMUP_DAYS + args.days + 1, args.seed)
+    else:
+        history = load_history(args.csv)
+        # The history starts at 00:00 of its first complete day
+        first_midnight = history.index[0].ceil("D")
+        history = history[history.index >= first_midnight]
+    start = pd.to_datetime(args.start).to_pydatetime() if args.start else \
+        (history.index[0] + timedelta(days=WARMUP_DAYS)).to_pydatetime()
+    config = replace(BacktestConfig(), battery_capacity_Wh=args.capacity, max_charge_energy_per_period_Wh=args.max_charge,
+                     max_discharge_energy_per_period_Wh=args.max_discharge, max_buy_energy_per_period_Wh=args.max_buy,
+                     charge_efficiency=args.efficiency, discharge_efficiency=args.efficiency,
+                     battery_purchase_price=args.battery_price, min_soc_percent=args.min_soc,
+                     soc_safety_margin=args.safety_margin, sell_allowed=args.sell,
+                     enable_fore_to_real_correction=not args.no_correction, optimizer_engine=args.engine)
+
+    t0 = time.perf_counter()
+    days = backtest(history, start, args.days, config, args.chunk_days, args.workers)
+    elapsed = time.perf_counter() - t0
+    if days.empty:
+        print("No day could be replayed")
+        return 1
+    if args.save:
+        days.to_csv(args.save, index=False)
+
+    pd.set_option("display.width", 200)
+    print(summary(days).round(2).to_string())
+    print(f"{len(days)} days replayed in {elapsed:.1f} s ({days['seconds'].sum():.1f} s of calculation), "
+          f"{int(days['failed_calculations'].sum())} hours without target SoC")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(parse_args()))
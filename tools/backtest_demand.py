@@ -0,0 +1,160 @@
+"""
+Backtest of the demand forecasters.
+
+Replays the last days of the demand history: for each day the forecasters are trained with the
+history before 00:00 and forecast the next hours, which are compared with the real demand.
+Compared forecasters:
+- ridge: FourierRidgeForecaster, the built-in NumPy engine
+- naive: the same hour one week before (reference)
+- prophet: Prophet fitted in this process, only if the prophet package is installed
+
+The history is the synthetic demand of tools/benchmark.py or the demand read from InfluxDB
+(grid to consumers plus inverter to consumers, as in make_predictions). Examples:
+
+    python tools/backtest_demand.py --synthetic --days 365 --folds 28
+    python tools/backtest_demand.py --url http://192.168.0.100:8086 --password secret \\
+        --grid-entity victron_vebus_acin1toacout_228 --inverter-entity victron_vebus_invertertoacout_228
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# The modules of the integration are imported without its Home Assistant __init__
+from component import register_package
+
+register_package()
+
+from custom_components.ess_controller.api import PVContollerAPI  # noqa: E402
+from custom_components.ess_controller.demand_forecast import FourierRidgeForecaster, seasonal_naive_forecast  # noqa: E402
+from custom_components.ess_controller.hourly_series import HourlySeries  # noqa: E402
+from benchmark import START, synthetic_hourly  # noqa: E402
+
+try:
+    from prophet import Prophet
+except ImportError:
+    Prophet = None
+
+
+def ridge_forecast(train: HourlySeries, start_hour: int, periods: int) -> HourlySeries:
+    """Forecast with the built-in ridge regression forecaster."""
+    return FourierRidgeForecaster().fit(train).predict(start_hour, periods)
+
+
+def naive_forecast(train: HourlySeries, start_hour: int, periods: int) -> HourlySeries:
+    """Forecast with the value of the same hour one week before."""
+    return seasonal_naive_forecast(train, start_hour, periods)
+
+
+def prophet_forecast(train: HourlySeries, start_hour: int, periods: int) -> HourlySeries:
+    """Forecast with Prophet as the Addon does (default model, NaN hours are ignored)."""
+    df = pd.DataFrame({"ds": train.index, "y": train.values})
+    model = Prophet()
+    model.fit(df)
+    future = pd.DataFrame({"ds": HourlySeries(start_hour, np.zeros(periods)).index})
+    return HourlySeries(start_hour, model.predict(future)["yhat"].to_numpy())
+
+
+async def influx_history(args: argparse.Namespace) -> HourlySeries | None:
+    """Read the hourly demand of the last days from InfluxDB."""
+    api = PVContollerAPI(influx_db_url=args.url, influx_db_user=args.user, influx_db_pass=args.password,
+                         influx_db_database=args.database, acin_to_acout_sensor=f"sensor.{args.grid_entity}",
+                         inverter_to_acout_sensor=f"sensor.{args.inverter_entity}", str_local_timezone=args.timezone)
+    try:
+        # Wait for the timezone set in a task by the constructor
+        while api.class_local_timezone is None:
+            await asyncio.sleep(0)
+        start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=args.days)
+        return await api.demand_history_series(start)
+    finally:
+        await api.async_close()
+
+
+def backtest(history: HourlySeries, forecasters: dict, folds: int, train_days: int, horizon: int) -> dict:
+    """Return the errors (Wh) and the fit times (ms) of each forecaster in the last folds days of the history."""
+    results = {name: {"abs": [], "sq": [], "ms": []} for name in forecasters}
+    end_hour = history.start_hour + len(history)
+    # Origins at 00:00 of the last days with a complete horizon after them
+    last_origin = (end_hour - horizon) // 24 * 24
+    origins = [last_origin - 24 * i for i in range(folds)][::-1]
+    for origin in origins:
+        train_start = max(origin - 24 * train_days, history.start_hour)
+        if origin - train_start < 24 * 7:
+            continue
+        train = HourlySeries(train_start, history.values[train_start - history.start_hour:origin - history.start_hour])
+        actual = history.values[origin - history.start_hour:origin - history.start_hour + horizon]
+        valid = ~np.isnan(actual)
+        for name, forecaster in forecasters.items():
+            t0 = time.perf_counter()
+            forecast = forecaster(train, origin, horizon).values
+            results[name]["ms"].append(1000 * (time.perf_counter() - t0))
+            error = (forecast - actual)[valid & ~np.isnan(forecast)] * 1000
+            results[name]["abs"].extend(np.abs(error).tolist())
+            results[name]["sq"].extend((error ** 2).tolist())
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--synthetic", action="store_true", help="Use the synthetic demand of tools/benchmark.py")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    parser.add_argument("--url", help="URL of InfluxDB, e.g. http://192.168.0.100:8086")
+    parser.add_argument("--user", default="homeassistant", help="InfluxDB user")
+    parser.add_argument("--password", default="", help="InfluxDB password")
+    parser.add_argument("--database", default="homeassistant", help="InfluxDB database")
+    parser.add_argument("--grid-entity", help="entity_id (without the domain) of the energy from the grid to the consumers")
+    parser.add_argument("--inverter-entity", help="entity_id (without the domain) of the energy from the inverter to the consumers")
+    parser.add_argument("--timezone", default="Europe/Madrid", help="Local timezone of Home Assistant")
+    parser.add_argument("--days", type=int, default=365, help="Days of history")
+    parser.add_argument("--train-days", type=int, default=365, help="Days of history used to train each forecast")
+    parser.add_argument("--folds", type=int, default=28, help="Number of days replayed")
+    parser.add_argument("--horizon", type=int, default=30, help="Hours of each forecast")
+    parser.add_argument("--no-prophet", action="store_true", help="Do not run Prophet even if it is installed")
+    args = parser.parse_args()
+    if not args.synthetic and not (args.url and args.grid_entity and args.inverter_entity):
+        parser.error("use --synthetic or give --url, --grid-entity and --inverter-entity")
+    if args.days < 8 or args.folds < 1 or args.horizon < 1:
+        parser.error("--days must be at least 8, --folds and --horizon at least 1")
+    return args
+
+
+async def main(args: argparse.Namespace) -> int:
+    """Run the backtest and print the errors of each forecaster."""
+    if args.synthetic:
+        # Synthetic demand in Wh, the history of the component is in kWh
+        history = HourlySeries.from_start(START, synthetic_hourly(24 * args.days, args.seed)["demand"] / 1000)
+    else:
+        history = await influx_history(args)
+        if history is None:
+            print("No demand history in InfluxDB")
+            return 1
+
+    forecasters = {"ridge": ridge_forecast, "naive": naive_forecast}
+    if Prophet is not None and not args.no_prophet:
+        # cmdstanpy logs every fit at info level
+        logging.getLogger("cmdstanpy").setLevel(logging.WARNING)
+        forecasters["prophet"] = prophet_forecast
+    elif not args.no_prophet:
+        print("The prophet package is not installed, Prophet is not compared")
+
+    results = backtest(history, forecasters, args.folds, args.train_days, args.horizon)
+    print(f"{len(history)} hours of history, {args.folds} days replayed, horizon {args.horizon} h")
+    print(f"{'forecaster':<12} {'MAE (Wh)':>10} {'RMSE (Wh)':>10} {'fit p50 (ms)':>13}")
+    for name, result in results.items():
+        if not result["abs"]:
+            print(f"{name:<12} no forecasts (not enough history)")
+            continue
+        print(f"{name:<12} {np.mean(result['abs']):>10.1f} {np.sqrt(np.mean(result['sq'])):>10.1f} "
+              f"{np.median(result['ms']):>13.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(main(parse_args())))
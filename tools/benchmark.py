@@ -0,0 +1,356 @@
+"""
+Benchmark of the ESS Controller calculations with synthetic data.
+
+Measures the latency (percentiles) and the peak memory of the optimizer, the data conversions
+and the InfluxDB parsing without a Home Assistant instance (only the Python packages of the
+component are needed). Examples:
+
+    python tools/benchmark.py
+    python tools/benchmark.py --days 1 365 1825 --horizons 24 168 --repeat 50
+    python tools/benchmark.py --only pulp_calculations --engines pulp dp
+    python tools/benchmark.py --only pulp_calculations --horizons 24 --period-minutes 15 5
+    python tools/benchmark.py --save baseline.json
+    python tools/benchmark.py --compare baseline.json --tolerance 0.2
+
+With --compare the exit code is 1 if the median of any benchmark is slower than the
+median of the saved results by more than the tolerance.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from aiohttp import web
+
+# The modules of the integration are imported without its Home Assistant __init__
+from component import register_package
+
+register_package()
+
+from custom_components.ess_controller.api import PVContollerAPI  # noqa: E402
+from custom_components.ess_controller.influx_stream import InfluxChunkParser, INFLUX_CHUNK_SIZE  # noqa: E402
+from custom_components.ess_controller.const import OPTIMIZER_ENGINES, OPTIMIZER_ENGINE_VALIDATE  # noqa: E402
+from custom_components.ess_controller.optimizer import hourly_to_periods  # noqa: E402
+from custom_components.ess_controller.utils import forecast_solar_api_to_dict, pvpc_raw_to_useful_dict  # noqa: E402
+
+BENCHMARKS = ["pulp_calculations", "forecast_solar_api_to_dict", "pvpc_raw_to_useful_dict",
+              "compare_solar_production_forecast", "influx_chunk_parser", "df_from_influxdb"]
+
+# Start of the synthetic data (a winter day, the solar production is low in the first hours)
+START = datetime(2024, 1, 1, 0, 0)
+# Minute of the calculation moment (the first period is a fraction of an hour)
+CURRENT_MINUTE = 17
+# The ESIOS sensor only has the prices of the current and the next day
+MAX_PVPC_HOURS = 48
+
+
+def synthetic_hourly(hours: int, seed: int) -> dict[str, np.ndarray]:
+    """Return synthetic hourly demand (Wh), solar production (Wh) and buy/sell prices (€/kWh)."""
+    rng = np.random.default_rng(seed)
+    hour_of_day = (np.arange(hours) + START.hour) % 24
+    # Solar production: half sine wave between 7h and 19h with random clouds
+    daylight = np.clip(np.sin((hour_of_day - 7) / 12 * np.pi), 0, None)
+    solar = 3000 * daylight * rng.uniform(0.3, 1.0, hours)
+    # Demand: base load plus peaks in the morning and in the evening
+    demand = 300 + 900 * np.exp(-((hour_of_day - 8) ** 2) / 4) + 1200 * np.exp(-((hour_of_day - 21) ** 2) / 6)
+    demand = demand * rng.uniform(0.7, 1.3, hours)
+    # Prices: cheap at night and at noon, expensive in the evening
+    buy = 0.10 + 0.08 * np.exp(-((hour_of_day - 20) ** 2) / 8) - 0.04 * daylight + rng.uniform(0, 0.02, hours)
+    sell = np.clip(buy - 0.06, 0, None)
+    return {"demand": demand, "solar": solar, "buy": buy, "sell": sell}
+
+
+def forecast_solar_api_data(hours: int, seed: int) -> dict[str, float]:
+    """Return a dictionary as downloaded from the Forecast.Solar API (two delta values per hour, kWh)."""
+    solar = synthetic_hourly(hours, seed)["solar"] / 1000
+    data = {}
+    for i, value in enumerate(solar):
+        date = START + timedelta(hours=i)
+        data[date.strftime("%Y-%m-%d %H:%M:%S")] = round(value / 2, 3)
+        data[(date + timedelta(minutes=31, seconds=26)).strftime("%Y-%m-%d %H:%M:%S")] = round(value / 2, 3)
+    return data
+
+
+def pvpc_raw_data(hours: int, seed: int) -> dict[str, float]:
+    """Return the price attributes of the ESIOS sensor for the first hours (at most 48)."""
+    buy = synthetic_hourly(MAX_PVPC_HOURS, seed)["buy"]
+    data = {}
+    for i in range(min(hours, MAX_PVPC_HOURS)):
+        key = f"price_{i:02d}h" if i < 24 else f"price_next_day_{i - 24:02d}h"
+        data[key] = round(float(buy[i]), 5)
+    return data
+
+
+def history_df(hours: int, seed: int, scale: float = 1.0) -> pd.DataFrame:
+    """Return a DataFrame of hourly energy deltas (kWh) like the ones read from InfluxDB."""
+    solar = synthetic_hourly(hours, seed)["solar"] / 1000 * scale
+    index = pd.date_range(START, periods=hours, freq="h", name="time")
+    return pd.DataFrame({"delta_energy": solar}, index=index)
+
+
+def influx_response(hours: int, seed: int, chunk_size: int = INFLUX_CHUNK_SIZE) -> bytes:
+    """Return the body of a chunked response of InfluxDB (epoch=s) with the cumulative energy of a sensor."""
+    values = np.cumsum(synthetic_hourly(hours, seed)["solar"] / 1000)
+    start = int(pd.Timestamp(START, tz="UTC").timestamp())
+    lines = []
+    for offset in range(0, hours, chunk_size):
+        rows = [[start + 3600 * i, round(float(values[i]), 3)] for i in range(offset, min(offset + chunk_size, hours))]
+        series = {"name": "kWh", "columns": ["time", "value"], "values": rows}
+        result = {"statement_id": 0, "series": [series]}
+        if offset + chunk_size < hours:
+            result["partial"] = True
+        lines.append(json.dumps({"results": [result]}))
+    return ("\n".join(lines) + "\n").encode()
+
+
+class Benchmark:
+    """Run each case several times and collect the latency percentiles and the peak memory."""
+
+    def __init__(self, repeat: int, warmup: int) -> None:
+        """Initialize the benchmark."""
+        self.repeat = repeat
+        self.warmup = warmup
+        self.results = []
+
+    async def run(self, name: str, size: str, func) -> None:
+        """Measure the coroutine function func (called without arguments)."""
+        for _ in range(self.warmup):
+            await func()
+        times = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            await func()
+            times.append(time.perf_counter() - start)
+        # The memory is measured in a separate run since tracemalloc slows down the allocations
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        await func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        times_ms = np.array(times) * 1000
+        result = {
+            "benchmark": name,
+            "size": size,
+            "p50_ms": float(np.percentile(times_ms, 50)),
+            "p90_ms": float(np.percentile(times_ms, 90)),
+            "p99_ms": float(np.percentile(times_ms, 99)),
+            "max_ms": float(times_ms.max()),
+            "peak_kib": peak / 1024,
+        }
+        self.results.append(result)
+        print(f"{name:<36} {size:<22} {result['p50_ms']:>10.3f} {result['p90_ms']:>10.3f} "
+              f"{result['p99_ms']:>10.3f} {result['max_ms']:>10.3f} {result['peak_kib']:>11.1f}", flush=True)
+
+
+async def bench_pulp_calculations(bench: Benchmark, horizons: list[int], engines: list[str], seed: int,
+                                  periods_minutes: tuple[int, ...] = (60,)) -> None:
+    """Benchmark the optimization of the SoC schedule with each engine and length of the periods."""
+    current_datetime = START.replace(minute=CURRENT_MINUTE)
+    for engine, period_minutes in itertools.product(engines, periods_minutes):
+        api = PVContollerAPI(battery_capacity_Wh=10000, max_charge_energy_per_period_Wh=3000,
+                             max_discharge_energy_per_period_Wh=3000, max_buy_energy_per_period_Wh=5000,
+                             charge_efficiency=0.95, discharge_efficiency=0.95, battery_purchase_price=3000,
+                             optimizer_engine=engine, period_minutes=period_minutes)
+        periods_per_hour = api.periods_per_hour
+        size = f"engine={engine}" if period_minutes == 60 else f"engine={engine} p={period_minutes}"
+        try:
+            for horizon in horizons:
+                data = synthetic_hourly(horizon, seed)
+
+                async def calculate():
+                    # pulp_calculations modifies the first period of the lists, use new copies each time
+                    api._list_demand = hourly_to_periods(data["demand"], periods_per_hour)
+                    api._list_solar_production = hourly_to_periods(data["solar"], periods_per_hour)
+                    api._list_buy_prices = hourly_to_periods(data["buy"], periods_per_hour, energy=False)
+                    api._list_sell_prices = hourly_to_periods(data["sell"], periods_per_hour, energy=False)
+                    api._current_initial_soc_Wh = 5000
+                    api._test_min_soc_Wh = 2000
+                    _, objective = await api.pulp_calculations(current_datetime)
+                    if objective is None:
+                        raise RuntimeError(f"No solution for horizon {horizon} with engine {engine}")
+
+                await bench.run("pulp_calculations", f"{size} h={horizon}", calculate)
+        finally:
+            await api.async_close()
+
+
+async def bench_forecast_solar_api_to_dict(bench: Benchmark, horizons: list[int], seed: int) -> None:
+    """Benchmark the conversion of the Forecast.Solar data."""
+    current_datetime = START.replace(minute=CURRENT_MINUTE)
+    for horizon in horizons:
+        data = forecast_solar_api_data(horizon, seed)
+        await bench.run("forecast_solar_api_to_dict", f"h={horizon}",
+                        lambda: forecast_solar_api_to_dict(data, current_datetime))
+
+
+async def bench_pvpc_raw_to_useful_dict(bench: Benchmark, horizons: list[int], seed: int) -> None:
+    """Benchmark the conversion of the prices of the ESIOS sensor."""
+    current_datetime = START.replace(minute=CURRENT_MINUTE)
+    for horizon in sorted({min(horizon, MAX_PVPC_HOURS) for horizon in horizons}):
+        data = pvpc_raw_data(horizon, seed)
+        await bench.run("pvpc_raw_to_useful_dict", f"h={horizon}",
+                        lambda: pvpc_raw_to_useful_dict(data, current_datetime))
+
+
+async def bench_compare_solar_production_forecast(bench: Benchmark, days: list[int], seed: int) -> None:
+    """Benchmark the comparison of the solar production history with the solar forecast history."""
+    api = PVContollerAPI()
+    try:
+        for num_days in days:
+            production = history_df(24 * num_days, seed)
+            forecast = history_df(24 * num_days, seed + 1, scale=1.2)
+
+            async def compare():
+                api.df_history_solar_production = production
+                api.df_hystory_forecast_solar = forecast
+                await api.compare_solar_production_forecast()
+
+            await bench.run("compare_solar_production_forecast", f"days={num_days}", compare)
+    finally:
+        await api.async_close()
+
+
+async def bench_influx_chunk_parser(bench: Benchmark, days: list[int], seed: int) -> None:
+    """Benchmark the incremental parser of the InfluxDB responses (fed in pieces of 64 KiB)."""
+    for num_days in days:
+        body = influx_response(24 * num_days, seed)
+
+        async def parse():
+            parser = InfluxChunkParser()
+            for offset in range(0, len(body), 65536):
+                parser.feed(body[offset:offset + 65536])
+            parser.close()
+
+        await bench.run("influx_chunk_parser", f"days={num_days}", parse)
+
+
+async def bench_df_from_influxdb(bench: Benchmark, days: list[int], seed: int) -> None:
+    """Benchmark df_from_influxdb against a local HTTP server that returns the synthetic responses."""
+    bodies = {}
+
+    async def query(request):
+        # The number of days is passed in the name of the database
+        return web.Response(body=bodies[request.query["db"]], content_type="application/json")
+
+    app = web.Application()
+    app.router.add_get("/query", query)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        for num_days in days:
+            database = f"days{num_days}"
+            bodies[database] = influx_response(24 * num_days, seed)
+            api = PVContollerAPI(influx_db_url=f"http://127.0.0.1:{port}/query", influx_db_user="user",
+                                 influx_db_pass="pass", influx_db_database=database,
+                                 str_local_timezone="Europe/Madrid")
+            try:
+                # Wait for the timezone set in a task by the constructor
+                while api.class_local_timezone is None:
+                    await asyncio.sleep(0)
+                query_string = await api.energy_query_string("sensor.solar_production")
+
+                async def read():
+                    df = await api.df_from_influxdb(query_string)
+                    if len(df) != 24 * num_days:
+                        raise RuntimeError(f"Unexpected number of rows: {len(df)}")
+
+                await bench.run("df_from_influxdb", f"days={num_days}", read)
+            finally:
+                await api.async_close()
+    finally:
+        await runner.cleanup()
+
+
+def compare_results(results: list[dict], baseline_file: str, tolerance: float) -> bool:
+    """Compare the medians with the saved ones and return True if there is no regression."""
+    with open(baseline_file, encoding="utf-8") as f:
+        baseline = {(r["benchmark"], r["size"]): r for r in json.load(f)["results"]}
+    ok = True
+    print()
+    for result in results:
+        previous = baseline.get((result["benchmark"], result["size"]))
+        if previous is None:
+            continue
+        ratio = result["p50_ms"] / previous["p50_ms"] if previous["p50_ms"] > 0 else math.inf
+        status = "ok"
+        if ratio > 1 + tolerance:
+            status = "REGRESSION"
+            ok = False
+        print(f"{result['benchmark']:<36} {result['size']:<22} {previous['p50_ms']:>10.3f} -> "
+              f"{result['p50_ms']:>10.3f} ms ({ratio:5.2f}x) {status}")
+    return ok
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, nargs="+", default=[1, 30, 365, 1825],
+                        help="Length of the history series in days (1 day to 5 years)")
+    parser.add_argument("--horizons", type=int, nargs="+", default=[12, 24, 48, 168],
+                        help="Optimization horizons in hours (12 to 168)")
+    parser.add_argument("--engines", nargs="+", default=["pulp", "dp"],
+                        choices=[engine for engine in OPTIMIZER_ENGINES if engine != OPTIMIZER_ENGINE_VALIDATE],
+                        help="Optimizer engines for pulp_calculations")
+    parser.add_argument("--period-minutes", type=int, nargs="+", default=[60], choices=[60, 15, 5],
+                        help="Length of the periods of pulp_calculations (sub-hourly periods of the rolling horizon)")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS,
+                        help="Benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=20, help="Measured runs of each case")
+    parser.add_argument("--warmup", type=int, default=2, help="Runs of each case before measuring")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    parser.add_argument("--save", help="Save the results to a JSON file")
+    parser.add_argument("--compare", help="Compare the results with a JSON file saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown of the median with --compare (0.25 = 25%%)")
+    args = parser.parse_args()
+    if any(days < 1 or days > 5 * 366 for days in args.days):
+        parser.error("--days must be between 1 and 1830")
+    if any(horizon < 2 or horizon > 168 for horizon in args.horizons):
+        parser.error("--horizons must be between 2 and 168")
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    return args
+
+
+async def main(args: argparse.Namespace) -> int:
+    """Run the selected benchmarks."""
+    bench = Benchmark(args.repeat, args.warmup)
+    print(f"{'benchmark':<36} {'size':<22} {'p50 (ms)':>10} {'p90 (ms)':>10} "
+          f"{'p99 (ms)':>10} {'max (ms)':>10} {'peak (KiB)':>11}")
+    if "pulp_calculations" in args.only:
+        await bench_pulp_calculations(bench, args.horizons, args.engines, args.seed, args.period_minutes)
+    if "forecast_solar_api_to_dict" in args.only:
+        await bench_forecast_solar_api_to_dict(bench, args.horizons, args.seed)
+    if "pvpc_raw_to_useful_dict" in args.only:
+        await bench_pvpc_raw_to_useful_dict(bench, args.horizons, args.seed)
+    if "compare_solar_production_forecast" in args.only:
+        await bench_compare_solar_production_forecast(bench, args.days, args.seed)
+    if "influx_chunk_parser" in args.only:
+        await bench_influx_chunk_parser(bench, args.days, args.seed)
+    if "df_from_influxdb" in args.only:
+        await bench_df_from_influxdb(bench, args.days, args.seed)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"date": datetime.now().isoformat(), "args": vars(args), "results": bench.results}, f, indent=2)
+    if args.compare and not compare_results(bench.results, args.compare, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    # The component logs every step at debug level, only the warnings are shown
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(main(parse_args())))
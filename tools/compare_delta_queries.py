@@ -0,0 +1,114 @@
+"""
+Equivalence check of the hourly energy differences calculated by InfluxDB and by pandas.
+
+Reads the same energy sensor of a real InfluxDB (1.8, InfluxQL) in both ways:
+- pandas: cumulative counter (last("value")) differenced by PVContollerAPI.hourly_delta_energy_dataframe
+- InfluxDB: energy_query_string(..., delta=True), NON_NEGATIVE_DIFFERENCE calculated by the database
+and checks that both give the same hourly deltas. The hours with a counter reset are omitted by
+InfluxDB and set to 0 by pandas: they must be exactly the hours missing in InfluxDB, any other missing
+hour is a difference. tests/test_delta_queries.py makes the same checks offline with recorded points. Examples:
+
+    python tools/compare_delta_queries.py --url http://192.168.0.100:8086 --user homeassistant \\
+        --password secret --entity victron_solarcharger_yield_user_230 --days 30
+    python tools/compare_delta_queries.py ... --end 2024-10-01 --tolerance 1e-6
+
+The exit code is 1 if any hour differs by more than the tolerance (kWh).
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# The modules of the integration are imported without its Home Assistant __init__
+from component import register_package
+
+register_package()
+
+from custom_components.ess_controller.api import PVContollerAPI  # noqa: E402
+
+
+def compare_deltas(pandas_df: pd.DataFrame, influx_df: pd.DataFrame, tolerance: float) -> tuple[bool, pd.DataFrame]:
+    """
+    Align both DataFrames by hour and return whether they match and the hours that differ.
+    The hours missing in InfluxDB must be the counter resets of the pandas DataFrame (the counter decreases).
+    """
+    both = pd.DataFrame({
+        "pandas": pandas_df["delta_energy"] if not pandas_df.empty else pd.Series(dtype=np.float64),
+        "influx": influx_df["delta_energy"] if not influx_df.empty else pd.Series(dtype=np.float64),
+    })
+    counter = pandas_df["energy_kWh"] if not pandas_df.empty else pd.Series(dtype=np.float64)
+    reset = (counter < counter.shift(1)).reindex(both.index, fill_value=False).astype(bool)
+    both["reset"] = reset
+    differ = both["pandas"].isna() | (both["influx"].isna() != reset) | \
+        (~reset & ((both["pandas"] - both["influx"]).abs() > tolerance))
+    differences = both[differ]
+    return differences.empty, differences
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", required=True, help="URL of InfluxDB, e.g. http://192.168.0.100:8086")
+    parser.add_argument("--user", default="homeassistant", help="InfluxDB user")
+    parser.add_argument("--password", default="", help="InfluxDB password")
+    parser.add_argument("--database", default="homeassistant", help="InfluxDB database")
+    parser.add_argument("--entity", required=True, help="entity_id of the energy sensor without the domain")
+    parser.add_argument("--timezone", default="Europe/Madrid", help="Local timezone of Home Assistant")
+    parser.add_argument("--end", help="Local end date (YYYY-MM-DD), by default today at 00:00")
+    parser.add_argument("--days", type=int, default=30, help="Days of history before the end date")
+    parser.add_argument("--tolerance", type=float, default=1e-9, help="Allowed difference of each hour (kWh)")
+    args = parser.parse_args()
+    if args.days < 1:
+        parser.error("--days must be at least 1")
+    return args
+
+
+async def main(args: argparse.Namespace) -> int:
+    """Read the deltas in both ways and compare them."""
+    end = pd.to_datetime(args.end).to_pydatetime() if args.end else \
+        datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = end - timedelta(days=args.days)
+    api = PVContollerAPI(influx_db_url=args.url, influx_db_user=args.user, influx_db_pass=args.password,
+                         influx_db_database=args.database, str_local_timezone=args.timezone)
+    try:
+        # Wait for the timezone set in a task by the constructor
+        while api.class_local_timezone is None:
+            await asyncio.sleep(0)
+
+        t0 = time.perf_counter()
+        pandas_df = await api.hourly_delta_energy_dataframe(args.entity, start=start, end=end)
+        t1 = time.perf_counter()
+        query = await api.energy_query_string(args.entity, start=start, end=end, delta=True)
+        influx_df = await api.df_from_influxdb(query)
+        t2 = time.perf_counter()
+    finally:
+        await api.async_close()
+
+    # The last hour of the InfluxDB query (time <= end) is not complete, the hour of end is left out of both
+    if not pandas_df.empty:
+        pandas_df = pandas_df[pandas_df.index < end]
+    if not influx_df.empty:
+        influx_df = influx_df[influx_df.index < end]
+    print(f"pandas:   {len(pandas_df):>7} hours {1000 * (t1 - t0):>9.1f} ms")
+    print(f"InfluxDB: {len(influx_df):>7} hours {1000 * (t2 - t1):>9.1f} ms")
+    if pandas_df.empty and influx_df.empty:
+        print(f"No data of {args.entity} between {start} and {end}")
+        return 1
+
+    ok, differences = compare_deltas(pandas_df, influx_df, args.tolerance)
+    if ok:
+        print("The hourly deltas are equivalent")
+        return 0
+    print(f"{len(differences)} hours differ by more than {args.tolerance} kWh:")
+    print(differences.to_string())
+    return 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(asyncio.run(main(parse_args())))
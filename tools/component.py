@@ -0,0 +1,29 @@
+"""
+Import of the modules of the integration without Home Assistant.
+
+The __init__ of custom_components/ess_controller sets up the integration and imports Home Assistant.
+The tools only use the modules that do not depend on it (api, optimizer, utils, ...), so the package
+is registered from its directory without running its __init__. Usage, before importing the modules:
+
+    from component import register_package
+    register_package()
+"""
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PACKAGE = "custom_components.ess_controller"
+PACKAGE_DIR = os.path.join(ROOT, "custom_components", "ess_controller")
+
+
+def register_package() -> None:
+    """Register the package of the integration (without its __init__) so that its modules can be imported."""
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    if PACKAGE in sys.modules:
+        return
+    spec = importlib.machinery.ModuleSpec(PACKAGE, None, is_package=True)
+    spec.submodule_search_locations = [PACKAGE_DIR]
+    sys.modules[PACKAGE] = importlib.util.module_from_spec(spec)
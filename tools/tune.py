@@ -0,0 +1,173 @@
+"""
+Tuning of the controller parameters with the backtest.
+
+Replays the same historical days (tools/backtest.py) with each combination of:
+- soc_safety_margin: SoC margin added to the minimum SoC (%), as the number entity of the integration
+- final_soc_weight_factor: factor of the weight w of the final SoC in the objective function (1 = heuristic w)
+- battery_eol_cycles_if_min_soc_20 / _50: battery lifetime used to price the energy of the battery
+and reports the Pareto-optimal combinations of three objectives: the grid cost (€, lower is better), the equivalent
+full cycles of the battery (degradation, lower is better) and the lowest SoC reached (reserve, higher is better).
+The battery cycles are counted instead of the battery cost since the cost depends on the tuned lifetime parameters.
+
+The combinations are the grid of the given values or, with --samples, random samples of the ranges (Monte Carlo).
+The chunks of days of all the combinations run in a single process pool. Examples:
+
+    python tools/tune.py --synthetic --days 90 --margins 0 5 10 15 20 --w-factors 0.5 1 2
+    python tools/tune.py --csv history.csv --days 180 --samples 64 --save sweep.csv
+"""
+import argparse
+import itertools
+import logging
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from backtest import WARMUP_DAYS, BacktestConfig, backtest_tasks, load_history, run_chunk, synthetic_history
+
+# Parameters of the sweep (fields of BacktestConfig)
+PARAMETERS = ["soc_safety_margin", "final_soc_weight_factor",
+              "battery_eol_cycles_if_min_soc_20", "battery_eol_cycles_if_min_soc_50"]
+# Ranges of the random samples: (low, high, logarithmic)
+SAMPLE_RANGES = {
+    "soc_safety_margin": (0, 25, False),
+    "final_soc_weight_factor": (0.25, 4, True),
+    "battery_eol_cycles_if_min_soc_20": (1500, 5000, False),
+}
+# The lifetime at 50% is sampled as a multiple of the lifetime at 20% (it is never shorter)
+SAMPLE_EOL_50_RATIO = (1.0, 3.0)
+
+
+def grid_candidates(values: dict[str, list[float]]) -> list[dict]:
+    """Return all the combinations of the values of each parameter."""
+    return [dict(zip(values, combination)) for combination in itertools.product(*values.values())]
+
+
+def random_candidates(samples: int, seed: int) -> list[dict]:
+    """Return random combinations of the parameters inside SAMPLE_RANGES."""
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for name, (low, high, logarithmic) in SAMPLE_RANGES.items():
+        if logarithmic:
+            columns[name] = np.exp(rng.uniform(np.log(low), np.log(high), samples))
+        else:
+            columns[name] = rng.uniform(low, high, samples)
+    columns["battery_eol_cycles_if_min_soc_50"] = \
+        columns["battery_eol_cycles_if_min_soc_20"] * rng.uniform(*SAMPLE_EOL_50_RATIO, samples)
+    return [{name: float(np.round(columns[name][i], 2)) for name in PARAMETERS} for i in range(samples)]
+
+
+def pareto_front(objectives: np.ndarray) -> np.ndarray:
+    """Return the mask of the rows not dominated by any other row (all the columns are minimized)."""
+    efficient = np.ones(len(objectives), dtype=bool)
+    for i, row in enumerate(objectives):
+        dominated = np.all(objectives <= row, axis=1) & np.any(objectives < row, axis=1)
+        efficient[i] = not dominated.any()
+    return efficient
+
+
+def sweep(history: pd.DataFrame, start, days: int, base: BacktestConfig, candidates: list[dict],
+          chunk_days: int = 7, workers: int | None = None) -> pd.DataFrame:
+    """Replay the days with each candidate and return the objectives of each one."""
+    tasks, owners = [], []
+    for number, candidate in enumerate(candidates):
+        candidate_tasks = backtest_tasks(history, start, days, replace(base, **candidate), chunk_days)
+        tasks.extend(candidate_tasks)
+        owners.extend([number] * len(candidate_tasks))
+
+    days_by_candidate = [[] for _ in candidates]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for number, chunk in zip(owners, executor.map(run_chunk, tasks)):
+            days_by_candidate[number].extend(chunk)
+
+    rows = []
+    for candidate, results in zip(candidates, days_by_candidate):
+        if not results:
+            continue
+        df = pd.DataFrame(results)
+        rows.append({**candidate,
+                     "days": len(df),
+                     "grid_cost": df["cost"].sum(),
+                     "baseline_cost": df["baseline_cost"].sum(),
+                     "cycles": df["discharged_Wh"].sum() / base.battery_capacity_Wh,
+                     "lowest_soc": df["min_soc"].min(),
+                     "failed_calculations": int(df["failed_calculations"].sum())})
+    results = pd.DataFrame(rows)
+    if not results.empty:
+        objectives = results[["grid_cost", "cycles", "lowest_soc"]].to_numpy() * np.array([1, 1, -1])
+        results["pareto"] = pareto_front(objectives)
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--synthetic", action="store_true", help="Use the synthetic data of tools/benchmark.py")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data and of the random samples")
+    parser.add_argument("--csv", help="CSV file with the hourly history (columns of tools/backtest.py)")
+    parser.add_argument("--start", help="First replayed day (YYYY-MM-DD), by default after the warmup days")
+    parser.add_argument("--days", type=int, default=90, help="Number of replayed days")
+    parser.add_argument("--chunk-days", type=int, default=7, help="Consecutive days replayed by each task")
+    parser.add_argument("--workers", type=int, help="Worker processes, by default the number of CPUs")
+    parser.add_argument("--margins", type=float, nargs="+", default=[0, 5, 10, 15, 20], help="SoC safety margins (%%)")
+    parser.add_argument("--w-factors", type=float, nargs="+", default=[0.5, 1, 2], help="Factors of the weight w")
+    parser.add_argument("--eol-20", type=float, nargs="+", default=[BacktestConfig.battery_eol_cycles_if_min_soc_20],
+                        help="Battery lifetime cycles with a minimum SoC of 20%%")
+    parser.add_argument("--eol-50", type=float, nargs="+", default=[BacktestConfig.battery_eol_cycles_if_min_soc_50],
+                        help="Battery lifetime cycles with a minimum SoC of 50%%")
+    parser.add_argument("--samples", type=int, help="Random samples of the parameter ranges instead of the grid")
+    parser.add_argument("--capacity", type=float, default=10000, help="Battery capacity (Wh)")
+    parser.add_argument("--battery-price", type=float, default=3000, help="Battery purchase price (€)")
+    parser.add_argument("--min-soc", type=float, default=20, help="Minimum SoC chosen by the user (%%)")
+    parser.add_argument("--sell", action="store_true", help="The energy sent to the grid is paid at the sell price")
+    parser.add_argument("--save", help="Save the objectives of all the combinations to a CSV file")
+    args = parser.parse_args()
+    if args.synthetic == bool(args.csv):
+        parser.error("use either --synthetic or --csv")
+    if args.days < 1 or args.chunk_days < 1 or (args.samples is not None and args.samples < 1):
+        parser.error("--days, --chunk-days and --samples must be at least 1")
+    return args
+
+
+def main(args: argparse.Namespace) -> int:
+    """Run the sweep and print the Pareto-optimal combinations."""
+    if args.synthetic:
+        history = synthetic_history(WARMUP_DAYS + args.days + 1, args.seed)
+    else:
+        history = load_history(args.csv)
+        history = history[history.index >= history.index[0].ceil("D")]
+    start = pd.to_datetime(args.start).to_pydatetime() if args.start else \
+        (history.index[0] + timedelta(days=WARMUP_DAYS)).to_pydatetime()
+    base = replace(BacktestConfig(), battery_capacity_Wh=args.capacity, battery_purchase_price=args.battery_price,
+                   min_soc_percent=args.min_soc, sell_allowed=args.sell)
+    if args.samples:
+        candidates = random_candidates(args.samples, args.seed)
+    else:
+        candidates = grid_candidates({"soc_safety_margin": args.margins, "final_soc_weight_factor": args.w_factors,
+                                      "battery_eol_cycles_if_min_soc_20": args.eol_20,
+                                      "battery_eol_cycles_if_min_soc_50": args.eol_50})
+
+    t0 = time.perf_counter()
+    results = sweep(history, start, args.days, base, candidates, args.chunk_days, args.workers)
+    elapsed = time.perf_counter() - t0
+    if results.empty:
+        print("No day could be replayed")
+        return 1
+    if args.save:
+        results.to_csv(args.save, index=False)
+
+    pd.set_option("display.width", 200)
+    front = results[results["pareto"]].sort_values("grid_cost").drop(columns="pareto")
+    print(f"{len(candidates)} combinations x {int(results['days'].max())} days in {elapsed:.1f} s")
+    print(f"Pareto-optimal combinations ({len(front)}):")
+    print(front.round(3).to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(parse_args()))